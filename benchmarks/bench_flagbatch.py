@@ -0,0 +1,86 @@
+"""Benchmark the initial flagging stage with separate flagdata calls vs a FlagBatch.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_flagbatch.py --nchan 2048 --nscans 6
+
+Before: manual channel 0, quack 'beg', quack 'endb' and a summary, each one
+a separate `flagdata` call (4 passes over the MS).
+After: the same commands plus the summary in one `flagdata(mode='list')` pass.
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import casatasks as cts
+
+from capture.core.flagging import FlagBatch
+from synthetic import make_synthetic_ms
+
+
+def flag_separately(msfile, quackinterval):
+    """Initial flagging as done before, one flagdata call per command."""
+    cts.flagdata(vis=msfile, mode='manual', spw='0:0', action='apply', flagbackup=False)
+    cts.flagdata(vis=msfile, mode='quack', quackinterval=quackinterval, quackmode='beg',
+                 action='apply', flagbackup=False)
+    cts.flagdata(vis=msfile, mode='quack', quackinterval=quackinterval, quackmode='endb',
+                 action='apply', flagbackup=False)
+    return cts.flagdata(vis=msfile, mode='summary'), 4
+
+
+def flag_batched(msfile, quackinterval):
+    """Initial flagging with a FlagBatch (single pass, summary included)."""
+    flagbatch = FlagBatch(msfile)
+    flagbatch.add(mode='manual', spw='0:0')
+    flagbatch.add(mode='quack', quackinterval=quackinterval, quackmode='beg')
+    flagbatch.add(mode='quack', quackinterval=quackinterval, quackmode='endb')
+    return flagbatch.apply(summary=True), 1
+
+
+def run(nant, nchan, nscans, quackinterval, repeat, workdir):
+    """Time both approaches on copies of the same synthetic MS."""
+    template = make_synthetic_ms(os.path.join(workdir, f"bench_{nant}_{nchan}_{nscans}.ms"),
+                                 nant=nant, nchan=nchan, nscans=nscans)
+    results = {'nant': nant, 'nchan': nchan, 'nscans': nscans}
+    for label, func in (('before', flag_separately), ('after', flag_batched)):
+        times = []
+        for _ in range(repeat):
+            msfile = os.path.join(workdir, f"{label}.ms")
+            shutil.rmtree(msfile, ignore_errors=True)
+            shutil.copytree(template, msfile)
+            t0 = time.perf_counter()
+            summary, passes = func(msfile, quackinterval)
+            times.append(time.perf_counter() - t0)
+        results[label] = {'passes': passes, 'wall_time_s': min(times),
+                          'flagged': summary['flagged'], 'total': summary['total']}
+    results['speedup'] = results['before']['wall_time_s'] / results['after']['wall_time_s']
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--nant', type=int, default=30, help='Number of antennas')
+    parser.add_argument('--nchan', type=int, default=2048, help='Number of channels')
+    parser.add_argument('--nscans', type=int, default=6, help='Number of scans')
+    parser.add_argument('--quack', type=float, default=8.0, help='Quack interval (s)')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions (best time is kept)')
+    parser.add_argument('--output', type=str, default='flagbatch.json', help='Output JSON file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir='.') as workdir:
+        results = run(args.nant, args.nchan, args.nscans, args.quack, args.repeat, workdir)
+
+    for label in ('before', 'after'):
+        r = results[label]
+        print(f"{label:>6}: {r['passes']} passes, {r['wall_time_s']:.2f} s, "
+              f"{r['flagged']:.0f}/{r['total']:.0f} flagged")
+    print(f"speedup: {results['speedup']:.2f}x")
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
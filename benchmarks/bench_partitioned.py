@@ -0,0 +1,123 @@
+"""Benchmark flagging, applycal and split on a monolithic MS vs a partitioned Multi-MS.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_partitioned.py --nchan 2048 --workers 1 4 16
+
+Serial: one `flagdata(mode='list')` pass, one applycal pass and one mstransform
+split of a target on the monolithic MS.
+Partitioned: the MS is partitioned by scan and the same three stages run on the
+sub-MSs through a `PartitionRunner` with 1, 4 and 16 workers (capped to the CPUs
+of the node, the effective number is recorded).
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import casatasks as cts
+
+from capture.core.flagging import FlagBatch
+from capture.core.calibration import apply_calibration_batch
+from capture.core.parallel import partition_ms, PartitionRunner
+from synthetic import make_synthetic_ms
+
+FIELDS = ['3C286', 'TARGET1', 'TARGET2']
+
+
+def make_gaintable(msfile, caltable):
+    """Solve a phase-only gain table on the calibrator to apply in the benchmark."""
+    cts.delmod(vis=msfile, otf=True, scr=True)
+    cts.gaincal(vis=msfile, caltable=caltable, field='3C286', solint='inf', refant='C00',
+                calmode='p', minsnr=0)
+    return caltable
+
+
+def stages(msfile, gaintable, splitfile, runner=None):
+    """Run the three stages, returning the wall time of each one."""
+    times = {}
+    t0 = time.perf_counter()
+    flagbatch = FlagBatch(msfile)
+    flagbatch.add(mode='manual', spw='0:0')
+    flagbatch.add(mode='quack', quackinterval=8.0, quackmode='beg')
+    flagbatch.add(mode='clip', clipminmax=[0, 50], datacolumn='DATA')
+    flagbatch.apply(summary=True, runner=runner)
+    times['flagdata'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    apply_calibration_batch(msfile, FIELDS, [gaintable, '', ''], runner=runner)
+    times['applycal'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    if runner is not None:
+        runner.mstransform(outputvis=splitfile, field='TARGET1', datacolumn='corrected',
+                           keepflags=False)
+    else:
+        cts.mstransform(vis=msfile, outputvis=splitfile, field='TARGET1',
+                        datacolumn='corrected', keepflags=False)
+    times['split'] = time.perf_counter() - t0
+    times['total'] = sum(times.values())
+    return times
+
+
+def run(nant, nchan, nscans, nparts, workers, memory_gb, workdir):
+    """Time the serial and partitioned runs on copies of the same synthetic MS."""
+    template = make_synthetic_ms(os.path.join(workdir, f"bench_{nant}_{nchan}_{nscans}.ms"),
+                                 nant=nant, nchan=nchan, nscans=nscans)
+    gaintable = make_gaintable(template, f"{template}.G")
+    results = {'nant': nant, 'nchan': nchan, 'nscans': nscans, 'partitions': nparts,
+               'cpus': os.cpu_count(), 'runs': []}
+
+    def fresh(label):
+        msfile = os.path.join(workdir, f"{label}.ms")
+        for path in (msfile, f"{msfile}.mms", f"{msfile}.split"):
+            shutil.rmtree(path, ignore_errors=True)
+        shutil.copytree(template, msfile)
+        return msfile
+
+    msfile = fresh('serial')
+    results['serial'] = stages(msfile, gaintable, f"{msfile}.split")
+
+    for nworkers in workers:
+        msfile = fresh(f"workers{nworkers}")
+        t0 = time.perf_counter()
+        mmsfile = partition_ms(msfile, axis='scan', nparts=nparts)
+        partition_time = time.perf_counter() - t0
+        runner = PartitionRunner(mmsfile, workers=nworkers, memory_gb=memory_gb)
+        with runner:
+            times = stages(mmsfile, gaintable, f"{msfile}.split", runner=runner)
+        results['runs'].append({'workers': nworkers, 'effective_workers': runner.workers,
+                                'partition_s': partition_time, **times,
+                                'speedup': results['serial']['total'] / times['total']})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--nant', type=int, default=30, help='Number of antennas')
+    parser.add_argument('--nchan', type=int, default=2048, help='Number of channels')
+    parser.add_argument('--nscans', type=int, default=16, help='Number of scans')
+    parser.add_argument('--partitions', type=int, default=16, help='Number of sub-MSs')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16],
+                        help='Worker counts to time')
+    parser.add_argument('--memory', type=float, default=None, help='Memory cap per worker (GB)')
+    parser.add_argument('--output', type=str, default='partitioned.json', help='Output JSON file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir='.') as workdir:
+        results = run(args.nant, args.nchan, args.nscans, args.partitions, args.workers,
+                      args.memory, workdir)
+
+    print(f"serial: {results['serial']['total']:.2f} s")
+    for r in results['runs']:
+        print(f"{r['workers']:>3} workers ({r['effective_workers']} effective): "
+              f"{r['total']:.2f} s + {r['partition_s']:.2f} s partitioning, "
+              f"speedup {r['speedup']:.2f}x")
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark the start-up time of CAPTURE (imports, Pipeline construction, --plan).
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_startup.py --config config_capture.toml --repeat 5
+
+Every case runs in a fresh interpreter, so nothing is cached between them:
+- casatasks: `import casatasks`, what every `Pipeline(...)` used to pay
+- import: `import capture.core.pipeline` (and the modules the Snakefile imports)
+- pipeline: `Pipeline(config)`, as the Snakefile does at parse time
+- eager: `import casatasks` followed by `Pipeline(config)`, the previous behaviour
+- plan: `python -m capture.main config --plan`
+
+The median wall time of each case is recorded, together with whether CASA was
+imported.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import statistics
+import tempfile
+
+CHECK = "import sys; print('CASA_LOADED' if 'casatasks' in sys.modules else 'CASA_NOT_LOADED')"
+
+CASES = {
+    'casatasks': "import casatasks",
+    'import': ("import capture.core.pipeline, capture.core.calibration, capture.core.imaging, "
+               "capture.utils.casa_tools"),
+    'pipeline': ("from capture.core.pipeline import Pipeline; "
+                 "Pipeline({config!r}, log=False)"),
+    'eager': ("import casatasks; from capture.core.pipeline import Pipeline; "
+              "Pipeline({config!r}, log=False)"),
+}
+
+
+def time_command(command, env, cwd):
+    """Run a command, returning its wall time and whether it imported CASA."""
+    t0 = time.perf_counter()
+    result = subprocess.run(command, env=env, cwd=cwd, capture_output=True, text=True,
+                            check=True)
+    return time.perf_counter() - t0, 'CASA_LOADED' in result.stdout
+
+
+def run(config, repeat):
+    """Time every case `repeat` times."""
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [src,
+                                                                    os.environ.get('PYTHONPATH')])))
+    commands = {name: [sys.executable, '-c', f"{code.format(config=config)}; {CHECK}"]
+                for name, code in CASES.items()}
+    commands['plan'] = [sys.executable, '-m', 'capture.main', config, '--plan']
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, command in commands.items():
+            runs = [time_command(command, env, workdir) for _ in range(repeat)]
+            results[name] = {'median_s': statistics.median(t for t, _ in runs),
+                             'min_s': min(t for t, _ in runs),
+                             'casa_loaded': any(loaded for _, loaded in runs)}
+    # --plan prints the plan, not the CASA check
+    results['plan'].pop('casa_loaded')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', type=str, default='config_capture.toml',
+                        help='Configuration file')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each case')
+    parser.add_argument('--output', type=str, default='startup.json', help='Output JSON file')
+    args = parser.parse_args()
+
+    results = run(os.path.abspath(args.config), args.repeat)
+    for name, r in results.items():
+        loaded = '' if 'casa_loaded' not in r else \
+            (', CASA imported' if r['casa_loaded'] else ', CASA not imported')
+        print(f"{name:>10}: {r['median_s']:.2f} s median, {r['min_s']:.2f} s min{loaded}")
+    print(f"Pipeline construction: {results['eager']['median_s']:.2f} s -> "
+          f"{results['pipeline']['median_s']:.2f} s")
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
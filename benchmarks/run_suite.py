@@ -0,0 +1,327 @@
+"""Time every pipeline step and helper on synthetic uGMRT-like MSs of several sizes.
+
+Usage:
+    PYTHONPATH=src python benchmarks/run_suite.py --nchan 2048 4096
+    PYTHONPATH=src python benchmarks/run_suite.py --only flagging calibration --compare HEAD~1
+
+For each data size a synthetic MS (see `synthetic.py`, with a calibrator and two
+targets) is simulated once and the pipeline runs on a fresh copy of it, in the order
+of the pipeline: metadata helpers, flagging, bad antenna/channel searches,
+calibration, target split and averaging, and imaging. Every benchmark records its
+wall time, CPU time, peak memory, bytes read/written and the time of each CASA task
+it called (see `capture.utils.profiling`).
+
+The results are stored in `benchmarks/results/<commit>.json` (with a `-dirty` suffix if
+the tree has uncommitted changes), so that the runs of different commits can be
+compared with `--compare <commit>`. Everything runs offline on the local machine.
+"""
+
+import os
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import casatasks as cts
+from datetime import datetime
+
+from capture.core.flagging import FlagBatch, find_bad_antennas, find_and_flag_bad_channels
+from capture.core.calibration import (initial_calibration, gain_calibration_batch,
+                                      apply_calibration_batch)
+from capture.core.imaging import make_dirty_image, clean_image
+from capture.utils.casa_tools import getfields, getnchan, getbandcut, vislistobs, flagsummary
+from capture.utils.ms_metadata import clear_metadata_cache
+from capture.utils.profiling import Profiler
+from synthetic import make_synthetic_ms, DEFAULT_FIELDS
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+REFANT = 'C00'
+CALIBRATOR = '3C286'
+TARGET = 'TARGET1'
+
+
+def bench_getfields(ctx):
+    getfields(ctx['msfile'])
+
+
+def bench_getnchan(ctx):
+    getnchan(ctx['msfile'])
+
+
+def bench_getbandcut(ctx):
+    getbandcut(ctx['msfile'])
+
+
+def bench_vislistobs(ctx):
+    vislistobs(ctx['msfile'])
+
+
+def bench_initial_flagging(ctx):
+    flagbatch = FlagBatch(ctx['msfile'])
+    flagbatch.add(mode='manual', spw='0:0')
+    flagbatch.add(mode='quack', quackinterval=8.0, quackmode='beg')
+    flagbatch.add(mode='quack', quackinterval=8.0, quackmode='endb')
+    flagbatch.apply(summary=True)
+
+
+def bench_find_bad_antennas(ctx):
+    find_bad_antennas(ctx['msfile'], fields=[CALIBRATOR])
+
+
+def bench_find_bad_channels(ctx):
+    find_and_flag_bad_channels(ctx['msfile'], find=True, flag=False)
+
+
+def bench_initial_calibration(ctx):
+    ctx['caltables'] = initial_calibration(ctx['msfile'], REFANT, ctx['flagspw'], [CALIBRATOR],
+                                           [CALIBRATOR], [])
+
+
+def bench_gain_calibration_batch(ctx):
+    gain_calibration_batch(ctx['msfile'], list(DEFAULT_FIELDS), REFANT, ctx['flagspw'], '', '')
+
+
+def bench_fluxscale(ctx):
+    msfile = ctx['msfile']
+    cts.fluxscale(vis=msfile, caltable=f"{msfile}.AP.G", fluxtable=f"{msfile}.fluxscale",
+                  reference=CALIBRATOR, incremental=False)
+
+
+def bench_apply_calibration_batch(ctx):
+    msfile = ctx['msfile']
+    gntable, _, bptable = ctx['caltables']
+    apply_calibration_batch(msfile, list(DEFAULT_FIELDS),
+                            [gntable, bptable, f"{msfile}.fluxscale"])
+
+
+def bench_flagsummary(ctx):
+    flagsummary(ctx['msfile'])
+
+
+def bench_clip_flagging(ctx):
+    flagbatch = FlagBatch(ctx['msfile'])
+    flagbatch.add(mode='clip', datacolumn='corrected', clipminmax=[0, 50])
+    flagbatch.apply(summary=True)
+
+
+def bench_split_target(ctx):
+    cts.mstransform(vis=ctx['msfile'], outputvis=ctx['splitfile'], field=TARGET,
+                    datacolumn='corrected', keepflags=False)
+
+
+def bench_average(ctx):
+    cts.mstransform(vis=ctx['splitfile'], outputvis=ctx['avgfile'], chanaverage=True,
+                    chanbin=ctx['chanavg'], datacolumn='data')
+
+
+def bench_make_dirty_image(ctx):
+    make_dirty_image(ctx['avgfile'], cell=ctx['cell'], imsize=ctx['imsize'])
+
+
+def bench_clean_image(ctx):
+    clean_image(ctx['avgfile'], niter=ctx['niter'], threshold='1mJy', cell=ctx['cell'],
+                imsize=ctx['imsize'])
+
+
+# (group, name, function) in pipeline order, later benchmarks use the products of earlier ones
+BENCHMARKS = [
+    ('casa_tools', 'getfields', bench_getfields),
+    ('casa_tools', 'getnchan', bench_getnchan),
+    ('casa_tools', 'getbandcut', bench_getbandcut),
+    ('casa_tools', 'vislistobs', bench_vislistobs),
+    ('flagging', 'initial_flagging', bench_initial_flagging),
+    ('flagging', 'find_bad_antennas', bench_find_bad_antennas),
+    ('flagging', 'find_bad_channels', bench_find_bad_channels),
+    ('calibration', 'initial_calibration', bench_initial_calibration),
+    ('calibration', 'gain_calibration_batch', bench_gain_calibration_batch),
+    ('calibration', 'fluxscale', bench_fluxscale),
+    ('calibration', 'apply_calibration_batch', bench_apply_calibration_batch),
+    ('casa_tools', 'flagsummary', bench_flagsummary),
+    ('flagging', 'clip_flagging', bench_clip_flagging),
+    ('split', 'split_target', bench_split_target),
+    ('split', 'average', bench_average),
+    ('imaging', 'make_dirty_image', bench_make_dirty_image),
+    ('imaging', 'clean_image', bench_clean_image),
+]
+
+
+def selected(only):
+    """Get the benchmarks whose group or name is in `only` (all if empty)."""
+    if not only:
+        return BENCHMARKS
+    chosen = [b for b in BENCHMARKS if b[0] in only or b[1] in only]
+    if not chosen:
+        raise ValueError(f"No benchmarks match {only}")
+    return chosen
+
+
+def git_commit():
+    """Get the current commit of the repository (with '-dirty' if there are changes)."""
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               cwd=repo, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f"{commit}-dirty" if dirty else commit
+
+
+def machine_info():
+    """Describe the machine the benchmarks run on."""
+    try:
+        memory_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**3
+    except (ValueError, OSError):
+        memory_gb = None
+    return {'host': platform.node(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'memory_gb': memory_gb, 'python': platform.python_version(),
+            'casatasks': cts.version_string()}
+
+
+def dir_size(path):
+    """Get the total size of the files in a directory, in bytes."""
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+def run_size(size, benchmarks, repeat, imaging, workdir, profiler):
+    """Run the benchmarks on a synthetic MS of the given size, keeping the best of `repeat` runs.
+
+    Args:
+        size: Dictionary with the nant, nchan, inttime and nscans of the MS
+        imaging: Dictionary with the chanavg, cell, imsize and niter of the imaging steps
+
+    Returns:
+        Dictionary with the size, the MS size in MB and the results of every benchmark.
+    """
+    label = '_'.join(f"{key}{value:g}" for key, value in size.items())
+    template = make_synthetic_ms(os.path.join(workdir, f"template_{label}.ms"), sources=True,
+                                 **size)
+    results = {**size, 'ms_size_mb': dir_size(template) / 1024**2, 'benchmarks': {}}
+
+    for run in range(repeat):
+        msfile = os.path.join(workdir, f"{label}.ms")
+        for path in os.listdir(workdir):
+            if path.startswith(label):
+                shutil.rmtree(os.path.join(workdir, path), ignore_errors=True)
+        shutil.copytree(template, msfile)
+        clear_metadata_cache()
+        ctx = {'msfile': msfile, 'flagspw': f"0:1~{size['nchan'] - 1}",
+               'splitfile': f"{msfile}.split.ms", 'avgfile': f"{msfile}.split.avg.ms",
+               'caltables': (f"{msfile}.K1", f"{msfile}.AP.G0", f"{msfile}.B1"), **imaging}
+
+        for group, name, function in benchmarks:
+            first = len(profiler.records)
+            with profiler.measure('step', name) as record:
+                function(ctx)
+            tasks = {}
+            for task in profiler.records[first:]:
+                if task['kind'] == 'task':
+                    tasks[task['name']] = tasks.get(task['name'], 0.0) + task['wall_s']
+            record = {'group': group, **{key: record[key] for key in
+                                         ('wall_s', 'cpu_s', 'peak_rss_mb', 'read_mb',
+                                          'write_mb')}, 'tasks': tasks}
+            best = results['benchmarks'].get(name)
+            if best is None or record['wall_s'] < best['wall_s']:
+                results['benchmarks'][name] = record
+            print(f"[{label} run {run + 1}/{repeat}] {name}: {record['wall_s']:.2f} s", flush=True)
+    return results
+
+
+def load_results(reference, results_dir):
+    """Load stored results given a file or the (abbreviated) commit they were run at."""
+    if os.path.isfile(reference):
+        path = reference
+    else:
+        commit = subprocess.run(['git', 'rev-parse', reference], capture_output=True, text=True,
+                                cwd=os.path.dirname(results_dir)).stdout.strip() or reference
+        matches = sorted(f for f in os.listdir(results_dir) if f.startswith(commit)) \
+            if os.path.isdir(results_dir) else []
+        if not matches:
+            raise FileNotFoundError(f"No stored results for {reference} in {results_dir}")
+        path = os.path.join(results_dir, matches[0])
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(reference, current):
+    """Print the wall time of every benchmark against the reference results."""
+    print(f"\n{'benchmark':<26}{'size':>22}{'ref (s)':>10}{'now (s)':>10}{'ratio':>8}")
+    sizekeys = ('nant', 'nchan', 'inttime', 'nscans')
+    for size in current['results']:
+        key = tuple(size[k] for k in sizekeys)
+        ref = next((r for r in reference['results'] if tuple(r[k] for k in sizekeys) == key),
+                   None)
+        if ref is None:
+            continue
+        label = f"{size['nant']}ant {size['nchan']}ch {size['nscans']}sc"
+        for name, bench in size['benchmarks'].items():
+            if name in ref['benchmarks']:
+                before = ref['benchmarks'][name]['wall_s']
+                print(f"{name:<26}{label:>22}{before:>10.2f}{bench['wall_s']:>10.2f}"
+                      f"{bench['wall_s'] / before if before > 0 else float('nan'):>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--nant', type=int, nargs='+', default=[30], help='Numbers of antennas')
+    parser.add_argument('--nchan', type=int, nargs='+', default=[2048, 4096],
+                        help='Numbers of channels')
+    parser.add_argument('--inttime', type=float, nargs='+', default=[16.0],
+                        help='Integration times (s)')
+    parser.add_argument('--nscans', type=int, nargs='+', default=[6], help='Numbers of scans')
+    parser.add_argument('--only', type=str, nargs='+', default=[],
+                        help='Only run these benchmarks or groups ('
+                             f"{', '.join(sorted(set(b[0] for b in BENCHMARKS)))})")
+    parser.add_argument('--repeat', type=int, default=1, help='Repetitions (best time is kept)')
+    parser.add_argument('--chanavg', type=int, default=8, help='Channels averaged before imaging')
+    parser.add_argument('--cell', type=str, default='2arcsec', help='Image cell size')
+    parser.add_argument('--imsize', type=int, default=512, help='Image size (pixels)')
+    parser.add_argument('--niter', type=int, default=200, help='Clean iterations')
+    parser.add_argument('--workdir', type=str, default='.',
+                        help='Directory for the temporary MSs')
+    parser.add_argument('--results-dir', type=str, default=RESULTS_DIR,
+                        help='Directory where the results are stored per commit')
+    parser.add_argument('--compare', type=str, default=None, metavar='COMMIT',
+                        help='Compare with the stored results of this commit (or JSON file)')
+    args = parser.parse_args()
+
+    benchmarks = selected(args.only)
+    imaging = {'chanavg': args.chanavg, 'cell': args.cell, 'imsize': args.imsize,
+               'niter': args.niter}
+    profiler = Profiler()
+    profiler.instrument_casatasks()
+    results = {'commit': git_commit(), 'date': datetime.now().isoformat(),
+               'machine': machine_info(), 'imaging': imaging, 'results': []}
+
+    with tempfile.TemporaryDirectory(dir=os.path.abspath(args.workdir)) as workdir:
+        cwd = os.getcwd()
+        # Images and CASA logs are written to the current directory
+        os.chdir(workdir)
+        try:
+            for nant in args.nant:
+                for nchan in args.nchan:
+                    for inttime in args.inttime:
+                        for nscans in args.nscans:
+                            size = {'nant': nant, 'nchan': nchan, 'inttime': inttime,
+                                    'nscans': nscans}
+                            results['results'].append(run_size(size, benchmarks, args.repeat,
+                                                               imaging, workdir, profiler))
+        finally:
+            os.chdir(cwd)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    output = os.path.join(args.results_dir, f"{results['commit']}.json")
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(load_results(args.compare, args.results_dir), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Synthetic uGMRT-like Measurement Sets for the CAPTURE benchmarks.
+
+The data are simulated with `casatools.simulator`, so they can be generated
+offline on any machine with CASA installed. The visibilities are noise only, or
+a point source at the centre of each field plus noise, so that the calibration
+and imaging steps have something to solve for.
+"""
+
+import os
+import shutil
+import argparse
+import numpy as np
+import casatools
+
+
+# Standard flux calibrator plus two targets, observed in turns
+DEFAULT_FIELDS = {
+    '3C286': ('13h31m08.288', '30d30m32.96'),
+    'TARGET1': ('12h00m00.000', '20d00m00.00'),
+    'TARGET2': ('12h30m00.000', '25d00m00.00'),
+}
+
+# Point sources at the field centres for `make_synthetic_ms(sources=True)`: flux (Jy) at
+# 550 MHz and spectral index
+DEFAULT_SOURCES = {
+    '3C286': (20.0, -0.8),
+    'TARGET1': (0.1, -0.7),
+    'TARGET2': (0.05, -0.7),
+}
+
+
+def gmrt_like_layout(nant=30, seed=1):
+    """Get local (x, y) antenna positions (m) and names resembling the GMRT Y-shaped array.
+
+    Roughly half of the antennas are randomly placed in a ~1 km central square (C)
+    and the rest along the East, South and West arms out to ~14 km.
+    """
+    rng = np.random.default_rng(seed)
+    ncentral = max(1, nant // 2)
+    x = list(rng.uniform(-500, 500, ncentral))
+    y = list(rng.uniform(-500, 500, ncentral))
+    names = [f"C{i:02d}" for i in range(ncentral)]
+    arms = {'E': 10.0, 'S': 250.0, 'W': 130.0}
+    narm = nant - ncentral
+    for i in range(narm):
+        arm = 'ESW'[i % 3]
+        dist = 1500.0 + 12500.0 * (i // 3 + 1) / (narm // 3 + 1)
+        angle = np.radians(arms[arm]) + rng.normal(0, 0.02)
+        x.append(dist * np.cos(angle))
+        y.append(dist * np.sin(angle))
+        names.append(f"{arm}{i // 3 + 1:02d}")
+    return np.asarray(x), np.asarray(y), names
+
+
+def make_synthetic_ms(msname, nant=30, nchan=2048, inttime=16.0, nscans=6, scanlength=120.0,
+                      freq='550MHz', bandwidth=200e6, noise='1Jy', sources=None,
+                      overwrite=False):
+    """Simulate a uGMRT-like MS with RR/LL correlations.
+
+    Args:
+        msname: Output MS name
+        nant: Number of antennas
+        nchan: Number of channels of the single spectral window
+        inttime: Integration time in seconds
+        nscans: Number of scans, cycling over `DEFAULT_FIELDS`
+        scanlength: Length of each scan in seconds
+        freq: Frequency of the first channel
+        bandwidth: Total bandwidth in Hz
+        noise: Simple noise per visibility
+        sources: Point sources to predict (attenuated by the primary beam) before adding
+                 the noise, as {field: (flux_jy, spectral_index)}; True for
+                 `DEFAULT_SOURCES`, None for noise-only visibilities
+        overwrite: Remove `msname` first if it exists
+
+    Returns:
+        The MS name.
+    """
+    if os.path.exists(msname):
+        if not overwrite:
+            return msname
+        shutil.rmtree(msname)
+
+    me = casatools.measures()
+    sm = casatools.simulator()
+    x, y, names = gmrt_like_layout(nant)
+    sm.open(msname)
+    sm.setconfig(telescopename='GMRT', x=x, y=y, z=np.zeros(nant), dishdiameter=[45.0] * nant,
+                 mount=['alt-az'], antname=names, padname=names, coordsystem='local',
+                 referencelocation=me.observatory('GMRT'))
+    chanwidth = f"{bandwidth / nchan}Hz"
+    sm.setspwindow(spwname='GWB', freq=freq, deltafreq=chanwidth, freqresolution=chanwidth,
+                   nchannels=nchan, stokes='RR LL')
+    sm.setfeed('perfect R L')
+    for name, (ra, dec) in DEFAULT_FIELDS.items():
+        sm.setfield(sourcename=name, sourcedirection=me.direction('J2000', ra, dec))
+    sm.setlimits(shadowlimit=0.001, elevationlimit='8.0deg')
+    sm.setauto(autocorrwt=0.0)
+    sm.settimes(integrationtime=f"{inttime}s", usehourangle=True,
+                referencetime=me.epoch('utc', '2024/01/01/00:00:00'))
+    fields = list(DEFAULT_FIELDS)
+    start = -nscans * (scanlength + 30.0) / 2
+    for i in range(nscans):
+        sm.observe(fields[i % len(fields)], 'GWB', starttime=f"{start}s",
+                   stoptime=f"{start + scanlength}s")
+        start += scanlength + 30.0
+    if sources:
+        sources = DEFAULT_SOURCES if sources is True else sources
+        cl = casatools.componentlist()
+        for name, (flux, index) in sources.items():
+            cl.addcomponent(flux=flux, fluxunit='Jy', shape='point', freq=freq,
+                            dir=me.direction('J2000', *DEFAULT_FIELDS[name]),
+                            spectrumtype='spectral index', index=index)
+        cl.rename(f"{msname}.cl")
+        cl.close()
+        sm.setvp(dovp=True, usedefaultvp=True)
+        sm.predict(complist=f"{msname}.cl")
+        shutil.rmtree(f"{msname}.cl", ignore_errors=True)
+    sm.setnoise(mode='simplenoise', simplenoise=noise)
+    sm.corrupt()
+    sm.close()
+    sm.done()
+    return msname
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create a synthetic uGMRT-like MS',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('msname', type=str, help='Output MS name')
+    parser.add_argument('--nant', type=int, default=30, help='Number of antennas')
+    parser.add_argument('--nchan', type=int, default=2048, help='Number of channels')
+    parser.add_argument('--inttime', type=float, default=16.0, help='Integration time (s)')
+    parser.add_argument('--nscans', type=int, default=6, help='Number of scans')
+    parser.add_argument('--scanlength', type=float, default=120.0, help='Scan length (s)')
+    parser.add_argument('--sources', action='store_true',
+                        help='Add a point source at the centre of each field')
+    parser.add_argument('--overwrite', action='store_true', help='Overwrite an existing MS')
+    args = parser.parse_args()
+    make_synthetic_ms(args.msname, nant=args.nant, nchan=args.nchan, inttime=args.inttime,
+                      nscans=args.nscans, scanlength=args.scanlength, sources=args.sources or None,
+                      overwrite=args.overwrite)
+
+
+if __name__ == '__main__':
+    main()
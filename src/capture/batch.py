@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""Batch entry point: reduce many observations on the same node.
+
+Each observation (a configuration file, or a working directory containing one) is a
+full pipeline run in its own process (`capture.main` with `--working-dir`). The runs
+are scheduled so that the sum of their CPU and memory budgets fits in the node:
+a run starts as soon as there is room for it, and smaller runs later in the list
+fill the gaps left by large ones. The budget of a run comes from the `[batch]`
+section of its configuration, or is estimated from its imaging and parallel
+settings. The status of every run is kept up to date in a shared JSON summary.
+
+Usage:
+    gmrtbatch obs1/ obs2/ obs3/config_capture.toml --status batch_status.json
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tomllib
+import subprocess
+from datetime import datetime
+
+from .core.resources import tclean_memory_gb
+
+
+CONFIG_NAME = 'config_capture.toml'
+
+# Memory of a pipeline run without imaging (CASA, flagging, calibration), in GB
+BASE_MEMORY_GB = 2.0
+
+# Image size assumed for the estimate when it is derived from the data ("auto")
+AUTO_IMAGE_SIZE = 8192
+
+
+def estimate_budget(config, node_cpus=None) -> tuple:
+    """Get the CPUs and memory (GB) a pipeline run needs from its configuration.
+
+    `[batch] cpus`/`memory_gb` take precedence. Otherwise a run uses one CPU, or
+    `[parallel] workers` if it starts worker processes (partitioned mode, subband
+    self-calibration or the solint search), and the memory of the largest of its
+    stages: imaging (the tclean estimate of `resources.tclean_memory_gb`, with the
+    multiscale scales if it cleans), or the workers at `worker_memory_gb` each.
+    """
+    batch = config.get('batch', {})
+    imaging = config.get('imaging', {})
+    parallel = config.get('parallel', {})
+    node_cpus = node_cpus or os.cpu_count() or 1
+
+    workers = parallel.get('workers', 4)
+    forks = parallel.get('partitioned', False) or imaging.get('do_subband_selfcal', False) \
+        or imaging.get('scal_solint_search', False)
+    cpus = batch.get('cpus') or (min(workers, node_cpus) if forks else 1)
+
+    memory = batch.get('memory_gb')
+    if not memory:
+        imsize = imaging.get('image_size', AUTO_IMAGE_SIZE)
+        imsize = AUTO_IMAGE_SIZE if imsize == 'auto' else int(imsize)
+        wprojplanes = imaging.get('nwproj_pl', 1)
+        wprojplanes = 128 if wprojplanes == 'auto' else int(wprojplanes)
+        nscales = 3 if imaging.get('do_selfcal', False) else 0
+        image = tclean_memory_gb(imsize, imaging.get('use_nterms', 1), wprojplanes,
+                                 nscales=nscales) \
+            if imaging.get('make_dirty', False) or imaging.get('do_selfcal', False) else 0.0
+        if imaging.get('do_subband_selfcal', False):
+            # Every subband worker images at the same time
+            image *= cpus
+        worker_memory = parallel.get('worker_memory_gb') or BASE_MEMORY_GB
+        memory = max(BASE_MEMORY_GB, image, cpus * worker_memory if forks else 0.0)
+    return int(cpus), float(memory)
+
+
+def node_memory_gb() -> float:
+    """Get the physical memory of the node in GB."""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**3
+
+
+class BatchJob:
+    """A pipeline run of the batch, with its budget and status."""
+
+    def __init__(self, target, config_name=CONFIG_NAME):
+        """Initialize the job from a configuration file or a working directory."""
+        target = os.path.abspath(target)
+        if os.path.isdir(target):
+            self.workdir, self.config = target, os.path.join(target, config_name)
+        else:
+            self.workdir, self.config = os.path.dirname(target), target
+        self.name = os.path.relpath(self.config)
+        self.status = 'pending'
+        self.cpus, self.memory_gb = 1, BASE_MEMORY_GB
+        self.error = None
+        self.pid = self.returncode = None
+        self.start = self.end = None
+        self.peak_rss_gb = None
+        self.process = None
+
+    @property
+    def logfile(self) -> str:
+        """File with the console output of the run."""
+        return os.path.join(self.workdir, 'capture_batch.log')
+
+    def load(self, node_cpus):
+        """Read the configuration and estimate the budget (False if it cannot be read)."""
+        try:
+            with open(self.config, 'rb') as f:
+                config = tomllib.load(f)
+        except (OSError, tomllib.TOMLDecodeError) as e:
+            self.status, self.error = 'failed', f"cannot read {self.config}: {e}"
+            return False
+        self.cpus, self.memory_gb = estimate_budget(config, node_cpus)
+        return True
+
+    def summary(self) -> dict:
+        """Status of the job for the shared summary."""
+        wall = (self.end or time.time()) - self.start if self.start else None
+        return {'name': self.name, 'config': self.config, 'workdir': self.workdir,
+                'status': self.status, 'cpus': self.cpus, 'memory_gb': self.memory_gb,
+                'pid': self.pid, 'returncode': self.returncode, 'error': self.error,
+                'start': datetime.fromtimestamp(self.start).isoformat() if self.start else None,
+                'wall_s': wall, 'peak_rss_gb': self.peak_rss_gb, 'log': self.logfile}
+
+
+def _limit_memory(memory_bytes):
+    """Cap the data segment of a run (called in the child before exec)."""
+    resource.setrlimit(resource.RLIMIT_DATA, (memory_bytes, memory_bytes))
+
+
+class BatchScheduler:
+    """Runs pipeline jobs as local processes within the CPU and memory of the node."""
+
+    def __init__(self, jobs, cpus=None, memory_gb=None, status_file='batch_status.json',
+                 hard_limit=False, poll=5.0, extra_args=()):
+        """Initialize the scheduler.
+
+        Args:
+            jobs: `BatchJob`s to run, in order of priority
+            cpus: CPUs the jobs can use in total (all of the node by default)
+            memory_gb: Memory the jobs can use in total (90% of the node by default)
+            status_file: Shared JSON summary, rewritten whenever a job changes status
+            hard_limit: Also cap the memory of each run to its budget (RLIMIT_DATA)
+            poll: Seconds between checks of the running jobs
+            extra_args: Additional arguments for `capture.main` (e.g. ['--debug'])
+        """
+        self.jobs = jobs
+        self.cpus = cpus or os.cpu_count() or 1
+        self.memory_gb = memory_gb or 0.9 * node_memory_gb()
+        self.status_file = status_file
+        self.hard_limit = hard_limit
+        self.poll = poll
+        self.extra_args = list(extra_args)
+
+    def free(self) -> tuple:
+        """Get the CPUs and memory (GB) not reserved by the running jobs."""
+        running = [job for job in self.jobs if job.status == 'running']
+        return (self.cpus - sum(job.cpus for job in running),
+                self.memory_gb - sum(job.memory_gb for job in running))
+
+    def write_status(self):
+        """Rewrite the shared summary atomically."""
+        counts = {}
+        for job in self.jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        tmp = f"{self.status_file}.tmp{os.getpid()}"
+        with open(tmp, 'w') as f:
+            json.dump({'updated': datetime.now().isoformat(), 'cpus': self.cpus,
+                       'memory_gb': self.memory_gb, 'counts': counts,
+                       'jobs': [job.summary() for job in self.jobs]}, f, indent=2)
+        os.replace(tmp, self.status_file)
+
+    def launch(self, job):
+        """Start the pipeline run of a job, with its thread count set to its CPUs."""
+        env = dict(os.environ)
+        for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+            env[var] = str(job.cpus)
+        command = [sys.executable, '-m', 'capture.main', job.config, '--working-dir',
+                   job.workdir] + self.extra_args
+        limit = int(job.memory_gb * 1024**3) if self.hard_limit else None
+        with open(job.logfile, 'ab') as log:
+            job.process = subprocess.Popen(command, cwd=job.workdir, env=env, stdout=log,
+                                           stderr=subprocess.STDOUT,
+                                           stdin=subprocess.DEVNULL,
+                                           preexec_fn=(lambda: _limit_memory(limit))
+                                           if limit else None)
+        job.pid, job.status, job.start = job.process.pid, 'running', time.time()
+        free_cpus, free_memory = self.free()
+        logging.info(f"Started {job.name} (pid {job.pid}, {job.cpus} CPUs, "
+                     f"{job.memory_gb:.1f} GB); free: {free_cpus} CPUs, {free_memory:.1f} GB")
+
+    def reap(self) -> bool:
+        """Collect the jobs that finished. Returns whether any did."""
+        finished = False
+        for job in self.jobs:
+            if job.status != 'running':
+                continue
+            pid, status, usage = os.wait4(job.pid, os.WNOHANG)
+            if pid == 0:
+                continue
+            job.process.returncode = job.returncode = os.waitstatus_to_exitcode(status)
+            job.end = time.time()
+            job.peak_rss_gb = usage.ru_maxrss / 1024**2
+            job.status = 'done' if job.returncode == 0 else 'failed'
+            if job.returncode != 0:
+                job.error = f"exited with code {job.returncode}, see {job.logfile}"
+            logging.info(f"{job.name} {job.status} after {job.end - job.start:.0f} s, peak "
+                         f"{job.peak_rss_gb:.1f} GB of {job.memory_gb:.1f} GB budgeted")
+            finished = True
+        return finished
+
+    def next_jobs(self) -> list:
+        """Get the pending jobs that fit in the free resources, in order of priority.
+
+        A job larger than the whole node runs alone once nothing else is running.
+        """
+        free_cpus, free_memory = self.free()
+        idle = all(job.status != 'running' for job in self.jobs)
+        selected = []
+        for job in self.jobs:
+            if job.status != 'pending':
+                continue
+            fits = job.cpus <= free_cpus and job.memory_gb <= free_memory
+            oversized = job.cpus > self.cpus or job.memory_gb > self.memory_gb
+            if fits or (oversized and idle and not selected):
+                if oversized:
+                    logging.warning(f"{job.name} needs {job.cpus} CPUs and {job.memory_gb:.1f} "
+                                    f"GB, more than the node: running it alone")
+                selected.append(job)
+                free_cpus -= job.cpus
+                free_memory -= job.memory_gb
+                if oversized:
+                    break
+        return selected
+
+    def run(self) -> list:
+        """Run all the jobs. Returns the jobs with their final status."""
+        for job in self.jobs:
+            if job.status == 'pending':
+                job.load(self.cpus)
+        logging.info(f"Batch of {len(self.jobs)} runs on {self.cpus} CPUs and "
+                     f"{self.memory_gb:.1f} GB")
+        self.write_status()
+        while any(job.status in ('pending', 'running') for job in self.jobs):
+            started = self.next_jobs()
+            for job in started:
+                try:
+                    self.launch(job)
+                except OSError as e:
+                    job.status, job.error = 'failed', str(e)
+                    logging.error(f"Cannot start {job.name}: {e}")
+            if self.reap() or started:
+                self.write_status()
+            else:
+                time.sleep(self.poll)
+        self.write_status()
+        return self.jobs
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Run the CAPTURE pipeline on many observations on this node',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('targets', type=str, nargs='+',
+                        help='Configuration files, or working directories with one')
+    parser.add_argument('--config-name', type=str, default=CONFIG_NAME,
+                        help='Name of the configuration file inside working directories')
+    parser.add_argument('--cpus', type=int, default=None,
+                        help='CPUs to use in total (all of the node by default)')
+    parser.add_argument('--memory-gb', type=float, default=None,
+                        help='Memory to use in total (90%% of the node by default)')
+    parser.add_argument('--hard-limit', action='store_true',
+                        help='Also cap the memory of each run to its budget')
+    parser.add_argument('--status', type=str, default='batch_status.json',
+                        help='Shared JSON summary with the status of every run')
+    parser.add_argument('--poll', type=float, default=5.0,
+                        help='Seconds between checks of the running pipelines')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    jobs = [BatchJob(target, args.config_name) for target in args.targets]
+    scheduler = BatchScheduler(jobs, cpus=args.cpus, memory_gb=args.memory_gb,
+                               status_file=os.path.abspath(args.status),
+                               hard_limit=args.hard_limit, poll=args.poll,
+                               extra_args=['--debug'] if args.debug else [])
+    jobs = scheduler.run()
+    for job in jobs:
+        logging.info(f"{job.name}: {job.status}" + (f" ({job.error})" if job.error else ''))
+    sys.exit(0 if all(job.status == 'done' for job in jobs) else 1)
+
+
+if __name__ == '__main__':
+    main()
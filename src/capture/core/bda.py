@@ -0,0 +1,150 @@
+"""Baseline-dependent time averaging for CAPTURE pipeline.
+
+The short central-square baselines of the GMRT move through the uv-plane much
+more slowly than the long arm baselines, so with a single integration time they
+are heavily oversampled. The averaging interval of each baseline is chosen here
+from the rate at which it moves (from the UVW column) and a tolerance for the
+time-smearing amplitude loss at the edge of the imaged field. The averaging
+itself is done by mstransform, which closes the time bin of a baseline when it
+has moved by more than `maxuvwdistance`.
+
+Used on the averaged target MS before imaging when `bda_tolerance` is set.
+"""
+
+import math
+import logging
+import numpy as np
+
+from .planner import SPEED_OF_LIGHT, resolve_geometry, parse_angle
+from ..utils.lazy import casatasks as cts
+from ..utils.casa_tools import iter_ms_chunks, casatable, CHUNK_BYTES
+from ..utils.ms_metadata import get_metadata
+
+
+def smearing_loss(duv_lambda, radius_rad):
+    """Get the amplitude loss of a point source at `radius_rad` from the phase centre
+    when the visibilities averaged together span `duv_lambda` wavelengths."""
+    return 1.0 - np.sinc(np.asarray(duv_lambda) * radius_rad)
+
+
+def max_uv_span(tolerance, radius_rad, freq):
+    """Get the largest uv-distance (m) an average can span for a smearing loss of at
+    most `tolerance` at `radius_rad` and frequency `freq` (1 - sinc(x) ~ x^2 / 6)."""
+    return math.sqrt(6 * tolerance) / (math.pi * radius_rad) * SPEED_OF_LIGHT / freq
+
+
+def baseline_uv_rates(msfile, chunk_rows=None) -> dict:
+    """Get the rows, length (m) and largest uv-rate (m/s) of each baseline of an MS.
+
+    UVW, TIME and INTERVAL are read in bounded chunks of rows; within a chunk the rows
+    are sorted by baseline and time, and the rate is taken between consecutive
+    integrations of the same baseline (not across scan gaps).
+
+    Returns:
+        Dictionary with the 'antenna1', 'antenna2', 'rows', 'length' and 'rate' arrays
+        (one entry per baseline) and the integration time 'inttime' (s).
+    """
+    chunk_rows = chunk_rows or CHUNK_BYTES // 48
+    stats = {}
+    intervals = []
+    for chunk in iter_ms_chunks(msfile, ['UVW', 'TIME', 'INTERVAL', 'ANTENNA1', 'ANTENNA2',
+                                         'FLAG_ROW'], chunk_rows=chunk_rows):
+        keep = ~chunk['FLAG_ROW']
+        if not keep.any():
+            continue
+        uv = chunk['UVW'][:2, keep]
+        time, interval = chunk['TIME'][keep], chunk['INTERVAL'][keep]
+        baseline = chunk['ANTENNA1'][keep].astype(np.int64) << 16 | chunk['ANTENNA2'][keep]
+        intervals.append(np.median(interval))
+
+        order = np.lexsort((time, baseline))
+        baseline, time, interval, uv = baseline[order], time[order], interval[order], uv[:, order]
+        dt = np.diff(time)
+        pairs = (baseline[1:] == baseline[:-1]) & (dt > 0) & (dt <= 1.5 * interval[1:])
+        rate = np.hypot(*np.diff(uv, axis=1)) / np.where(pairs, dt, 1.0)
+
+        keys, index, rows = np.unique(baseline, return_inverse=True, return_counts=True)
+        maxrate = np.zeros(len(keys))
+        np.maximum.at(maxrate, index[1:][pairs], rate[pairs])
+        length = np.zeros(len(keys))
+        np.maximum.at(length, index, np.hypot(*uv))
+        for key, nrow, brate, blength in zip(keys.tolist(), rows, maxrate, length):
+            previous = stats.get(key, (0, 0.0, 0.0))
+            stats[key] = (previous[0] + int(nrow), max(previous[1], brate),
+                          max(previous[2], blength))
+
+    keys = np.array(sorted(stats), dtype=np.int64)
+    values = np.array([stats[key] for key in keys.tolist()]).reshape(-1, 3)
+    return {'antenna1': keys >> 16, 'antenna2': keys & 0xFFFF,
+            'rows': values[:, 0].astype(np.int64), 'rate': values[:, 1],
+            'length': values[:, 2], 'inttime': float(np.median(intervals)) if intervals else 0.0}
+
+
+def plan_bda(msfile, tolerance, radius_rad, max_interval=120.0) -> dict:
+    """Choose the averaging interval of each baseline for a time-smearing tolerance.
+
+    Args:
+        msfile: Measurement Set to average
+        tolerance: Largest amplitude loss (fraction) of a source at the field edge
+        radius_rad: Radius of the imaged field (rad)
+        max_interval: Longest averaging interval (s)
+
+    Returns:
+        Dictionary with the uv-span limit 'maxuvwdistance' (m), the per-baseline
+        'intervals' (s, whole integrations), the 'timebin' for mstransform, the
+        predicted output rows and compression, the largest predicted smearing loss and
+        the per-baseline statistics of `baseline_uv_rates`.
+    """
+    fmax = float(get_metadata(msfile).chan_freqs(0).max())
+    span = max_uv_span(tolerance, radius_rad, fmax)
+    baselines = baseline_uv_rates(msfile)
+    inttime = baselines['inttime']
+    rate = baselines['rate']
+
+    # Whole integrations per bin, between one and max_interval
+    with np.errstate(divide='ignore'):
+        nint = np.floor(np.where(rate > 0, span / rate, np.inf) / inttime)
+    nint = np.clip(nint, 1, max(1, math.floor(max_interval / inttime)))
+    intervals = nint * inttime
+    rows_out = int(np.ceil(baselines['rows'] / nint).sum())
+    rows_in = int(baselines['rows'].sum())
+    loss = smearing_loss(rate * intervals * fmax / SPEED_OF_LIGHT, radius_rad)
+    return {'maxuvwdistance': span, 'intervals': intervals,
+            'timebin': f"{float(intervals.max()) if intervals.size else inttime:g}s",
+            'rows_in': rows_in, 'rows_out': rows_out,
+            'compression': rows_in / rows_out if rows_out else 1.0,
+            'max_loss': float(loss.max()) if loss.size else 0.0, **baselines}
+
+
+def field_radius(msfile, cell, imsize, plan=None) -> float:
+    """Get the radius (rad) of the field imaged with the given (or "auto") settings."""
+    cell, imsize, _ = resolve_geometry(msfile, cell, imsize, 1, plan=plan)
+    return int(imsize) * parse_angle(cell) / 2
+
+
+def bda_average(msfile, outputvis, tolerance, radius_rad, max_interval=120.0) -> dict:
+    """Average an MS in time with baseline-dependent intervals (see `plan_bda`).
+
+    Returns:
+        The plan, with the achieved output rows and compression ratio.
+    """
+    plan = plan_bda(msfile, tolerance, radius_rad, max_interval)
+    intervals = plan['intervals']
+    logging.info(f"Baseline-dependent averaging of {msfile}: smearing loss <= {tolerance:g} "
+                 f"at {math.degrees(radius_rad) * 60:.1f} arcmin, uv-span <= "
+                 f"{plan['maxuvwdistance']:.1f} m, intervals {intervals.min():g}s "
+                 f"(longest baseline) to {intervals.max():g}s, "
+                 f"predicted compression {plan['compression']:.2f}x")
+
+    cts.mstransform(vis=msfile, outputvis=outputvis, datacolumn='data', keepflags=False,
+                    timeaverage=True, timebin=plan['timebin'],
+                    maxuvwdistance=plan['maxuvwdistance'])
+
+    with casatable(outputvis) as tb:
+        rows_out = tb.nrows()
+    plan['rows_out'] = rows_out
+    plan['compression'] = plan['rows_in'] / rows_out if rows_out else 1.0
+    logging.info(f"Averaged {msfile} into {outputvis}: {plan['rows_in']} -> {rows_out} rows, "
+                 f"compression {plan['compression']:.2f}x, largest predicted smearing loss "
+                 f"{plan['max_loss']:.4f}")
+    return plan
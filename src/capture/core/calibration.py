@@ -1,22 +1,35 @@
 """Calibration functions for CAPTURE pipeline."""
 
+import os
 import logging
-import casatasks as cts
+import numpy as np
+from ..utils.lazy import casatasks as cts
+from ..utils.task_cache import Deferred, call_cached
+from .resources import governor
+
+# In-place calls that set up the model of each MS in `initial_calibration`, run before
+# the first calibration solve on the MS that is not in the task cache
+_model_setup = {}
 
 def initial_calibration(msfile, ref_ant, flagspw, myampcals, mybpcals, mypcals, mycalsuffix=''):
-    """Perform initial calibration steps."""
+    """Perform initial calibration steps.
+
+    The solves go through the task cache (see `capture.utils.task_cache`): clearcal and
+    setjy only run if one of them has to be redone.
+    """
     logging.info("Starting initial calibration")
     
-    # Clear calibration
-    cts.clearcal(vis=msfile)
-    
-    # Set flux density scale
-    for ampcal in myampcals:
-        cts.setjy(vis=msfile, spw=flagspw, field=ampcal)
+    # Clear calibration and set flux density scale
+    model = Deferred(('clearcal', {'vis': msfile}),
+                     *(('setjy', {'vis': msfile, 'spw': flagspw, 'field': ampcal})
+                       for ampcal in myampcals))
+    _model_setup[os.path.abspath(msfile)] = model
         
     # Delay calibration using first flux calibrator
     gntable = f"{msfile}.K1{mycalsuffix}"
-    cts.gaincal(
+    governor().predict_solve('gaincal', msfile, myampcals[0], '60s')
+    call_cached(
+        'gaincal', [gntable], deferred=model,
         vis=msfile, caltable=gntable, spw=flagspw, field=myampcals[0],
         solint='60s', refant=ref_ant, solnorm=True, gaintype='K',
         gaintable=[], parang=True
@@ -24,7 +37,9 @@ def initial_calibration(msfile, ref_ant, flagspw, myampcals, mybpcals, mypcals,
     
     # Initial bandpass calibration
     aptable = f"{msfile}.AP.G0{mycalsuffix}"
-    cts.gaincal(
+    governor().predict_solve('gaincal', msfile, ','.join(mybpcals), 'int')
+    call_cached(
+        'gaincal', [aptable], tables=[gntable], deferred=model,
         vis=msfile, caltable=aptable, append=False, field=','.join(mybpcals),
         spw=flagspw, solint='int', refant=ref_ant, minsnr=2.0,
         solmode='L1R', gaintype='G', calmode='ap',
@@ -32,7 +47,9 @@ def initial_calibration(msfile, ref_ant, flagspw, myampcals, mybpcals, mypcals,
     )
     
     bptable = f"{msfile}.B1{mycalsuffix}"
-    cts.bandpass(
+    governor().predict_solve('bandpass', msfile, ','.join(mybpcals), 'inf')
+    call_cached(
+        'bandpass', [bptable], tables=[gntable, aptable], deferred=model,
         vis=msfile, caltable=bptable, spw=flagspw, field=','.join(mybpcals),
         solint='inf', refant=ref_ant, solnorm=True, minsnr=2.0,
         fillgaps=8, parang=True,
@@ -45,9 +62,13 @@ def initial_calibration(msfile, ref_ant, flagspw, myampcals, mybpcals, mypcals,
 def gain_calibration(msfile, mycal, ref_ant, gainspw, uvrange, mycalsuffix, append=False):
     """Perform gain calibration."""
     gtable = [f"{msfile}.K1{mycalsuffix}", f"{msfile}.B1{mycalsuffix}"]
+    caltable = f"{msfile}.AP.G{mycalsuffix}"
     
-    cts.gaincal(
-        vis=msfile, caltable=f"{msfile}.AP.G{mycalsuffix}", spw=gainspw,
+    governor().predict_solve('gaincal', msfile, mycal, '120s')
+    call_cached(
+        'gaincal', [caltable], tables=gtable + ([caltable] if append else []),
+        deferred=_model_setup.get(os.path.abspath(msfile)),
+        vis=msfile, caltable=caltable, spw=gainspw,
         uvrange=uvrange, append=append, field=mycal, solint='120s',
         refant=ref_ant, minsnr=2.0, solmode='L1R', gaintype='G',
         calmode='ap', gaintable=gtable,
@@ -57,6 +78,14 @@ def gain_calibration(msfile, mycal, ref_ant, gainspw, uvrange, mycalsuffix, appe
     
     return gtable
 
+def flux_scale(msfile, caltable, fluxtable, reference):
+    """Bootstrap the flux density scale of the gain solutions from the reference calibrator."""
+    return call_cached(
+        'fluxscale', [fluxtable], tables=[caltable],
+        vis=msfile, caltable=caltable, fluxtable=fluxtable,
+        reference=reference, incremental=False
+    )
+
 def apply_calibration(msfile, field, gaintables, gainfield=None, interp=None):
     """Apply calibration tables."""
     if gainfield is None:
@@ -69,3 +98,97 @@ def apply_calibration(msfile, field, gaintables, gainfield=None, interp=None):
         gainfield=gainfield, interp=interp,
         calwt=False, parang=False
     )
+
+def gain_calibration_batch(msfile, mycals, ref_ant, gainspw, uvrange, mycalsuffix):
+    """Perform gain calibration on all calibrators in a single gaincal pass.
+
+    gaincal keeps separate solutions per field (combine=''), so this produces the same
+    table as calling `gain_calibration` once per calibrator with append=True.
+    """
+    logging.info(f"Gain calibration for {', '.join(mycals)} in a single pass")
+    return gain_calibration(msfile, ','.join(mycals), ref_ant, gainspw, uvrange, mycalsuffix,
+                            append=False)
+
+def caltable_fields(caltable):
+    """Get the names of the fields with solutions in a calibration table."""
+    from ..utils.casa_tools import casatable
+    with casatable(caltable) as tb:
+        field_ids = sorted(set(tb.getcol('FIELD_ID').tolist()))
+    with casatable(f"{caltable}/FIELD") as tb:
+        names = tb.getcol('NAME')
+    return [str(names[i]) for i in field_ids if i >= 0]
+
+def write_callib(callib, fields, gaintables, gainfield, interp, calwt=False):
+    """Write a cal library file equivalent to one applycal call per field.
+
+    A gainfield entry of None maps each field to its own solutions when the table has
+    them (as gainfield=[field, ...] in `apply_calibration`) and to the solutions of
+    all fields otherwise. Any other entry is used as the field map for all fields.
+    """
+    lines = []
+    for table, gfield, tinterp in zip(gaintables, gainfield, interp):
+        interp_par = ''
+        if tinterp:
+            tinterp, _, finterp = tinterp.partition(',')
+            interp_par = f" tinterp='{tinterp}'" + (f" finterp='{finterp}'" if finterp else '')
+        
+        if gfield is None:
+            withsols = set(caltable_fields(table))
+            own = [f for f in fields if f in withsols]
+            others = [f for f in fields if f not in withsols]
+            for field in own:
+                lines.append(f"caltable='{table}' calwt={calwt} field='{field}' "
+                             f"fldmap='{field}'{interp_par}")
+            if others:
+                lines.append(f"caltable='{table}' calwt={calwt} field='{','.join(others)}'"
+                             f"{interp_par}")
+        elif gfield:
+            lines.append(f"caltable='{table}' calwt={calwt} field='{','.join(fields)}' "
+                         f"fldmap='{gfield}'{interp_par}")
+        else:
+            lines.append(f"caltable='{table}' calwt={calwt} field='{','.join(fields)}'{interp_par}")
+    
+    with open(callib, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return callib
+
+def apply_calibration_batch(msfile, fields, gaintables, gainfield=None, interp=None, runner=None):
+    """Apply calibration tables to all the given fields in a single applycal pass.
+
+    Gives the same result as calling `apply_calibration` for each field, with the
+    per-field gainfield mapping expressed through a cal library (see `write_callib`).
+    If a `PartitionRunner` is given, the pass runs on all the sub-MSs in parallel.
+    """
+    if gainfield is None:
+        gainfield = [None, '', '']
+    if interp is None:
+        interp = ['nearest', '', '']
+    
+    if runner is not None:
+        runner.applycal(fields, gaintables, gainfield, interp)
+        return
+    
+    callib = write_callib(f"{msfile}.callib", fields, gaintables, gainfield, interp)
+    logging.info(f"Applying calibration to {len(fields)} fields in a single pass ({callib})")
+    cts.applycal(
+        vis=msfile, field=','.join(fields), docallib=True, callib=callib,
+        parang=False
+    )
+
+def gain_phase_scatter(caltable):
+    """Get the scatter (standard deviation, in degrees) of the unflagged gain phases of a table."""
+    from ..utils.casa_tools import casatable
+    with casatable(caltable) as tb:
+        gains = tb.getcol('CPARAM')
+        flags = tb.getcol('FLAG')
+    phases = np.degrees(np.angle(gains[~flags]))
+    return float(np.std(phases)) if phases.size else float('nan')
+
+def solution_quality(caltable):
+    """Get the median SNR of the unflagged solutions and the flagged fraction of a table."""
+    from ..utils.casa_tools import casatable
+    with casatable(caltable) as tb:
+        snr = tb.getcol('SNR')
+        flags = tb.getcol('FLAG')
+    return {'snr': float(np.median(snr[~flags])) if (~flags).any() else 0.0,
+            'flagged': float(flags.mean()) if flags.size else 1.0}
@@ -0,0 +1,131 @@
+"""Fused extraction of the target data for imaging.
+
+The target field used to be split out at full resolution (`{ms}.split.ms`) and
+the split then read back to average it by `chan_avg`: a full extra write and
+read of the target data. `extract_target` selects the field and the good channel
+range and applies the channel (and optional time) averaging in a single
+mstransform pass. The full-resolution split is only written when asked for.
+"""
+
+import os
+import logging
+import numpy as np
+
+from ..utils.lazy import casatasks as cts
+from ..utils.casa_tools import casatable
+from ..utils.flag_stats import flag_stats
+from ..utils.ms_metadata import get_metadata
+
+
+def good_channel_range(msfile, field) -> tuple:
+    """Get the (first, last) channels of a field between the fully flagged band edges.
+
+    Uses the per-scan flagging statistics (see `flag_stats`), so the FLAG column is
+    only read if it changed since they were last computed.
+    """
+    md = get_metadata(msfile)
+    stats = flag_stats(msfile)
+    rows = np.isin(stats.scans, md.scans_for_field(field))
+    flagged = stats.counts['flagged_channel'][rows].sum(axis=0)
+    total = stats.counts['total_channel'][rows].sum(axis=0)
+    good = np.flatnonzero((total > 0) & (flagged < total))
+    if good.size == 0:
+        return 0, md.nchan(0) - 1
+    return int(good[0]), int(good[-1])
+
+
+def _main_table_bytes(msfile) -> int:
+    """Get the bytes of the main table files of an MS (or of all its sub-MSs)."""
+    submss = os.path.join(msfile, 'SUBMSS')
+    if os.path.isdir(submss):
+        return sum(_main_table_bytes(entry.path) for entry in os.scandir(submss) if entry.is_dir())
+    return sum(entry.stat().st_size for entry in os.scandir(msfile) if entry.is_file())
+
+
+def split_bytes(msfile, field, nchan) -> int:
+    """Estimate the bytes of the visibility columns of a full-resolution split of a field.
+
+    Counts the DATA, FLAG and (if present) WEIGHT_SPECTRUM/SIGMA_SPECTRUM cells of the
+    unflagged rows of the field for `nchan` channels, which is what the split writes.
+    """
+    fid = int(np.flatnonzero(get_metadata(msfile).fieldnames == field)[0])
+    with casatable(msfile) as tb:
+        spectral = sum(col in tb.colnames() for col in ('WEIGHT_SPECTRUM', 'SIGMA_SPECTRUM'))
+        ncorr = tb.getcell('FLAG', 0).shape[0]
+        selected = tb.query(f"FIELD_ID=={fid} && !FLAG_ROW")
+        try:
+            nrows = selected.nrows()
+        finally:
+            selected.close()
+    # Complex data, flags stored as bits, float spectral weights
+    return int(nrows * nchan * ncorr * (8 + 1 / 8 + 4 * spectral))
+
+
+def extract_target(msfile, field, outputvis, splitvis=None, chanbin=1, timebin=None,
+                   keep_split=False, datacolumn='corrected', runner=None) -> dict:
+    """Split a field out of an MS with channel (and time) averaging, in one pass.
+
+    Only the channels between the fully flagged band edges of the field are kept
+    (see `good_channel_range`), and fully flagged rows are dropped.
+
+    Args:
+        msfile: Calibrated MS
+        field: Field to extract
+        outputvis: Averaged output MS
+        splitvis: Full-resolution split, only written if `keep_split` (or if there is no
+                  averaging, in which case it is the output)
+        chanbin: Channels averaged together
+        timebin: Averaging time (e.g. '16s'), None or '' for no time averaging
+        keep_split: Also write `splitvis` (an existing one is reused), and average from
+                    it (two passes)
+        datacolumn: Column of `msfile` to extract
+        runner: `PartitionRunner` to run the pass on the sub-MSs of a Multi-MS in parallel
+
+    Returns:
+        Dictionary with the output MS, the channel selection, and the I/O (MB) of the
+        pass and of the full-resolution split it avoided (estimated).
+    """
+    first, last = good_channel_range(msfile, field)
+    spw = f"0:{first}~{last}"
+    average = dict(chanaverage=chanbin > 1, chanbin=chanbin)
+    if timebin:
+        average.update(timeaverage=True, timebin=timebin)
+    averaging = chanbin > 1 or bool(timebin)
+    logging.info(f"Extracting {field} from {msfile}: channels {first}~{last}"
+                 f"{f', {chanbin} channels' if chanbin > 1 else ''}"
+                 f"{f', {timebin}' if timebin else ''} averaged")
+
+    def mstransform(vis, outputvis, field, datacolumn, **kwargs):
+        if runner is not None and vis == msfile:
+            return runner.mstransform(outputvis=outputvis, field=field, datacolumn=datacolumn,
+                                      keepflags=False, **kwargs)
+        return cts.mstransform(vis=vis, outputvis=outputvis, field=field, datacolumn=datacolumn,
+                               keepflags=False, **kwargs)
+
+    if not averaging:
+        mstransform(msfile, splitvis or outputvis, field, datacolumn, spw=spw)
+        return {'outputvis': splitvis or outputvis, 'spw': spw, 'passes': 1, 'saved_mb': 0.0}
+
+    if keep_split and splitvis:
+        # The full-resolution split is needed later: write it (unless it is left over
+        # from an earlier run), then average it
+        if os.path.exists(splitvis):
+            logging.info(f"Reusing the existing full-resolution split {splitvis}")
+        else:
+            mstransform(msfile, splitvis, field, datacolumn, spw=spw)
+        mstransform(splitvis, outputvis, '', 'data', **average)
+        split_mb = _main_table_bytes(splitvis) / 1024**2
+        logging.info(f"Kept the full-resolution split {splitvis} ({split_mb:.1f} MB)")
+        return {'outputvis': outputvis, 'splitvis': splitvis, 'spw': spw, 'passes': 2,
+                'split_mb': split_mb, 'saved_mb': 0.0}
+
+    mstransform(msfile, outputvis, field, datacolumn, spw=spw, **average)
+
+    # One write of the full-resolution split and one read back of it are saved
+    split_mb = split_bytes(msfile, field, last - first + 1) / 1024**2
+    written_mb = _main_table_bytes(outputvis) / 1024**2
+    logging.info(f"Extracted {field} into {outputvis} in one pass: wrote {written_mb:.1f} MB, "
+                 f"saved writing and reading back a ~{split_mb:.1f} MB full-resolution split "
+                 f"(~{2 * split_mb:.1f} MB of I/O)")
+    return {'outputvis': outputvis, 'spw': spw, 'passes': 1, 'written_mb': written_mb,
+            'split_mb': split_mb, 'saved_mb': 2 * split_mb}
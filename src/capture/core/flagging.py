@@ -0,0 +1,368 @@
+"""Flagging functions for CAPTURE pipeline."""
+
+import logging
+import warnings
+import numpy as np
+from ..utils.lazy import casatasks as cts
+
+from ..utils.casa_tools import iter_ms_chunks, getbandcut, freq_info, log_flagsummary
+from ..utils.ms_metadata import get_metadata
+from ..utils.flag_stats import flag_stats, flag_fingerprint, has_flag_stats, command_scans
+
+
+def flag_command(mode='manual', **params):
+    """Get the flag command string for `flagdata(mode='list')` with the given parameters."""
+    items = [f"mode='{mode}'"]
+    for key, value in params.items():
+        items.append(f"{key}='{value}'" if isinstance(value, str) else f"{key}={value}")
+    return ' '.join(items)
+
+
+class FlagBatch:
+    """Accumulates flag commands from several steps and applies them in a single pass.
+
+    Every `flagdata` call reads the whole MS. Collecting the commands (manual, quack,
+    clip, or the ones from the bad antenna/channel finders) and applying them with one
+    `flagdata(mode='list')` call reads it only once, and the flagging summary is computed
+    in that same pass.
+    """
+
+    def __init__(self, msfile):
+        """Initialize an empty batch for the given MS."""
+        self.msfile = msfile
+        self.cmds = []
+
+    def __len__(self):
+        return len(self.cmds)
+
+    def add(self, mode='manual', **params):
+        """Add a flag command (same parameters as `flagdata`)."""
+        self.cmds.append(flag_command(mode, **params))
+
+    def extend(self, cmds):
+        """Add already formatted flag command strings."""
+        self.cmds.extend(cmds)
+
+    def apply(self, summary=True, runner=None):
+        """Apply all the commands in one `flagdata` pass and empty the batch.
+
+        If a `PartitionRunner` is given, the pass runs on all the sub-MSs in parallel.
+
+        Returns:
+            The flagging summary computed in the same pass (None if `summary` is False
+            or there was nothing to apply).
+        """
+        if not self.cmds:
+            logging.info("No flag commands to apply")
+            return None
+
+        cmds = self.cmds + (["mode='summary'"] if summary else [])
+        logging.info(f"Applying {len(self.cmds)} flag commands to {self.msfile} in a single pass")
+        for cmd in self.cmds:
+            logging.debug(f"  {cmd}")
+        # The flags before this pass, which the statistics must match to update them
+        # from the affected scans only
+        before = flag_fingerprint(self.msfile) if has_flag_stats(self.msfile) else None
+        if runner is not None:
+            s = runner.flagdata(cmds)
+        else:
+            s = cts.flagdata(vis=self.msfile, mode='list', inpfile=cmds, action='apply')
+        # Keep the cached flagging statistics in sync, reading only the affected scans
+        if before is not None:
+            flag_stats(self.msfile, scans=command_scans(self.cmds), before=before)
+        self.cmds = []
+        if summary and s:
+            log_flagsummary(s)
+            return s
+        return None
+
+
+def central_channels(nchan, edge=0.1):
+    """Get the (first, last) channels leaving out a fraction `edge` of the band at each end."""
+    first = int(edge * nchan)
+    return first, max(first, nchan - first - 1)
+
+
+def antenna_scan_amplitudes(msfile, chan_range=None, chunk_rows=None):
+    """Get the mean raw amplitude per antenna, scan and correlation in a single pass.
+
+    The DATA column is streamed in bounded chunks of rows and the amplitudes of the
+    cross-correlations are accumulated to both antennas of each baseline, ignoring the
+    flags (as `visstat` with useflags=False did).
+
+    Returns:
+        Array of shape (nant, nscan, ncorr) with the mean amplitudes (NaN where there
+        is no data), ordered as `get_metadata(msfile).antennanames` and `.scannumbers`.
+    """
+    md = get_metadata(msfile)
+    nant, nscan, ncorr = len(md.antennanames), len(md.scannumbers), md.ncorr_for_pol(0)
+    if chan_range is None:
+        chan_range = central_channels(md.nchan(0))
+
+    sums = np.zeros(nant * nscan * ncorr)
+    counts = np.zeros(nant * nscan * ncorr)
+    corr = np.arange(ncorr)
+    for chunk in iter_ms_chunks(msfile, ['ANTENNA1', 'ANTENNA2', 'SCAN_NUMBER', 'DATA'],
+                                chunk_rows=chunk_rows, chan_range=chan_range):
+        cross = chunk['ANTENNA1'] != chunk['ANTENNA2']
+        if not cross.any():
+            continue
+        # mean amplitude over the channels: (ncorr, nrow) -> (nrow, ncorr)
+        amp = np.abs(chunk['DATA'][:, :, cross]).mean(axis=1).T
+        scan_idx = np.searchsorted(md.scannumbers, chunk['SCAN_NUMBER'][cross])
+        for ant in (chunk['ANTENNA1'][cross], chunk['ANTENNA2'][cross]):
+            idx = ((ant * nscan + scan_idx)[:, np.newaxis] * ncorr + corr).ravel()
+            sums += np.bincount(idx, weights=amp.ravel(), minlength=sums.size)
+            counts += np.bincount(idx, minlength=counts.size)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return means.reshape(nant, nscan, ncorr)
+
+
+def find_bad_antennas(msfile, fields=None, cutoff=None, chan_range=None, chunk_rows=None):
+    """Find antennas with low raw amplitudes in a single pass over the MS.
+
+    Antennas whose mean amplitude in a scan and correlation falls below the band cutoff
+    from `getbandcut` are reported as bad for that scan and correlation.
+
+    Args:
+        msfile: Measurement Set to inspect
+        fields: Field names whose scans are checked (e.g. the calibrators). All if None
+        cutoff: Mean amplitude cutoff. Taken from `getbandcut` if None
+        chan_range: (first, last) channels used for the statistics. Central 80% if None
+        chunk_rows: Rows read per chunk (see `iter_ms_chunks`)
+
+    Returns:
+        List of (antenna name, scan, correlation, mean amplitude) tuples.
+    """
+    if cutoff is None:
+        cutoff = getbandcut(msfile)
+        if cutoff is None:
+            return []
+
+    md = get_metadata(msfile)
+    means = antenna_scan_amplitudes(msfile, chan_range=chan_range, chunk_rows=chunk_rows)
+    corrnames = md.corr_names(0)
+    if fields is None:
+        scans = md.scannumbers
+    else:
+        scans = np.unique(np.concatenate([md.scans_for_field(f) for f in fields]))
+
+    badants = []
+    for iscan in np.flatnonzero(np.isin(md.scannumbers, scans)):
+        for ant, icorr in zip(*np.nonzero(means[:, iscan, :] < cutoff)):
+            badants.append((str(md.antennanames[ant]), int(md.scannumbers[iscan]),
+                            corrnames[icorr], float(means[ant, iscan, icorr])))
+
+    logging.info(f"Found {len(badants)} bad antenna/scan/correlation combinations "
+                 f"(cutoff {cutoff})")
+    return badants
+
+
+def write_badants(badants, outfile):
+    """Write the list of bad antennas from `find_bad_antennas` to a text file."""
+    with open(outfile, 'w') as f:
+        f.write("# Bad antennas list\n")
+        f.write("# antenna scan correlation mean_amp\n")
+        for ant, scan, corr, amp in badants:
+            f.write(f"{ant} {scan} {corr} {amp:.6f}\n")
+    logging.info(f"Bad antennas written to {outfile}")
+
+
+def badant_flag_commands(badants):
+    """Get compact flag commands for the bad antennas from `find_bad_antennas`.
+
+    Scans and correlations are merged per antenna, so each antenna needs at most one
+    command per distinct set of bad correlations.
+    """
+    by_antcorr = {}
+    for ant, scan, corr, _ in badants:
+        by_antcorr.setdefault(ant, {}).setdefault(scan, set()).add(corr)
+
+    cmds = []
+    for ant, scans in by_antcorr.items():
+        by_corrs = {}
+        for scan, corrs in scans.items():
+            by_corrs.setdefault(','.join(sorted(corrs)), []).append(scan)
+        for corrs, scanlist in by_corrs.items():
+            scanlist = ','.join(str(s) for s in sorted(scanlist))
+            cmds.append(f"mode='manual' antenna='{ant}' scan='{scanlist}' correlation='{corrs}'")
+    return cmds
+
+
+def find_and_flag_bad_antennas(msfile, outfile=None, flag=False, fields=None, batch=None):
+    """Find bad antennas, write `{msfile}.badants.txt` and optionally flag them.
+
+    If a `FlagBatch` is given, the flag commands are added to it instead of applied.
+    """
+    outfile = outfile or f"{msfile}.badants.txt"
+    badants = find_bad_antennas(msfile, fields=fields)
+    write_badants(badants, outfile)
+    cmds = badant_flag_commands(badants)
+    if flag and cmds and batch is not None:
+        batch.extend(cmds)
+    elif flag and cmds:
+        logging.info(f"Flagging bad antennas with {len(cmds)} flag commands")
+        cts.flagdata(vis=msfile, mode='list', inpfile=cmds, action='apply')
+    return badants, cmds
+
+
+# Number of arm antennas in a baseline: central square-central square, central square-arm
+# and arm-arm baselines see very different RFI levels at GMRT
+BASELINE_GROUPS = ('CC', 'CA', 'AA')
+
+
+def antenna_groups(antennanames):
+    """Get 1 for the GMRT arm antennas (E/S/W) and 0 for the central square (C) ones."""
+    return np.asarray([0 if name.upper().startswith('C') else 1 for name in antennanames])
+
+
+def channel_statistics(msfile, chunk_rows=None):
+    """Get robust per-channel amplitude statistics per baseline group, streaming the MS.
+
+    For every chunk of rows the median and the median absolute deviation (MAD) of the
+    unflagged cross-correlation amplitudes are computed per channel, correlation and
+    baseline group (see `BASELINE_GROUPS`). The final statistics are the medians of the
+    per-chunk values, so memory stays bounded by the chunk size.
+
+    Returns:
+        (median, mad) arrays of shape (ngroup, ncorr, nchan), NaN where all data were flagged.
+    """
+    md = get_metadata(msfile)
+    ngroup, ncorr, nchan = len(BASELINE_GROUPS), md.ncorr_for_pol(0), md.nchan(0)
+    armant = antenna_groups(md.antennanames)
+
+    medians, mads = [], []
+    for chunk in iter_ms_chunks(msfile, ['ANTENNA1', 'ANTENNA2', 'DATA', 'FLAG'],
+                                chunk_rows=chunk_rows):
+        cross = chunk['ANTENNA1'] != chunk['ANTENNA2']
+        amp = np.abs(chunk['DATA'][:, :, cross]).astype(np.float32)
+        amp[chunk['FLAG'][:, :, cross]] = np.nan
+        group = armant[chunk['ANTENNA1'][cross]] + armant[chunk['ANTENNA2'][cross]]
+        chunk_median = np.full((ngroup, ncorr, nchan), np.nan, dtype=np.float32)
+        chunk_mad = np.full((ngroup, ncorr, nchan), np.nan, dtype=np.float32)
+        with warnings.catch_warnings():
+            # channels with all data flagged
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            for g in np.unique(group):
+                gamp = amp[:, :, group == g]
+                chunk_median[g] = np.nanmedian(gamp, axis=2)
+                chunk_mad[g] = np.nanmedian(np.abs(gamp - chunk_median[g][..., np.newaxis]), axis=2)
+        medians.append(chunk_median)
+        mads.append(chunk_mad)
+
+    if not medians:
+        return (np.full((ngroup, ncorr, nchan), np.nan),) * 2
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmedian(np.stack(medians), axis=0), np.nanmedian(np.stack(mads), axis=0)
+
+
+def _running_median(spectra, window):
+    """Running median along the last axis, with the edges padded by reflection."""
+    half = window // 2
+    padded = np.pad(spectra, [(0, 0)] * (spectra.ndim - 1) + [(half, half)], mode='reflect')
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=-1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmedian(windows, axis=-1)
+
+
+def find_outlier_channels(median, mad, nsigma=5.0, window=15):
+    """Find channels whose amplitude level or scatter deviates from the smooth bandpass.
+
+    Both the median and the MAD spectra of every baseline group and correlation are
+    compared with their running median; a channel is an outlier if it deviates by more
+    than `nsigma` robust standard deviations in any of them.
+
+    Returns:
+        Sorted array of the outlier channel indices.
+    """
+    nchan = median.shape[-1]
+    window = min(window, nchan - (1 - nchan % 2))
+    spectra = np.concatenate([median.reshape(-1, nchan), mad.reshape(-1, nchan)])
+    spectra = spectra[~np.all(np.isnan(spectra), axis=1)]
+    if spectra.size == 0 or window < 3:
+        return np.zeros(0, dtype=int)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        resid = spectra - _running_median(spectra, window)
+        sigma = 1.4826 * np.nanmedian(np.abs(resid - np.nanmedian(resid, axis=1, keepdims=True)),
+                                      axis=1, keepdims=True)
+        outliers = np.abs(resid) > nsigma * sigma
+    return np.flatnonzero(np.any(outliers & (sigma > 0), axis=0))
+
+
+def freq_ranges_to_channels(freqs, ranges_mhz):
+    """Get the channels whose frequency falls within any of the given ranges (in MHz)."""
+    freqs = np.asarray(freqs)
+    order = np.argsort(freqs)
+    sorted_freqs = freqs[order]
+    chans = []
+    for fmin, fmax in ranges_mhz:
+        lo = np.searchsorted(sorted_freqs, min(fmin, fmax) * 1e6, side='left')
+        hi = np.searchsorted(sorted_freqs, max(fmin, fmax) * 1e6, side='right')
+        chans.append(order[lo:hi])
+    return np.unique(np.concatenate(chans)) if chans else np.zeros(0, dtype=int)
+
+
+def channel_ranges(chans):
+    """Get a CASA channel selection string (e.g. '5~9;20') for a list of channels."""
+    chans = np.unique(np.asarray(chans, dtype=int))
+    if chans.size == 0:
+        return ''
+    breaks = np.flatnonzero(np.diff(chans) > 1)
+    starts = np.concatenate([[chans[0]], chans[breaks + 1]])
+    ends = np.concatenate([chans[breaks], [chans[-1]]])
+    return ';'.join(str(s) if s == e else f"{s}~{e}" for s, e in zip(starts, ends))
+
+
+def channel_flag_commands(chans, spw=0):
+    """Get the flag commands (a single one) flagging the given channels."""
+    selection = channel_ranges(chans)
+    return [f"mode='manual' spw='{spw}:{selection}'"] if selection else []
+
+
+def find_and_flag_bad_channels(msfile, outfile=None, find=True, rfi_ranges=None, nsigma=5.0,
+                               flag=False, batch=None):
+    """Find bad channels and known RFI frequencies, write `{msfile}.badchans.txt` and flag them.
+
+    Args:
+        msfile: Measurement Set to inspect
+        outfile: Output flag command file. `{msfile}.badchans.txt` if None
+        find: Search for outlier channels in the data
+        rfi_ranges: List of [fmin, fmax] known RFI frequency ranges in MHz to also flag
+        nsigma: Threshold for the outlier channels (see `find_outlier_channels`)
+        flag: Apply the resulting flag commands
+        batch: `FlagBatch` where the flag commands are added instead of applied
+
+    Returns:
+        (channels, flag commands)
+    """
+    outfile = outfile or f"{msfile}.badchans.txt"
+    chans = [np.zeros(0, dtype=int)]
+    if find:
+        outliers = find_outlier_channels(*channel_statistics(msfile), nsigma=nsigma)
+        logging.info(f"Found {len(outliers)} outlier channels")
+        chans.append(outliers)
+    if rfi_ranges:
+        rfichans = freq_ranges_to_channels(freq_info(msfile), rfi_ranges)
+        logging.info(f"{len(rfichans)} channels fall in known RFI frequency ranges")
+        chans.append(rfichans)
+
+    chans = np.unique(np.concatenate(chans))
+    cmds = channel_flag_commands(chans)
+    with open(outfile, 'w') as f:
+        f.write("# Bad channels flag commands\n")
+        for cmd in cmds:
+            f.write(f"{cmd}\n")
+    logging.info(f"Bad channels written to {outfile}")
+
+    if flag and cmds and batch is not None:
+        batch.extend(cmds)
+    elif flag and cmds:
+        logging.info(f"Flagging {len(chans)} bad channels")
+        cts.flagdata(vis=msfile, mode='list', inpfile=cmds, action='apply')
+    return chans, cmds
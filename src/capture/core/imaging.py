@@ -1,17 +1,152 @@
 """Imaging functions for CAPTURE pipeline."""
 
+import os
+import glob
+import json
+import shutil
 import logging
-import casatasks as cts
+from ..utils.lazy import casatasks as cts
+
+from .planner import resolve_geometry
+from ..utils.fingerprint import (fingerprint, params_digest, path_signature, signature_digest,
+                                 METADATA_SUBTABLES)
+from ..utils.flag_stats import flag_digest
+from ..utils.task_cache import call_cached
+from .resources import governor
+
+# Products that tclean can restart from instead of recomputing them
+RESTART_PRODUCTS = ('psf', 'residual', 'sumwt', 'pb', 'weight')
+
+# All the images written by tclean
+PRODUCTS = ('image', 'model', 'mask', 'alpha', 'beta') + RESTART_PRODUCTS
+
+# Suffix of the image names of the dirty images (niter=0)
+DIRTY_SUFFIX = '-dirty-img'
+
+def image_prefix(msfile):
+    """Get the image name `make_dirty_image` and `clean_image` use for an MS (its file
+    name up to the first '.')."""
+    return str(msfile).rstrip('/').split('/')[-1].split('.')[0]
+
+def dirty_image_name(msfile):
+    """Get the name of the dirty image `make_dirty_image` writes for an MS (exported to
+    `{name}.fits`)."""
+    return f"{image_prefix(msfile)}{DIRTY_SUFFIX}"
+
+def ms_setup(msfile):
+    """Get a digest of the metadata subtables of an MS (fields, spectral setup...), which
+    change when the MS is made again, e.g. with other channels."""
+    return signature_digest({name: path_signature(os.path.join(str(msfile), name))
+                             for name in METADATA_SUBTABLES})
+
+def _products_record(imagename):
+    """Get the path of the file recording the state the products of an image were made from."""
+    return f"{imagename}.capture_products.json"
+
+def _has_products(imagename, kind, nterms):
+    """Check if the given product ('psf', 'residual'...) of an image exists."""
+    return os.path.isdir(f"{imagename}.{kind}.tt0" if nterms > 1 else f"{imagename}.{kind}")
+
+def reusable_products(msfile, imagename, params, nterms=1):
+    """Decide which imaging products can be reused for the next tclean run of an image.
+
+    The PSF (and imaging weights) depend only on the uv-coverage, flags and imaging
+    parameters, so it is reused while the flags of the MS and the parameters are the
+    same as when it was made. The residual also depends on the visibilities and the
+    model, so it is only reused if the MS has not changed at all since the last run
+    (e.g. when cleaning further right after the dirty image).
+
+    Returns:
+        Tuple (calcpsf, calcres) for tclean.
+    """
+    try:
+        with open(_products_record(imagename)) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return True, True
+
+    if record.get('params') != params_digest(params) or not _has_products(imagename, 'psf', nterms):
+        return True, True
+    if record.get('flags') != flag_digest(msfile):
+        return True, True
+    calcres = record.get('data') != fingerprint(msfile) or \
+        not _has_products(imagename, 'residual', nterms)
+    return False, calcres
+
+def products_changed(imagename, params):
+    """Check if an image was previously made with different imaging parameters."""
+    try:
+        with open(_products_record(imagename)) as f:
+            return json.load(f).get('params') != params_digest(params)
+    except (OSError, ValueError):
+        return False
+
+def record_products(msfile, imagename, params):
+    """Record the state of the MS and the parameters the products of an image were made from."""
+    with open(_products_record(imagename), 'w') as f:
+        json.dump({'msfile': str(msfile), 'params': params_digest(params),
+                   'flags': flag_digest(msfile), 'data': fingerprint(msfile)}, f, indent=2)
+
+def clear_products(imagename):
+    """Remove the images of a previous tclean run, which tclean cannot restart from if
+    the imaging parameters changed."""
+    for kind in ('image', 'model', 'mask') + RESTART_PRODUCTS:
+        for path in glob.glob(f"{imagename}.{kind}") + glob.glob(f"{imagename}.{kind}.*"):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+
+def seed_products(source, imagename):
+    """Copy the restart products of an image (e.g. the dirty image) to a new image name."""
+    for kind in RESTART_PRODUCTS:
+        for path in glob.glob(f"{source}.{kind}*"):
+            target = f"{imagename}{path[len(source):]}"
+            if not os.path.exists(target):
+                shutil.copytree(path, target)
+    shutil.copyfile(_products_record(source), _products_record(imagename))
 
 def tclean_image(msfile, imagename, niter=0, threshold='1mJy', cell='1arcsec',
-                imsize=1024, nterms=1, wprojplanes=1, robust=0.0):
-    """Create an image using tclean."""
+                imsize=1024, nterms=1, wprojplanes=1, robust=0.0, plan=None):
+    """Create an image using tclean.
+
+    Any of cell, imsize and wprojplanes can be "auto", to be derived from the
+    uv-coverage of the MS (see `planner.resolve_geometry`, with the options in `plan`).
+    """
+    cell, imsize, wprojplanes = resolve_geometry(msfile, cell, imsize, wprojplanes,
+                                                 nterms=nterms, plan=plan)
+    dirtyname = f"{imagename}{DIRTY_SUFFIX}"
     if niter == 0:
-        imagename = f"{imagename}-dirty-img"
+        imagename = dirtyname
+    # Lower-memory settings if the call would not fit in the node, and parallel mode
+    settings = governor().govern_tclean(msfile, imagename, imsize, cell, nterms, wprojplanes,
+                                        niter, scales=(0, 5, 15), plan=plan)
     
-    cts.tclean(
+    # Parameters that the PSF and the residual depend on (unlike niter or threshold), as
+    # tclean runs them, and the setup of the MS (tclean cannot restart from images of
+    # another spectral or field setup)
+    params = {'msfile': os.path.abspath(str(msfile)), 'setup': ms_setup(msfile),
+              'imsize': imsize, 'cell': cell,
+              'robust': robust, 'nterms': nterms, 'wprojplanes': settings['wprojplanes'],
+              'scales': settings['scales']}
+    calcpsf, calcres = reusable_products(msfile, imagename, params, nterms)
+    if products_changed(imagename, params):
+        logging.info(f"Imaging parameters of {imagename} changed, removing its previous images")
+        clear_products(imagename)
+    if calcpsf and imagename != dirtyname and not os.path.exists(f"{imagename}.model" if nterms == 1
+                                                                 else f"{imagename}.model.tt0"):
+        # A first clean can start from the PSF and residual of the dirty image
+        dirty = reusable_products(msfile, dirtyname, params, nterms)
+        if not dirty[0]:
+            seed_products(dirtyname, imagename)
+            calcpsf, calcres = dirty
+    logging.info(f"Imaging {imagename}: "
+                 f"{'computing' if calcpsf else 'reusing'} PSF, "
+                 f"{'computing' if calcres else 'reusing'} residual")
+    
+    tclean_args = dict(
         vis=msfile,
         imagename=imagename,
+        calcpsf=calcpsf,
+        calcres=calcres,
         selectdata=True,
         field='0',
         spw='',
@@ -32,27 +167,40 @@ def tclean_image(msfile, imagename, niter=0, threshold='1mJy', cell='1arcsec',
         pbmask=0.0,
         deconvolver='mtmfs' if nterms > 1 else 'multiscale',
         gridder='wproject',
-        wprojplanes=wprojplanes,
-        scales=[0, 5, 15],
+        wprojplanes=settings['wprojplanes'],
+        scales=settings['scales'],
         wbawp=False,
         restoration=True,
         savemodel='modelcolumn',
         cyclefactor=0.5,
-        parallel=False,
+        parallel=settings['parallel'],
         interactive=False
     )
+    # The images are reused if the same call was made on the same data before. The
+    # model visibilities tclean writes into the MS are then predicted again
+    def predict_model():
+        if niter > 0:
+            logging.info(f"Predicting the model visibilities of {imagename} into {msfile}")
+            cts.tclean(**{**tclean_args, 'niter': 0, 'calcpsf': False, 'calcres': False,
+                          'restoration': False})
+    inputs = [path for kind in ('model', 'mask')
+              for path in glob.glob(f"{imagename}.{kind}") + glob.glob(f"{imagename}.{kind}.*")]
+    call_cached('tclean', [pattern for kind in PRODUCTS
+                           for pattern in (f"{imagename}.{kind}", f"{imagename}.{kind}.*")],
+                tables=inputs, datacolumn=True, on_hit=predict_model, **tclean_args)
+    record_products(msfile, imagename, params)
     
     # Export to FITS format
     if nterms > 1:
-        cts.exportfits(imagename=f"{imagename}.image.tt0", fitsimage=f"{imagename}.fits")
+        cts.exportfits(imagename=f"{imagename}.image.tt0", fitsimage=f"{imagename}.fits", overwrite=True)
     else:
-        cts.exportfits(imagename=f"{imagename}.image", fitsimage=f"{imagename}.fits")
+        cts.exportfits(imagename=f"{imagename}.image", fitsimage=f"{imagename}.fits", overwrite=True)
     
     return imagename
 
-def make_dirty_image(msfile, cell, imsize, nterms=1, wprojplanes=1, robust=0.0):
+def make_dirty_image(msfile, cell, imsize, nterms=1, wprojplanes=1, robust=0.0, plan=None):
     """Create a dirty image."""
-    nameprefix = msfile.split('/')[-1].split('.')[0]
+    nameprefix = image_prefix(msfile)
     logging.info(f"Creating dirty image for {nameprefix}")
     
     return tclean_image(
@@ -63,12 +211,14 @@ def make_dirty_image(msfile, cell, imsize, nterms=1, wprojplanes=1, robust=0.0):
         imsize=imsize,
         nterms=nterms,
         wprojplanes=wprojplanes,
-        robust=robust
+        robust=robust,
+        plan=plan
     )
 
-def clean_image(msfile, niter, threshold, cell, imsize, nterms=1, wprojplanes=1, robust=0.0):
+def clean_image(msfile, niter, threshold, cell, imsize, nterms=1, wprojplanes=1, robust=0.0,
+                plan=None):
     """Create a cleaned image."""
-    nameprefix = msfile.split('/')[-1].split('.')[0]
+    nameprefix = image_prefix(msfile)
     logging.info(f"Creating cleaned image for {nameprefix}")
     
     return tclean_image(
@@ -80,5 +230,14 @@ def clean_image(msfile, niter, threshold, cell, imsize, nterms=1, wprojplanes=1,
         imsize=imsize,
         nterms=nterms,
         wprojplanes=wprojplanes,
-        robust=robust
+        robust=robust,
+        plan=plan
     )
+
+def image_metrics(imagename, nterms=1):
+    """Get the quality metrics of a cleaned image: peak, residual RMS and dynamic range."""
+    suffix = '.tt0' if nterms > 1 else ''
+    peak = float(cts.imstat(imagename=f"{imagename}.image{suffix}")['max'][0])
+    rms = float(cts.imstat(imagename=f"{imagename}.residual{suffix}")['rms'][0])
+    return {'peak': peak, 'residual_rms': rms,
+            'dynamic_range': peak / rms if rms > 0 else float('nan')}
@@ -0,0 +1,287 @@
+"""Concurrent batch ingestion of LTA and FITS files into Measurement Sets.
+
+Every input becomes a job made of external commands run as asyncio subprocesses:
+listscan and gvfits for LTA files, and
+importgmrt (in a separate Python process) for the FITS files. Up to `concurrency`
+jobs run at the same time. The output of every command is streamed into a
+per-file log as it is produced, each command has a timeout and is retried a
+number of times, and the wall time and throughput of every file and command is
+reported.
+
+Usage:
+    python -m capture.core.ingest obs1.lta obs2.lta obs3.fits --gvbin listscan gvfits -j 4
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+from dataclasses import dataclass, field, asdict
+
+
+# Directory to add to PYTHONPATH so that the conversion subprocesses find `capture`
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@dataclass
+class IngestJob:
+    """One input file to convert, with its outputs and the outcome of the conversion."""
+    source: str
+    msfile: str | None = None
+    fitsfile: str | None = None
+    workdir: str | None = None
+    status: str = 'pending'
+    error: str | None = None
+    wall_s: float = 0.0
+    input_mb: float = 0.0
+    commands: list = field(default_factory=list)
+
+    def __post_init__(self):
+        self.source = os.path.abspath(self.source)
+        self.workdir = os.path.abspath(self.workdir or os.path.dirname(self.source))
+        stem = os.path.splitext(os.path.basename(self.source))[0]
+        if self.is_lta and self.fitsfile is None:
+            self.fitsfile = f"{stem}.FITS"
+        elif not self.is_lta:
+            self.fitsfile = self.source
+        if self.msfile == '':
+            self.msfile = os.path.join(self.workdir, f"{stem}.ms")
+        for name in ('fitsfile', 'msfile'):
+            if getattr(self, name):
+                setattr(self, name, os.path.join(self.workdir, getattr(self, name)))
+        if self.is_lta:
+            # gvfits writes the FITS file name in capitals
+            self.fitsfile = os.path.join(os.path.dirname(self.fitsfile),
+                                         os.path.basename(self.fitsfile).upper())
+
+    @property
+    def is_lta(self) -> bool:
+        """Whether the input is an LTA file (anything not ending in .fits)."""
+        return not self.source.lower().endswith(('.fits', '.uvfits'))
+
+    @property
+    def logfile(self) -> str:
+        """Log with the output of all the commands run for this file."""
+        stem = os.path.splitext(os.path.basename(self.source))[0]
+        return os.path.join(self.workdir, f"{stem}.ingest.log")
+
+    @property
+    def throughput_mb_s(self) -> float:
+        """Input MB converted per second of wall time."""
+        return self.input_mb / self.wall_s if self.wall_s > 0 else 0.0
+
+
+def _python(code):
+    """Command running a Python snippet in a new interpreter that can import `capture`."""
+    return [sys.executable, '-c', code]
+
+
+def _edit_listscan_log(job):
+    """Set the FITS file name in the log listscan writes (TEST.FITS by default)."""
+    stem = os.path.splitext(os.path.basename(job.source))[0]
+    logfile = os.path.join(job.workdir, f"{stem}.log")
+    with open(logfile) as f:
+        log = f.read()
+    with open(logfile, 'w') as f:
+        f.write(log.replace('TEST.FITS', os.path.basename(job.fitsfile)))
+    return logfile
+
+
+def _remove(*paths):
+    """Remove the partial outputs of a failed command."""
+    for path in paths:
+        if path and os.path.isdir(path):
+            shutil.rmtree(path)
+        elif path and os.path.exists(path):
+            os.remove(path)
+
+
+def job_commands(job, gvbinpath=None) -> list:
+    """Get the commands that convert a job's input, as (name, command, outputs) tuples.
+
+    A command can also be a callable taking the job, for the steps done in Python.
+
+    Args:
+        gvbinpath: Paths to the listscan and gvfits executables (for LTA inputs)
+    """
+    commands = []
+    if job.is_lta:
+        if not gvbinpath:
+            raise ValueError(f"listscan and gvfits are needed to convert {job.source}")
+        stem = os.path.splitext(os.path.basename(job.source))[0]
+        commands += [
+            ('listscan', [gvbinpath[0], job.source], []),
+            ('edit_log', _edit_listscan_log, []),
+            ('gvfits', [gvbinpath[1], os.path.join(job.workdir, f"{stem}.log")],
+             [job.fitsfile]),
+        ]
+    if job.msfile:
+        commands.append(('importgmrt', _python(f"import casatasks; casatasks.importgmrt("
+                                               f"fitsfile={job.fitsfile!r}, vis={job.msfile!r})"),
+                         [job.msfile]))
+    return commands
+
+
+async def run_command(command, logfile, cwd=None, timeout=None) -> int:
+    """Run a command, appending its output (stdout and stderr) to `logfile` as it comes.
+
+    Returns:
+        The return code of the command.
+
+    Raises:
+        TimeoutError: If the command runs for longer than `timeout` seconds (it is killed).
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [PACKAGE_ROOT, env.get('PYTHONPATH')]))
+    process = await asyncio.create_subprocess_exec(*command, cwd=cwd, env=env,
+                                                   stdin=asyncio.subprocess.DEVNULL,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.STDOUT)
+
+    async def stream():
+        with open(logfile, 'ab') as f:
+            # listscan/gvfits report progress with carriage returns: copy raw blocks
+            while block := await process.stdout.read(65536):
+                f.write(block)
+                f.flush()
+
+    try:
+        await asyncio.wait_for(asyncio.gather(stream(), process.wait()), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise TimeoutError(f"killed after {timeout} s")
+    return process.returncode
+
+
+async def ingest_job(job, commands, semaphore, timeout=None, retries=1, retry_delay=5.0):
+    """Run the commands of a job in order, each one retried up to `retries` times.
+
+    The outcome (status, error, timings) is stored in the job.
+    """
+    async with semaphore:
+        os.makedirs(job.workdir, exist_ok=True)
+        job.input_mb = os.path.getsize(job.source) / 1024**2 if os.path.exists(job.source) \
+            else 0.0
+        job.status = 'running'
+        logging.info(f"Ingesting {job.source}")
+        start = time.perf_counter()
+        for name, command, outputs in commands:
+            for attempt in range(1, retries + 2):
+                with open(job.logfile, 'a') as f:
+                    f.write(f"\n### {name} (attempt {attempt}): "
+                            f"{command.__name__ if callable(command) else ' '.join(command)}\n")
+                _remove(*outputs)
+                t0 = time.perf_counter()
+                try:
+                    if callable(command):
+                        command(job)
+                        returncode = 0
+                    else:
+                        returncode = await run_command(command, job.logfile, cwd=job.workdir,
+                                                       timeout=timeout)
+                    error = None if returncode == 0 else f"{name} exited with code {returncode}"
+                    if error is None and any(not os.path.exists(out) for out in outputs):
+                        error = f"{name} did not write {', '.join(outputs)}"
+                except (OSError, TimeoutError) as e:
+                    error = f"{name}: {e}"
+                job.commands.append({'name': name, 'attempt': attempt, 'error': error,
+                                     'wall_s': time.perf_counter() - t0})
+                if error is None:
+                    break
+                logging.warning(f"{job.source}: {error} (attempt {attempt}/{retries + 1})")
+                if attempt <= retries:
+                    await asyncio.sleep(retry_delay * attempt)
+            if error is not None:
+                job.status, job.error = 'failed', error
+                break
+        else:
+            job.status = 'done'
+        job.wall_s = time.perf_counter() - start
+        logging.info(f"{job.source}: {job.status} in {job.wall_s:.1f} s "
+                     f"({job.throughput_mb_s:.1f} MB/s), log in {job.logfile}")
+        return job
+
+
+async def _ingest(jobs, gvbinpath, concurrency, timeout, retries, retry_delay):
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*(ingest_job(job, job_commands(job, gvbinpath),
+                                             semaphore, timeout, retries, retry_delay)
+                                  for job in jobs))
+
+
+def ingest(jobs, gvbinpath=None, concurrency=4, timeout=None, retries=1,
+           retry_delay=5.0, report='ingest_report.json'):
+    """Convert many LTA/FITS files concurrently.
+
+    Args:
+        jobs: `IngestJob`s (or input file names, converted to MSs next to them)
+        gvbinpath: Paths to the listscan and gvfits executables
+        concurrency: Maximum number of files converted at the same time
+        timeout: Maximum seconds for each command (None for no limit)
+        retries: Number of times a failed command is run again
+        retry_delay: Seconds to wait before the first retry (doubled for the second...)
+        report: JSON file for the outcome, timings and throughput of each file (None to
+                not write it)
+
+    Returns:
+        The jobs, with their status, error and timings filled in.
+    """
+    jobs = [job if isinstance(job, IngestJob) else IngestJob(job, msfile='') for job in jobs]
+    logging.info(f"Ingesting {len(jobs)} files, {concurrency} at a time")
+    start = time.perf_counter()
+    jobs = asyncio.run(_ingest(jobs, gvbinpath, concurrency, timeout, retries,
+                               retry_delay))
+    wall = time.perf_counter() - start
+
+    total_mb = sum(job.input_mb for job in jobs if job.status == 'done')
+    failed = [job for job in jobs if job.status != 'done']
+    logging.info(f"Ingested {len(jobs) - len(failed)}/{len(jobs)} files, {total_mb:.0f} MB in "
+                 f"{wall:.1f} s ({total_mb / wall if wall > 0 else 0:.1f} MB/s overall)")
+    for job in failed:
+        logging.error(f"Failed to ingest {job.source}: {job.error}")
+    if report:
+        with open(report, 'w') as f:
+            json.dump({'wall_s': wall, 'concurrency': concurrency,
+                       'jobs': [{**asdict(job), 'throughput_mb_s': job.throughput_mb_s}
+                                for job in jobs]}, f, indent=2)
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert many LTA/FITS files to MSs concurrently',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('inputs', type=str, nargs='+', help='LTA or FITS files')
+    parser.add_argument('--gvbin', type=str, nargs=2, default=None,
+                        metavar=('LISTSCAN', 'GVFITS'), help='listscan and gvfits executables')
+    parser.add_argument('--fits-only', action='store_true',
+                        help='Stop LTA conversions at the FITS file (no importgmrt)')
+    parser.add_argument('--workdir', type=str, default=None,
+                        help='Directory for the outputs and logs (next to each input by default)')
+    parser.add_argument('-j', '--concurrency', type=int, default=4,
+                        help='Files converted at the same time')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Maximum seconds for each command')
+    parser.add_argument('--retries', type=int, default=1, help='Retries of a failed command')
+    parser.add_argument('--report', type=str, default='ingest_report.json',
+                        help='JSON report with the outcome and throughput of each file')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    gvbinpath = [os.path.abspath(x) for x in args.gvbin] if args.gvbin else None
+    jobs = [IngestJob(source, msfile=None if args.fits_only else '', workdir=args.workdir)
+            for source in args.inputs]
+    jobs = ingest(jobs, gvbinpath, args.concurrency, args.timeout, args.retries,
+                  report=args.report)
+    sys.exit(0 if all(job.status == 'done' for job in jobs) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""Partitioned (Multi-MS) parallel execution for CAPTURE pipeline.
+
+In partitioned mode the MS is split by scan (or spw) into a Multi-MS (MMS), and
+the work that is independent per partition (flagging, applying calibration and
+splitting) runs on the sub-MSs in a pool of worker processes. Tasks that need
+the whole dataset (gaincal, bandpass, fluxscale...) keep running serially on
+the MMS, which CASA treats as a regular MS.
+"""
+
+import os
+import glob
+import json
+import shutil
+import logging
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from ..utils.lazy import casatasks as cts
+
+from ..utils.fingerprint import fingerprint
+from ..utils.ms_metadata import get_metadata
+from .resources import governor, BASE_MEMORY_GB, THREAD_VARIABLES
+
+
+def _limit_memory(memory_bytes, threads=None):
+    """Process pool initializer capping the data segment and the threads of each worker."""
+    if memory_bytes:
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_bytes, memory_bytes))
+    if threads:
+        # Read by CASA when it is first imported in the worker
+        for var in THREAD_VARIABLES:
+            os.environ[var] = str(threads)
+
+
+def _present_fields(msfile, fields):
+    """Get the fields (from the given ones) that have data in an MS."""
+    md = get_metadata(msfile)
+    return [f for f in fields if len(md.scans_for_field(f)) > 0]
+
+
+def _flagdata_part(submss, cmds):
+    """Apply a list of flag commands to one sub-MS."""
+    return cts.flagdata(vis=submss, mode='list', inpfile=cmds, action='apply', flagbackup=False)
+
+
+def _applycal_part(submss, fields, gaintables, gainfield, interp):
+    """Apply calibration to the given fields of one sub-MS in a single pass."""
+    from .calibration import write_callib
+    fields = _present_fields(submss, fields)
+    if not fields:
+        return submss
+    callib = write_callib(f"{submss}.callib", fields, gaintables, gainfield, interp)
+    cts.applycal(vis=submss, field=','.join(fields), docallib=True, callib=callib,
+                 parang=False, flagbackup=False)
+    return submss
+
+
+def _mstransform_part(submss, outputvis, field, kwargs):
+    """Run mstransform on one sub-MS (None if the field has no data in it)."""
+    if field and not _present_fields(submss, [field]):
+        return None
+    cts.mstransform(vis=submss, outputvis=outputvis, field=field, **kwargs)
+    return outputvis
+
+
+def merge_flag_summaries(summaries):
+    """Add up the 'flagged' and 'total' counts of several flagdata summaries."""
+    merged = {}
+    for summary in summaries:
+        for key, value in (summary or {}).items():
+            if isinstance(value, dict):
+                merged[key] = merge_flag_summaries([merged.get(key, {}), value])
+            elif key in ('flagged', 'total'):
+                merged[key] = merged.get(key, 0.0) + value
+            else:
+                merged.setdefault(key, value)
+    return merged
+
+
+def partition_ms(msfile, mmsfile=None, axis='scan', nparts=8):
+    """Partition an MS into a Multi-MS by scan or spw.
+
+    An existing Multi-MS is reused only if it was partitioned from the same MS (same
+    fingerprint) with the same axis and number of partitions, as recorded in
+    `{mmsfile}.capture_partition.json`; otherwise it is partitioned again.
+
+    Returns:
+        Name of the Multi-MS (`{msfile}.mms` by default).
+    """
+    mmsfile = mmsfile or f"{msfile.rstrip('/')}.mms"
+    record_file = f"{mmsfile}.capture_partition.json"
+    record = {'msfile': os.path.abspath(msfile), 'ms': fingerprint(msfile), 'axis': axis,
+              'nparts': nparts}
+    try:
+        with open(record_file) as f:
+            partitioned = json.load(f)
+    except (OSError, ValueError):
+        partitioned = None
+    if os.path.isdir(mmsfile):
+        if partitioned == record:
+            logging.info(f"Using existing Multi-MS {mmsfile}")
+            return mmsfile
+        logging.info(f"{mmsfile} was not partitioned from the current {msfile} with these "
+                     f"settings, partitioning again")
+        shutil.rmtree(mmsfile)
+
+    logging.info(f"Partitioning {msfile} by {axis} into {nparts} sub-MSs: {mmsfile}")
+    cts.partition(vis=msfile, outputvis=mmsfile, createmms=True, separationaxis=axis,
+                  numsubms=nparts, datacolumn='all', flagbackup=False)
+    with open(record_file, 'w') as f:
+        json.dump(record, f, indent=2)
+    return mmsfile
+
+
+def worker_count(workers, memory_gb=None):
+    """Limit the number of workers to the CPUs and, if given, to the memory of the node."""
+    workers = max(1, min(workers, os.cpu_count() or 1))
+    if memory_gb:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        workers = max(1, min(workers, int(total // (memory_gb * 1024**3))))
+    return workers
+
+
+def process_pool(workers, memory_gb=None, threads=None):
+    """Get a pool of `workers` processes, each one capped to `memory_gb` GB and to
+    `threads` threads if given."""
+    memory_bytes = int(memory_gb * 1024**3) if memory_gb else None
+    # spawn: the CASA tools do not survive a fork of an initialized process
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_limit_memory, initargs=(memory_bytes, threads))
+
+
+class PartitionRunner:
+    """Runs the per-partition work of a Multi-MS in a pool of worker processes."""
+
+    def __init__(self, mmsfile, workers=4, memory_gb=None):
+        """Initialize the runner.
+
+        Args:
+            mmsfile: Multi-MS created by `partition_ms`
+            workers: Maximum number of worker processes
+            memory_gb: Memory cap per worker in GB (None for no limit). The number of
+                       workers is also reduced so that they fit in the node memory.
+        """
+        self.mmsfile = mmsfile
+        self.memory_gb = memory_gb
+        self.workers, self.threads = governor().plan_workers(
+            'partitions', worker_count(workers, memory_gb), memory_gb or BASE_MEMORY_GB)
+        self._pool = None
+        logging.info(f"Partitioned mode: {len(self.submss)} sub-MSs, {self.workers} workers"
+                     + (f", {memory_gb} GB per worker" if memory_gb else ''))
+
+    @property
+    def submss(self):
+        """Get the sorted list of sub-MSs of the Multi-MS."""
+        return sorted(glob.glob(os.path.join(self.mmsfile, 'SUBMSS', '*.ms')))
+
+    def map(self, func, *iterables):
+        """Run `func` over the arguments in the process pool, returning the results in order.
+
+        The pool is started on first use and kept until `close`, so the workers import
+        CASA only once.
+        """
+        if self._pool is None:
+            self._pool = process_pool(self.workers, self.memory_gb, self.threads)
+        return list(self._pool.map(func, *iterables))
+
+    def close(self):
+        """Shut down the worker processes."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def flagdata(self, cmds):
+        """Apply a list of flag commands to every sub-MS.
+
+        Returns:
+            The merged summary if the commands included mode='summary'.
+        """
+        submss = self.submss
+        logging.info(f"Applying {len(cmds)} flag commands to {len(submss)} sub-MSs")
+        return merge_flag_summaries(self.map(_flagdata_part, submss, [cmds] * len(submss)))
+
+    def applycal(self, fields, gaintables, gainfield, interp):
+        """Apply calibration to the given fields of every sub-MS (see `write_callib`)."""
+        submss = self.submss
+        logging.info(f"Applying calibration to {len(fields)} fields in {len(submss)} sub-MSs")
+        n = len(submss)
+        self.map(_applycal_part, submss, [fields] * n, [gaintables] * n, [gainfield] * n,
+                 [interp] * n)
+
+    def mstransform(self, outputvis, field='', **kwargs):
+        """Run mstransform on every sub-MS and reassemble the outputs into `outputvis`.
+
+        The partial outputs are moved (not copied) into `outputvis`, which is a Multi-MS.
+        """
+        submss = self.submss
+        partial = [f"{outputvis.rstrip('/')}.part{i:04d}" for i in range(len(submss))]
+        outputs = self.map(_mstransform_part, submss, partial, [field] * len(submss),
+                           [kwargs] * len(submss))
+        outputs = [out for out in outputs if out is not None]
+        if not outputs:
+            raise ValueError(f"No data selected in {self.mmsfile} for field '{field}'")
+        logging.info(f"Reassembling {len(outputs)} partial outputs into {outputvis}")
+        cts.virtualconcat(vis=outputs, concatvis=outputvis, copypointing=False, keepcopy=False)
+        return outputvis
+
+
+def reassemble(mmsfile, msfile):
+    """Write a Multi-MS back into a monolithic MS."""
+    logging.info(f"Reassembling {mmsfile} into {msfile}")
+    cts.mstransform(vis=mmsfile, outputvis=msfile, createmms=False, datacolumn='all')
+    return msfile
@@ -4,21 +4,41 @@ import logging
 import os
 import tomllib
 from datetime import datetime
-import casatasks as cts
 
+from ..utils.lazy import casatasks as cts, on_import
 from ..utils.casa_tools import vislistobs
 
 from ..utils.pipeline_state import PipelineState
+from ..utils import task_cache
+from . import resources
+from ..utils.profiling import Profiler
 from .steps import PIPELINE_STEPS, PipelineStep
+from .parallel import partition_ms, PartitionRunner
+from .ingest import IngestJob, ingest
+
+# Steps that create the MS, before the partitioned mode can start
+IMPORT_STEPS = ('lta_to_fits', 'fits_to_ms')
 
 class Pipeline:
     """Main CAPTURE pipeline class."""
     
-    def __init__(self, config_file='config_capture.toml'):
-        """Initialize pipeline with configuration."""
-        self.setup_logging()
+    def __init__(self, config_file='config_capture.toml', log=True):
+        """Initialize pipeline with configuration.
+
+        Args:
+            config_file: TOML configuration file
+            log: Set up the pipeline and CASA log files (False to keep the logging
+                 configuration of the caller, e.g. to only plan the run)
+        """
+        if log:
+            self.setup_logging()
         self.load_config(config_file)
         self.state = PipelineState()
+        task_cache.configure(self.cachedir, self.cachesize, self.cacheage, enabled=self.usecache,
+                             data_digest=self.cachedigest)
+        resources.configure(self.memoryfraction, self.threads, self.strictmemory)
+        self.profiler = Profiler()
+        self.runner = None
         
     def setup_logging(self):
         """Set up logging configuration."""
@@ -38,8 +58,9 @@ class Pipeline:
         logging.info(f"CASA_LOGFILE = casa-{self.logfile_name}")
         logging.info("#" * 85)
 
+        # CASA is only loaded when first used, its log file is set then
         self.casa_logfile = f'casa-{self.logfile_name}'
-        cts.casalog.setlogfile(self.casa_logfile)
+        on_import(cts, lambda casatasks: casatasks.casalog.setlogfile(self.casa_logfile))
 
     def load_config(self, config_file):
         """Load configuration from TOML file."""
@@ -58,6 +79,7 @@ class Pipeline:
         # Output settings
         self.splitfilename = config['output']['split_filename']
         self.splitavgfilename = config['output']['split_avg_filename']
+        self.keepsplit = config['output'].get('keep_split', False)
         
         # Flagging settings
         self.findbadants = config['flagging']['find_bad_ants']
@@ -67,6 +89,8 @@ class Pipeline:
         self.flaginit = config['flagging']['flag_init']
         self.flagsplitfile = config['flagging']['flag_split_file']
         self.doflagavg = config['flagging']['flag_avg']
+        self.badchansigma = config['flagging'].get('bad_chan_sigma', 5.0)
+        self.rfiranges = config['flagging'].get('rfi_ranges', [])
         
         # Calibration settings
         self.doinitcal = config['calibration']['do_init_cal']
@@ -86,6 +110,9 @@ class Pipeline:
         self.doselfcal = config['imaging']['do_selfcal']
         self.dosubbandselfcal = config['imaging']['do_subband_selfcal']
         self.chanavg = config['imaging']['chan_avg']
+        self.timeavg = config['imaging'].get('time_avg', '')
+        self.bdatolerance = config['imaging'].get('bda_tolerance', 0.0)
+        self.bdamaxinterval = config['imaging'].get('bda_max_interval', 120.0)
         self.subbandchan = config['imaging']['subband_chan']
         self.imcellsize = [config['imaging']['cell_size']]
         self.imsize_pix = config['imaging']['image_size']
@@ -94,12 +121,41 @@ class Pipeline:
         self.pcaloops = config['imaging']['pcal_loops']
         self.mJythreshold = config['imaging']['mjy_threshold']
         self.scalsolints = config['imaging']['scal_solints']
+        self.scalminimprovement = config['imaging'].get('scal_min_improvement', None)
+        self.scalsolintsearch = config['imaging'].get('scal_solint_search', False)
+        self.scalsolintcands = config['imaging'].get('scal_solint_candidates', self.scalsolints)
+        self.scalmaxflagged = config['imaging'].get('scal_max_flagged', 0.2)
+        self.scalminsnr = config['imaging'].get('scal_min_snr', 5.0)
         self.niter_start = config['imaging']['niter_start']
         self.use_nterms = config['imaging']['use_nterms']
         self.nwprojpl = config['imaging']['nwproj_pl']
+        self.imaging_plan = config['imaging'].get('plan', {})
+        
+        # Parallel settings
+        parallel = config.get('parallel', {})
+        self.partitioned = parallel.get('partitioned', False)
+        self.partitionaxis = parallel.get('partition_axis', 'scan')
+        self.npartitions = parallel.get('num_partitions', 16)
+        self.nworkers = parallel.get('workers', 4)
+        self.workermemory = parallel.get('worker_memory_gb', None)
+        # Resource governor settings
+        limits = config.get('resources', {})
+        self.memoryfraction = limits.get('memory_fraction', 0.8)
+        self.threads = limits.get('threads', 0)
+        self.strictmemory = limits.get('strict', False)
+        
+        # Task cache settings
+        cache = config.get('cache', {})
+        self.usecache = cache.get('enabled', False)
+        self.cachedir = cache.get('directory', '.capture_cache')
+        self.cachesize = cache.get('max_size_gb', 20.0)
+        self.cacheage = cache.get('max_age_days', 30.0)
+        self.cachedigest = cache.get('data_digest', False)
         
         # Processing settings
         self.target = config['processing']['target']
+        self.multitarget = config['processing'].get('multi_target', False)
+        self.targetsdir = config['processing'].get('targets_dir', 'targets')
         self.usetclean = config['processing']['use_tclean']
 
     def run_step(self, step: str | PipelineStep) -> bool:
@@ -110,35 +166,113 @@ class Pipeline:
         # Get actual file paths
         inputs = step.get_input_paths(**self.__dict__)
         outputs = step.get_output_paths(**self.__dict__)
+        params = step.get_params(**self.__dict__)
         
         # Check if step needs to be run
-        if not self.state.check_step_needed(step.name, inputs, outputs):
-            logging.info(f"Skipping step {step.name} - outputs up to date")
+        if not self.state.check_step_needed(step.name, inputs, outputs, params):
+            logging.info(f"Skipping step {step.name} - inputs, outputs and parameters unchanged")
             return False
             
         logging.info(f"Running step {step.name}")
-        step.function(self)
+        # Measure the CASA task calls of the step too
+        self.profiler.instrument_casatasks()
+        before = self.state.snapshot(inputs + outputs)
+        try:
+            with self.profiler.measure('step', step.name) as profile:
+                step.function(self)
+        except Exception as e:
+            self.state.mark_step_failed(step.name, e, params=params, wall_s=profile.get('wall_s'))
+            raise
         
-        # Register outputs
-        self.state.mark_step_complete(step.name, outputs)
+        # Register outputs and fingerprints, and keep earlier steps valid after in-place changes
+        self.state.mark_step_complete(step.name, outputs, inputs=inputs, params=params,
+                                      wall_s=profile.get('wall_s'))
+        self.state.adopt_changes(step.name, before)
+        self.state.record_profile(step.name, profile)
         return True
 
-    def run_pipeline(self):
-        """Run all pipeline steps."""
+    def use_partitions(self):
+        """Switch to the partitioned mode if enabled: the MS becomes a Multi-MS and the
+        per-partition work runs in parallel through `self.runner`."""
+        if not self.partitioned or self.runner is not None:
+            return
+        
+        msfilename = self.msfilename
+        self.msfilename = partition_ms(msfilename, axis=self.partitionaxis,
+                                       nparts=self.npartitions)
+        # The products are named after the MS they are made from
+        logging.warning(f"Partitioned mode: continuing on {self.msfilename}; the calibration "
+                        f"tables, flag files and splits are named after it instead of "
+                        f"{msfilename}, so products of a non-partitioned run are not reused")
+        self.runner = PartitionRunner(self.msfilename, workers=self.nworkers,
+                                      memory_gb=self.workermemory)
+
+    def planned_steps(self) -> list:
+        """Get the names of the steps `run_pipeline` runs with this configuration, in order."""
+        steps = []
         if self.fromlta:
-            self.run_step('lta_to_fits')
-            
+            steps.append('lta_to_fits')
         if self.fromfits:
-            self.run_step('fits_to_ms')
-            
+            steps.append('fits_to_ms')
         if self.flaginit:
-            self.run_step('initial_flagging')
-            
+            steps.append('initial_flagging')
+        if self.findbadants or self.flagbadants:
+            steps.append('find_bad_antennas')
+        if self.findbadchans or self.flagbadfreq:
+            steps.append('find_bad_channels')
         if self.doinitcal:
-            self.run_step('initial_calibration')
-            
+            steps.append('initial_calibration')
         if self.makedirty:
-            self.run_step('make_dirty_image')
+            steps.append('make_dirty_image')
+        return steps
+
+    def plan(self) -> list:
+        """Get which steps `run_pipeline` would run, without running anything.
+
+        Only the configuration and the pipeline state are read (CASA is not imported). A
+        step also runs if one of its inputs is an output of an earlier step that runs.
+
+        Returns:
+            List of (step name, reason to run it, or None if it would be skipped).
+        """
+        plan, produced = [], {}
+        for name in self.planned_steps():
+            step = PIPELINE_STEPS[name]
+            inputs = step.get_input_paths(**self.__dict__)
+            outputs = step.get_output_paths(**self.__dict__)
+            earlier = [produced[path] for path in inputs if path in produced]
+            if earlier:
+                reason = f"input from step {earlier[0]}, which runs"
+            else:
+                reason = self.state.stale_reason(name, inputs, outputs,
+                                                 step.get_params(**self.__dict__))
+            if reason is not None:
+                produced.update({path: name for path in outputs})
+            plan.append((name, reason))
+        return plan
+
+    def run_pipeline(self, profile_report='capture_profile'):
+        """Run all pipeline steps.
+
+        Args:
+            profile_report: Prefix of the JSON/CSV report of the steps and CASA tasks run
+                            (see `Profiler.write_report`), written even if a step fails
+        """
+        steps = self.planned_steps()
+        imports = [name for name in steps if name in IMPORT_STEPS]
+        try:
+            for name in imports:
+                self.run_step(name)
+                
+            self.use_partitions()
+                
+            for name in steps[len(imports):]:
+                self.run_step(name)
+        finally:
+            self.profiler.release_casatasks()
+            if self.profiler.records:
+                self.profiler.log_summary()
+                self.profiler.write_report(profile_report)
     
     def process_lta(self):
         """Process LTA file if specified."""
@@ -155,15 +289,15 @@ class Pipeline:
             return
             
         # Convert LTA to FITS
-        os.system(f"{self.gvbinpath[0]} {self.ltafile}")
-        if self.fits_file and self.fits_file != 'TEST.FITS':
-            os.system(f"sed -i 's/TEST.FITS/{self.fits_file}/ {self.ltafile.split('.')[0]}.log")
-            
-        if not os.path.isfile(self.fits_file):
-            if os.path.isfile('TEST.FITS'):
-                self.fits_file = 'TEST.FITS'
-            else:
-                os.system(f"{self.gvbinpath[1]} {self.ltafile.split('.')[0]}.log")
+        job = IngestJob(self.ltafile, fitsfile=self.fits_file or 'TEST.FITS', workdir=os.getcwd())
+        if os.path.isfile(job.fitsfile):
+            logging.info(f"Using existing FITS file {job.fitsfile}")
+        else:
+            job, = ingest([job], self.gvbinpath, concurrency=1, report=None)
+            if job.status != 'done':
+                logging.error(f"LTA to FITS conversion failed: {job.error}, see {job.logfile}")
+                return
+        self.fits_file = job.fitsfile
 
     def process_fits(self):
         """Process FITS file if specified."""
@@ -0,0 +1,188 @@
+"""Imaging planner for CAPTURE pipeline.
+
+Derives the cell size, image size and number of w-projection planes from the
+uv-coverage of the MS and the primary beam of the band, instead of using fixed
+values (1arcsec, 5000 pixels and 128 planes) for every band and array
+configuration. Used when `cell_size`, `image_size` or `nwproj_pl` are "auto".
+"""
+
+import math
+import logging
+import numpy as np
+
+from ..utils.casa_tools import iter_ms_chunks, CHUNK_BYTES
+from ..utils.fingerprint import ms_metadata_fingerprint
+from ..utils.ms_metadata import get_metadata
+
+
+SPEED_OF_LIGHT = 299792458.0
+
+# GMRT dish diameter (m) and primary beam FWHM in units of lambda/D
+DISH_DIAMETER = 45.0
+PB_FWHM_FACTOR = 1.2
+
+# Oversampling of the gridding convolution functions in CASA
+KERNEL_OVERSAMPLING = 20
+
+# Fixed settings used before the planner, as reference for the predicted cost
+FIXED_SETTINGS = {'cell': '1arcsec', 'imsize': 5000, 'wprojplanes': 128}
+
+# Plans already computed in this process, by absolute MS path
+_cache = {}
+
+
+def uvw_extremes(msfile, chunk_rows=None):
+    """Get the largest uv-distance and |w| (in m) and the number of unflagged rows.
+
+    The UVW column is read in bounded chunks of rows and reduced with NumPy.
+    """
+    chunk_rows = chunk_rows or CHUNK_BYTES // 32
+    uvmax, wmax, nrows = 0.0, 0.0, 0
+    for chunk in iter_ms_chunks(msfile, ['UVW', 'FLAG_ROW'], chunk_rows=chunk_rows):
+        uvw = chunk['UVW'][:, ~chunk['FLAG_ROW']]
+        if uvw.shape[1] == 0:
+            continue
+        uvmax = max(uvmax, float(np.sqrt(uvw[0]**2 + uvw[1]**2).max()))
+        wmax = max(wmax, float(np.abs(uvw[2]).max()))
+        nrows += uvw.shape[1]
+    return uvmax, wmax, nrows
+
+
+def optimum_imsize(npix):
+    """Get the smallest even image size >= npix with no prime factors other than 2, 3 and 5."""
+    n = max(2, int(math.ceil(npix)))
+    while True:
+        if n % 2 == 0:
+            m = n
+            for p in (2, 3, 5):
+                while m % p == 0:
+                    m //= p
+            if m == 1:
+                return n
+        n += 1
+
+
+def parse_angle(angle) -> float:
+    """Convert a CASA angle string ('1arcsec', '0.5arcmin', '1e-5rad'...) to radians."""
+    units = {'arcsec': math.pi / 648000, 'arcmin': math.pi / 10800, 'deg': math.pi / 180,
+             'rad': 1.0}
+    for unit, factor in units.items():
+        if str(angle).endswith(unit):
+            return float(str(angle)[:-len(unit)]) * factor
+    return float(angle) * units['arcsec']
+
+
+def min_wprojplanes(wmax_lambda, fov_rad, w_phase_error=0.5):
+    """Get the number of w-planes keeping the w-term phase error below `w_phase_error`.
+
+    At a distance l from the phase centre the w-term phase is 2*pi*w*(1 - sqrt(1 - l^2)).
+    With the planes spaced by wmax/N, the largest error at the field edge (l = fov/2)
+    between the w of a visibility and its plane must stay below the tolerance.
+    """
+    lmax = min(fov_rad / 2, 1.0)
+    n = 1 - math.sqrt(1 - lmax**2)
+    return max(1, int(math.ceil(2 * math.pi * wmax_lambda * n / w_phase_error)))
+
+
+def gridding_cost(nvis, imsize, cell_rad, wprojplanes, wmax_lambda, nterms=1):
+    """Predict the cost of one major cycle of w-projection gridding.
+
+    The support of the w-kernels (in uv cells) grows as w * fov^2, with the 7 cells of
+    the prolate spheroidal function as the minimum. Gridding touches support^2 cells per
+    visibility and Taylor term; the w-kernels are computed once per plane, and each major
+    cycle does two FFTs per Taylor term image.
+
+    Returns:
+        Dictionary with the support, the operation counts and the kernel memory (bytes).
+    """
+    fov = imsize * cell_rad
+    support = max(7, int(math.ceil(wmax_lambda * fov**2))) if wprojplanes > 1 else 7
+    nimages = 2 * nterms - 1
+    grid_ops = nvis * support**2 * nimages
+    kernel_size = support * KERNEL_OVERSAMPLING
+    kernel_ops = wprojplanes * kernel_size**2 * math.log2(max(kernel_size, 2))
+    fft_ops = 2 * nimages * imsize**2 * math.log2(imsize)
+    return {'support': support, 'grid_ops': grid_ops, 'kernel_ops': kernel_ops,
+            'fft_ops': fft_ops, 'total_ops': grid_ops + kernel_ops + fft_ops,
+            'kernel_memory': wprojplanes * kernel_size**2 * 8}
+
+
+def plan_imaging(msfile, pixels_per_beam=4.0, fov_pb=2.0, w_phase_error=0.5, nterms=1):
+    """Plan the image geometry and w-projection planes of an MS.
+
+    Args:
+        msfile: Measurement Set to image
+        pixels_per_beam: Pixels across the synthesized beam at the highest frequency
+        fov_pb: Field of view to image, in units of the primary beam FWHM at the
+                lowest frequency
+        w_phase_error: Largest w-term phase error (rad) at the edge of the field
+        nterms: Number of Taylor terms (only used for the predicted cost)
+
+    Returns:
+        Dictionary with 'cell' (CASA angle string), 'imsize', 'wprojplanes' and the
+        quantities they were derived from.
+    """
+    key = (str(msfile), ms_metadata_fingerprint(msfile), pixels_per_beam, fov_pb,
+           w_phase_error, nterms)
+    if key in _cache:
+        return _cache[key]
+
+    md = get_metadata(msfile)
+    freqs = md.chan_freqs(0)
+    fmin, fmax = float(freqs.min()), float(freqs.max())
+    uvmax, wmax, nrows = uvw_extremes(msfile)
+    uvmax_lambda = uvmax * fmax / SPEED_OF_LIGHT
+    wmax_lambda = wmax * fmax / SPEED_OF_LIGHT
+
+    beam = 1 / uvmax_lambda if uvmax_lambda > 0 else math.pi / 648000
+    cell_arcsec = math.floor(100 * math.degrees(beam / pixels_per_beam) * 3600) / 100
+    cell_arcsec = max(cell_arcsec, 0.01)
+    cell_rad = cell_arcsec * math.pi / 648000
+    pb_fwhm = PB_FWHM_FACTOR * SPEED_OF_LIGHT / fmin / DISH_DIAMETER
+    imsize = optimum_imsize(fov_pb * pb_fwhm / cell_rad)
+    wprojplanes = min_wprojplanes(wmax_lambda, imsize * cell_rad, w_phase_error)
+
+    plan = {'cell': f"{cell_arcsec:g}arcsec", 'imsize': imsize, 'wprojplanes': wprojplanes,
+            'uvmax_lambda': uvmax_lambda, 'wmax_lambda': wmax_lambda,
+            'pb_fwhm_arcmin': math.degrees(pb_fwhm) * 60,
+            'nvis': nrows * len(freqs),
+            'cost': gridding_cost(nrows * len(freqs), imsize, cell_rad, wprojplanes,
+                                  wmax_lambda, nterms)}
+    _cache[key] = plan
+    return plan
+
+
+def resolve_geometry(msfile, cell, imsize, wprojplanes, nterms=1, plan=None):
+    """Replace the "auto" values of cell, imsize and wprojplanes by the planned ones.
+
+    The predicted gridding cost of the resulting settings is logged next to the cost
+    of the fixed settings, so both can be compared.
+
+    Args:
+        plan: Options for `plan_imaging` (pixels_per_beam, fov_pb, w_phase_error)
+
+    Returns:
+        Tuple (cell, imsize, wprojplanes).
+    """
+    if 'auto' not in (str(cell), str(imsize), str(wprojplanes)):
+        return cell, imsize, wprojplanes
+
+    planned = plan_imaging(msfile, nterms=nterms, **(plan or {}))
+    cell = planned['cell'] if str(cell) == 'auto' else cell
+    imsize = planned['imsize'] if str(imsize) == 'auto' else int(imsize)
+    wprojplanes = planned['wprojplanes'] if str(wprojplanes) == 'auto' else int(wprojplanes)
+
+    cost = gridding_cost(planned['nvis'], imsize, parse_angle(cell), wprojplanes,
+                         planned['wmax_lambda'], nterms)
+    fixed = gridding_cost(planned['nvis'], FIXED_SETTINGS['imsize'],
+                          parse_angle(FIXED_SETTINGS['cell']), FIXED_SETTINGS['wprojplanes'],
+                          planned['wmax_lambda'], nterms)
+    logging.info(f"Imaging plan for {msfile}: cell={cell}, imsize={imsize}, "
+                 f"wprojplanes={wprojplanes} (uvmax={planned['uvmax_lambda']:.0f} lambda, "
+                 f"wmax={planned['wmax_lambda']:.0f} lambda, "
+                 f"PB FWHM={planned['pb_fwhm_arcmin']:.1f} arcmin)")
+    logging.info(f"Predicted gridding cost per major cycle: {cost['total_ops']:.3g} ops "
+                 f"(support {cost['support']}, kernels {cost['kernel_memory']/1024**2:.0f} MB) "
+                 f"vs {fixed['total_ops']:.3g} ops with {FIXED_SETTINGS} "
+                 f"(support {fixed['support']}, kernels {fixed['kernel_memory']/1024**2:.0f} MB)")
+    return cell, imsize, wprojplanes
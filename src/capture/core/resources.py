@@ -0,0 +1,301 @@
+"""Resource governor for CAPTURE pipeline.
+
+Predicts the peak memory and CPU time of the imaging (tclean) and calibration
+solve (gaincal/bandpass) calls from the dimensions of the MS and the imaging
+parameters, and sizes the work to the node before it runs:
+
+- worker pools (partitions, subbands, solint search, targets) get only as many
+  workers as the CPUs and the available memory fit, for the predicted memory of
+  one job, and each worker gets its share of the CPUs as OpenMP threads
+- a tclean call predicted not to fit in the available memory first falls back to
+  the fewest w-planes for the w-term accuracy, then drops the largest multiscale
+  scales; if it still does not fit it fails before starting (`strict = true`), or
+  runs with a warning
+- tclean runs with parallel=True only under mpicasa
+
+The predictions are rough (see `tclean_memory_gb` and the throughputs below), and
+every decision is logged with them. Configured in the `[resources]` section.
+"""
+
+import os
+import math
+import logging
+import numpy as np
+
+from .planner import plan_imaging, gridding_cost, min_wprojplanes, parse_angle
+from ..utils.casa_tools import casatable
+from ..utils.ms_metadata import get_metadata
+
+# Memory of a CASA process besides the data of the call, in GB
+BASE_MEMORY_GB = 1.0
+
+# Memory of the convolution functions of one w-plane when the support is not known
+# (no MS to plan from), in bytes
+DEFAULT_KERNEL_BYTES = 256**2 * 8 * 4
+
+# Throughputs (per thread) assumed for the CPU time predictions
+GRID_OPS_PER_S = 2e8
+SOLVE_VIS_PER_S = 2e7
+
+# Environment variables of the thread pools of CASA and the numerical libraries
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+def _cgroup_memory_gb() -> float | None:
+    """Get the memory left under the cgroup limit of this process in GB (None if unlimited)."""
+    for limit_file, usage_file in (('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+            with open(usage_file) as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        if limit == 'max' or int(limit) >= 2**60:
+            return None
+        return max(0.0, (int(limit) - usage) / 1024**3)
+    return None
+
+
+def node_resources() -> dict:
+    """Get the CPUs this process can use and the total and available memory (GB)."""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**3
+    available = total
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = dict(line.split(':', 1) for line in f)
+        available = int(meminfo['MemAvailable'].split()[0]) / 1024**2
+    except (OSError, KeyError, ValueError):
+        pass
+    cgroup = _cgroup_memory_gb()
+    if cgroup is not None:
+        available = min(available, cgroup)
+    return {'cpus': cpus or 1, 'memory_gb': total, 'available_gb': available}
+
+
+def tclean_memory_gb(imsize, nterms=1, wprojplanes=1, kernel_memory=None, nscales=0) -> float:
+    """Predict the peak memory of tclean (GB).
+
+    Counts the float images of the run (psf, residual, model and image per Taylor term,
+    plus pb, weight and sumwt), the complex gridding planes (2 * nterms - 1, padded by
+    1.2), the w-projection kernels (`kernel_memory` bytes, from `gridding_cost`, or
+    `DEFAULT_KERNEL_BYTES` per plane) and, when deconvolving with `nscales` multiscale
+    scales, the scale-convolved images (float and complex per scale and plane), with a
+    20% margin. The only estimate of the imaging memory, also used by the batch mode.
+    """
+    if kernel_memory is None:
+        kernel_memory = max(1, int(wprojplanes)) * DEFAULT_KERNEL_BYTES
+    planes = 2 * nterms - 1
+    images = imsize**2 * 4 * (4 * nterms + 2)
+    grids = (1.2 * imsize)**2 * 8 * planes
+    scales = imsize**2 * 12 * planes * nscales
+    return BASE_MEMORY_GB + 1.2 * (images + grids + kernel_memory + scales) / 1024**3
+
+
+def predict_tclean(msfile, imsize, cell, nterms=1, wprojplanes=1, niter=0, nscales=3,
+                   plan=None) -> dict:
+    """Predict the peak memory (GB) and CPU time (s) of a tclean call.
+
+    The number of visibilities and the largest w come from `plan_imaging` (cached per
+    MS), as do the "auto" values of imsize, cell and wprojplanes. The PSF and the
+    residual take one gridding pass each, and a clean is assumed to take one more major
+    cycle per 500 iterations (up to 10).
+
+    Returns:
+        Dictionary with 'memory_gb', 'cpu_s', the gridding 'cost' and 'nvis'.
+    """
+    planned = plan_imaging(msfile, nterms=nterms, **(plan or {}))
+    imsize = planned['imsize'] if str(imsize) == 'auto' else imsize
+    cell = planned['cell'] if str(cell) == 'auto' else cell
+    wprojplanes = planned['wprojplanes'] if str(wprojplanes) == 'auto' else wprojplanes
+    cost = gridding_cost(planned['nvis'], int(imsize), parse_angle(cell), int(wprojplanes),
+                         planned['wmax_lambda'], nterms)
+    cycles = 2 + (min(10, 1 + niter // 500) if niter else 0)
+    cpu_s = (cycles * (cost['grid_ops'] + cost['fft_ops']) + cost['kernel_ops']) / GRID_OPS_PER_S
+    memory = tclean_memory_gb(int(imsize), nterms, int(wprojplanes), cost['kernel_memory'],
+                              nscales if niter else 0)
+    return {'memory_gb': memory,
+            'cpu_s': cpu_s, 'cost': cost, 'nvis': planned['nvis'],
+            'wmax_lambda': planned['wmax_lambda']}
+
+
+def predict_solve(msfile, field='', solint='inf') -> dict:
+    """Predict the peak memory (GB) and CPU time (s) of a gaincal/bandpass solve.
+
+    The solver holds the visibilities (with model, weights and flags) of one solution
+    interval of the selected fields, and reads all of them once.
+
+    Returns:
+        Dictionary with 'memory_gb', 'cpu_s' and 'nvis'.
+    """
+    from .selfcal import solint_seconds
+
+    md = get_metadata(msfile)
+    fids = sorted({int(fid) for name in str(field).split(',') if name
+                   for fid in md.field_ids(name)})
+    with casatable(msfile) as tb:
+        selected = tb.query(f"FIELD_ID IN {fids}") if fids else tb
+        try:
+            times = selected.getcol('TIME') if selected.nrows() else np.zeros(0)
+        finally:
+            if fids:
+                selected.close()
+    nvis_row = md.nchan(0) * md.ncorr_for_pol(0)
+    unique = np.unique(times)
+    if unique.size == 0:
+        return {'memory_gb': BASE_MEMORY_GB, 'cpu_s': 0.0, 'nvis': 0}
+    inttime = float(np.median(np.diff(unique))) if unique.size > 1 else 1.0
+    seconds = solint_seconds(solint)
+    nint = 1 if seconds == 0 else unique.size if math.isinf(seconds) else \
+        min(unique.size, max(1, math.ceil(seconds / inttime)))
+    # Complex data and model, float weights and boolean flags per visibility
+    interval_bytes = times.size / unique.size * nint * nvis_row * 21
+    return {'memory_gb': BASE_MEMORY_GB + 1.2 * interval_bytes / 1024**3,
+            'cpu_s': times.size * nvis_row / SOLVE_VIS_PER_S, 'nvis': times.size * nvis_row}
+
+
+def under_mpi() -> bool:
+    """Check if this process is one of several mpicasa processes (tclean parallel=True)."""
+    size = os.environ.get('OMPI_COMM_WORLD_SIZE') or os.environ.get('PMI_SIZE')
+    if not size or int(size) < 2:
+        return False
+    try:
+        import casampi  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class ResourceGovernor:
+    """Sizes the worker pools and the tclean settings to the CPUs and memory of the node."""
+
+    def __init__(self, memory_fraction=0.8, threads=0, strict=False):
+        """Initialize the governor.
+
+        Args:
+            memory_fraction: Fraction of the available memory the pipeline plans to use
+            threads: Threads of a job running alone (0 for all the CPUs of the node)
+            strict: Fail a tclean call predicted not to fit in memory even with the
+                    lower-memory settings, instead of running it with a warning
+        """
+        self.memory_fraction = memory_fraction
+        self.threads = threads
+        self.strict = strict
+
+    def budget_gb(self) -> float:
+        """Get the memory the pipeline plans to use now (GB)."""
+        return self.memory_fraction * node_resources()['available_gb']
+
+    def set_threads(self):
+        """Set the thread count of this process (before CASA is imported), unless the
+        environment already sets it (e.g. gmrtbatch, to the CPUs of the run)."""
+        if os.environ.get('OMP_NUM_THREADS'):
+            logging.info(f"Resources: keeping OMP_NUM_THREADS={os.environ['OMP_NUM_THREADS']} "
+                         f"from the environment")
+            return int(os.environ['OMP_NUM_THREADS'])
+        threads = self.threads or node_resources()['cpus']
+        for var in THREAD_VARIABLES:
+            os.environ.setdefault(var, str(threads))
+        logging.info(f"Resources: {threads} threads (OMP_NUM_THREADS) for this process")
+        return threads
+
+    def plan_workers(self, label, workers, job_memory_gb) -> tuple:
+        """Choose how many jobs of `job_memory_gb` GB run at once, and their threads.
+
+        The workers are capped by the CPUs and by the memory budget; the CPUs are then
+        shared among them as threads.
+
+        Returns:
+            Tuple (workers, threads per worker).
+        """
+        node = node_resources()
+        budget = self.memory_fraction * node['available_gb']
+        fit = max(1, int(budget // job_memory_gb)) if job_memory_gb > 0 else workers
+        chosen = max(1, min(workers, node['cpus'], fit))
+        threads = max(1, (self.threads or node['cpus']) // chosen)
+        reason = ('memory' if fit < min(workers, node['cpus'])
+                  else 'CPUs' if node['cpus'] < workers else 'requested')
+        logging.info(f"Resources: {label}: {chosen} of {workers} workers ({reason}; "
+                     f"{job_memory_gb:.1f} GB predicted per job, {budget:.1f} GB budget, "
+                     f"{node['cpus']} CPUs), {threads} threads each")
+        if job_memory_gb > budget:
+            logging.warning(f"Resources: {label}: one job ({job_memory_gb:.1f} GB predicted) "
+                            f"exceeds the memory budget ({budget:.1f} GB)")
+        return chosen, threads
+
+    def govern_tclean(self, msfile, imagename, imsize, cell, nterms=1, wprojplanes=1, niter=0,
+                      scales=(0, 5, 15), plan=None) -> dict:
+        """Choose the tclean settings of a call that fit in the memory budget.
+
+        Returns:
+            Dictionary with the 'wprojplanes', 'scales' and 'parallel' to use.
+        """
+        settings = {'wprojplanes': int(wprojplanes), 'scales': list(scales),
+                    'parallel': under_mpi()}
+        predicted = predict_tclean(msfile, imsize, cell, nterms, wprojplanes, niter, len(scales),
+                                   plan=plan)
+        budget = self.budget_gb()
+        logging.info(f"Resources: tclean {imagename}: predicted {predicted['memory_gb']:.1f} GB "
+                     f"and {predicted['cpu_s']:.0f} CPU s ({predicted['nvis']:.3g} visibilities, "
+                     f"{imsize} pixels, {nterms} terms, {wprojplanes} w-planes), "
+                     f"budget {budget:.1f} GB")
+
+        if predicted['memory_gb'] > budget and settings['wprojplanes'] > 1:
+            minimum = min_wprojplanes(predicted['wmax_lambda'], int(imsize) * parse_angle(cell),
+                                      (plan or {}).get('w_phase_error', 0.5))
+            if minimum < settings['wprojplanes']:
+                settings['wprojplanes'] = minimum
+                predicted = predict_tclean(msfile, imsize, cell, nterms, minimum, niter,
+                                           len(scales), plan=plan)
+                logging.info(f"Resources: tclean {imagename}: reduced the w-planes from "
+                             f"{wprojplanes} to {minimum} (the fewest for the w-term accuracy), "
+                             f"predicted {predicted['memory_gb']:.1f} GB")
+        while predicted['memory_gb'] > budget and niter and len(settings['scales']) > 1:
+            dropped = settings['scales'].pop()
+            predicted = predict_tclean(msfile, imsize, cell, nterms, settings['wprojplanes'],
+                                       niter, len(settings['scales']), plan=plan)
+            logging.info(f"Resources: tclean {imagename}: dropped the multiscale scale "
+                         f"{dropped}, scales={settings['scales']}, "
+                         f"predicted {predicted['memory_gb']:.1f} GB")
+        if predicted['memory_gb'] > budget:
+            message = (f"tclean {imagename} is predicted to need {predicted['memory_gb']:.1f} GB "
+                       f"with the lower-memory settings, more than the {budget:.1f} GB budget; "
+                       f"reduce image_size, use_nterms or nwproj_pl")
+            if self.strict:
+                raise MemoryError(message)
+            logging.warning(f"Resources: {message} (running anyway, strict = false)")
+
+        logging.info(f"Resources: tclean {imagename}: parallel={settings['parallel']}"
+                     + ('' if settings['parallel'] else ' (not running under mpicasa)'))
+        return settings
+
+    def predict_solve(self, task, msfile, field='', solint='inf'):
+        """Log the predicted memory and CPU time of a calibration solve (see `predict_solve`)."""
+        predicted = predict_solve(msfile, field, solint)
+        budget = self.budget_gb()
+        logging.info(f"Resources: {task} on {msfile} (field '{field}', solint {solint}): "
+                     f"predicted {predicted['memory_gb']:.1f} GB and {predicted['cpu_s']:.0f} "
+                     f"CPU s ({predicted['nvis']:.3g} visibilities), budget {budget:.1f} GB")
+        if predicted['memory_gb'] > budget:
+            logging.warning(f"Resources: {task} on {msfile} is predicted to exceed the memory "
+                            f"budget ({predicted['memory_gb']:.1f} > {budget:.1f} GB)")
+        return predicted
+
+
+# Governor used by the pipeline (see `configure`)
+_default = ResourceGovernor()
+
+
+def configure(memory_fraction=0.8, threads=0, strict=False) -> ResourceGovernor:
+    """Set up the governor used by the pipeline (from the `[resources]` section)."""
+    global _default
+    _default = ResourceGovernor(memory_fraction, threads, strict)
+    return _default
+
+
+def governor() -> ResourceGovernor:
+    """Get the governor used by the pipeline."""
+    return _default
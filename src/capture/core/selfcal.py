@@ -0,0 +1,359 @@
+"""Self-calibration functions for CAPTURE pipeline."""
+
+import os
+import glob
+import json
+import shutil
+import logging
+from ..utils.lazy import casatasks as cts
+
+from ..utils.fingerprint import fingerprint
+from ..utils.ms_metadata import get_metadata
+from .calibration import apply_calibration, gain_phase_scatter, solution_quality
+from .imaging import clean_image, image_metrics
+from .parallel import process_pool, worker_count
+from .resources import governor, predict_tclean
+
+
+def solve_phase_gains(msfile, caltable, solint, ref_ant):
+    """Solve a phase-only gain table of a target against its model column."""
+    cts.gaincal(
+        vis=msfile,
+        caltable=caltable,
+        solint=solint,
+        refant=ref_ant,
+        gaintype='G',
+        calmode='p'
+    )
+    return caltable
+
+
+def solint_seconds(solint) -> float:
+    """Convert a gaincal solint ('int', '60s', '2min', 'inf'...) to seconds for sorting."""
+    solint = str(solint)
+    if solint == 'int':
+        return 0.0
+    if solint == 'inf':
+        return float('inf')
+    for unit, factor in (('min', 60.0), ('h', 3600.0), ('s', 1.0)):
+        if solint.endswith(unit):
+            return float(solint[:-len(unit)]) * factor
+    return float(solint)
+
+
+def search_solint(msfile, caltable, candidates, ref_ant, max_flagged=0.2, min_snr=5.0,
+                  workers=1, memory_gb=None):
+    """Solve the gains with several candidate solints at once and keep the best table.
+
+    Each candidate is solved into its own table (`{caltable}_{solint}`), concurrently in
+    a process pool if `workers` > 1. The concurrent solves share the MS, which is never
+    copied: gaincal only reads it (casacore's table locks let the processes read it at
+    the same time, and no HISTORY is written) and writes nothing but its own table. The
+    best candidate is the shortest solint whose median solution SNR is at least
+    `min_snr` and whose flagged fraction (solutions below the gaincal minsnr) is at most
+    `max_flagged`, as it follows the phases most closely with enough SNR; if none
+    qualifies, the one with the fewest flagged solutions (then the highest median SNR).
+    Its table is renamed to `caltable`.
+
+    Returns:
+        Tuple with the chosen solint and the quality of all the candidates.
+    """
+    candidates = sorted(candidates, key=solint_seconds)
+    tables = [f"{caltable}_{solint}" for solint in candidates]
+    for table in tables + [caltable]:
+        shutil.rmtree(table, ignore_errors=True)
+
+    n = len(candidates)
+    if workers > 1 and n > 1:
+        # The longest solint holds the most data at once
+        job_memory = governor().predict_solve('gaincal', msfile, solint=candidates[-1])['memory_gb']
+        workers, threads = governor().plan_workers(
+            f"solint search on {msfile}", worker_count(min(workers, n), memory_gb), job_memory)
+    if workers > 1 and n > 1:
+        with process_pool(workers, memory_gb, threads) as pool:
+            list(pool.map(solve_phase_gains, [msfile] * n, tables, candidates, [ref_ant] * n))
+    else:
+        for table, solint in zip(tables, candidates):
+            solve_phase_gains(msfile, table, solint, ref_ant)
+
+    quality = {solint: solution_quality(table) if os.path.isdir(table)
+               else {'snr': 0.0, 'flagged': 1.0}
+               for solint, table in zip(candidates, tables)}
+    for solint in candidates:
+        logging.info(f"  solint {solint}: median SNR {quality[solint]['snr']:.1f}, "
+                     f"{100*quality[solint]['flagged']:.1f}% flagged")
+
+    good = [solint for solint in candidates
+            if quality[solint]['flagged'] <= max_flagged and quality[solint]['snr'] >= min_snr]
+    best = good[0] if good else min(candidates, key=lambda x: (quality[x]['flagged'],
+                                                                -quality[x]['snr']))
+    logging.info(f"Best solint for {msfile}: {best}")
+    shutil.move(f"{caltable}_{best}", caltable)
+    return best, quality
+
+
+def _keep_model(imagename, keep):
+    """Copy the model and mask of an image (all Taylor terms) to `keep`, which replaces
+    `imagename` in their names, removing any earlier copy."""
+    _remove_model(keep)
+    for kind in ('model', 'mask'):
+        for path in glob.glob(f"{imagename}.{kind}") + glob.glob(f"{imagename}.{kind}.*"):
+            shutil.copytree(path, f"{keep}{path[len(imagename):]}")
+
+
+def _restore_model(keep, imagename):
+    """Replace the model and mask of an image with the ones kept by `_keep_model`."""
+    _remove_model(imagename)
+    _keep_model(keep, imagename)
+
+
+def _remove_model(imagename):
+    for kind in ('model', 'mask'):
+        for path in glob.glob(f"{imagename}.{kind}") + glob.glob(f"{imagename}.{kind}.*"):
+            shutil.rmtree(path)
+
+
+def _rank(metrics):
+    """Sort key of the loops by dynamic range, the undefined (NaN) ones last."""
+    return metrics['dynamic_range'] if metrics['dynamic_range'] == metrics['dynamic_range'] \
+        else float('-inf')
+
+
+def selfcal_loop(msfile, loops, solints, ref_ant, niter, threshold, cell, imsize, nterms=1,
+                 wprojplanes=1, robust=0.0, plan=None, min_improvement=None, report=None,
+                 solint_candidates=None, max_flagged=0.2, min_snr=5.0, search_workers=1,
+                 memory_gb=None):
+    """Run the phase-only self-calibration loop on a target MS.
+
+    A first clean image provides the model, then each loop solves a phase-only gain
+    table with the next solution interval, applies it and re-images. After every image
+    the peak, residual RMS and dynamic range (and the phase scatter of the new gain
+    solutions) are recorded. If `min_improvement` is given, the loop stops as soon as
+    the dynamic range improves by less than that fraction with respect to the previous
+    image, and the MS and the image are then reverted to the loop with the highest
+    dynamic range if that is not the last one: its gains are applied again and it is
+    re-imaged from its own model and mask (kept aside while it is the best loop, as every
+    clean continues from the previous one), and the report gives the metrics of that
+    final image.
+
+    Args:
+        report: JSON file for the per-loop metrics (`{msfile}.selfcal.json` by default)
+        solint_candidates: If given, every loop solves all these solints concurrently
+                           (with up to `search_workers` processes of `memory_gb` GB) and
+                           applies the best one (see `search_solint`) instead of taking
+                           the next one from `solints`
+
+    Returns:
+        The name of the last image.
+    """
+    imaging = dict(niter=niter, threshold=threshold, cell=cell, imsize=imsize, nterms=nterms,
+                   wprojplanes=wprojplanes, robust=robust, plan=plan)
+    report = report or f"{str(msfile).rstrip('/')}.selfcal.json"
+
+    # First create a clean image for model
+    imagename = clean_image(msfile=msfile, **imaging)
+    metrics = [{'loop': 0, 'solint': None, 'phase_scatter_deg': None,
+                **image_metrics(imagename, nterms)}]
+    # The model and mask of the best image so far, to revert to
+    keep = f"{imagename}.selfcal_best"
+    best = metrics[0]
+    if min_improvement is not None:
+        _keep_model(imagename, keep)
+    stop_reason = f"completed {loops} loops"
+
+    for loop in range(loops):
+        logging.info(f"Self-calibration loop {loop+1}/{loops} on {msfile}")
+
+        # Gain calibration on target itself
+        candidates = None
+        if solint_candidates:
+            solint, candidates = search_solint(msfile, f"{msfile}.selfcal_{loop}",
+                                               solint_candidates, ref_ant, max_flagged,
+                                               min_snr, search_workers, memory_gb)
+        else:
+            solint = solints[loop] if loop < len(solints) else 'inf'
+            solve_phase_gains(msfile, f"{msfile}.selfcal_{loop}", solint, ref_ant)
+
+        # Apply self-calibration
+        apply_calibration(
+            msfile=msfile,
+            field='0',
+            gaintables=[f"{msfile}.selfcal_{loop}"]
+        )
+
+        # Re-image
+        imagename = clean_image(msfile=msfile, **imaging)
+        metrics.append({'loop': loop + 1, 'solint': solint, 'solint_candidates': candidates,
+                        'phase_scatter_deg': gain_phase_scatter(f"{msfile}.selfcal_{loop}"),
+                        **image_metrics(imagename, nterms)})
+        previous, current = metrics[-2]['dynamic_range'], metrics[-1]['dynamic_range']
+        improvement = (current - previous) / previous if previous > 0 else float('inf')
+        metrics[-1]['improvement'] = improvement
+        logging.info(f"Loop {loop+1}: peak {metrics[-1]['peak']:.4g} Jy/beam, residual RMS "
+                     f"{metrics[-1]['residual_rms']:.4g} Jy/beam, dynamic range {current:.1f} "
+                     f"({100*improvement:+.1f}%), phase scatter "
+                     f"{metrics[-1]['phase_scatter_deg']:.1f} deg")
+        if min_improvement is not None and _rank(metrics[-1]) > _rank(best):
+            best = metrics[-1]
+            _keep_model(imagename, keep)
+
+        if min_improvement is not None and loop + 1 < loops and improvement < min_improvement:
+            stop_reason = (f"converged after {loop+1} loops: dynamic range improved by "
+                           f"{100*improvement:.1f}% < {100*min_improvement:.1f}%")
+            logging.info(f"Stopping self-calibration of {msfile}, {stop_reason}")
+            break
+
+    final = metrics[-1]
+    if min_improvement is not None and best is not metrics[-1]:
+        logging.info(f"Reverting {msfile} to self-calibration loop {best['loop']}, with the "
+                     f"highest dynamic range ({best['dynamic_range']:.1f} > "
+                     f"{metrics[-1]['dynamic_range']:.1f})")
+        if best['loop'] > 0:
+            apply_calibration(msfile=msfile, field='0',
+                              gaintables=[f"{msfile}.selfcal_{best['loop'] - 1}"])
+        else:
+            cts.clearcal(vis=msfile)
+        _restore_model(keep, imagename)
+        imagename = clean_image(msfile=msfile, **imaging)
+        final = {'loop': best['loop'], **image_metrics(imagename, nterms)}
+        logging.info(f"Reverted image: peak {final['peak']:.4g} Jy/beam, residual RMS "
+                     f"{final['residual_rms']:.4g} Jy/beam, dynamic range "
+                     f"{final['dynamic_range']:.1f}")
+    _remove_model(keep)
+
+    with open(report, 'w') as f:
+        json.dump({'msfile': str(msfile), 'image': imagename, 'min_improvement': min_improvement,
+                   'stop_reason': stop_reason, 'final_loop': final['loop'],
+                   'final': {key: final[key] for key in ('peak', 'residual_rms', 'dynamic_range')},
+                   'loops': metrics}, f, indent=2)
+    return imagename
+
+
+def subband_ranges(nchan, subband_chan):
+    """Get the (first, last) channels of each subband, the last one taking the remainder."""
+    subband_chan = max(1, min(subband_chan, nchan))
+    starts = list(range(0, nchan, subband_chan))
+    # Do not leave a subband much narrower than the others at the top of the band
+    if len(starts) > 1 and nchan - starts[-1] < subband_chan // 2:
+        starts.pop()
+    return [(first, (starts[i+1] if i+1 < len(starts) else nchan) - 1)
+            for i, first in enumerate(starts)]
+
+
+def _stale_product(path, record):
+    """Check if a subband product is missing or was made from other inputs than `record`
+    (as saved in `{path}.capture_subband.json` by `_record_product`), removing it if so."""
+    try:
+        with open(f"{path}.capture_subband.json") as f:
+            made = json.load(f)
+    except (OSError, ValueError):
+        made = None
+    if os.path.exists(path) and made == record:
+        return False
+    if os.path.exists(path):
+        logging.info(f"{path} was made from other data or settings, making it again")
+        shutil.rmtree(path)
+    return True
+
+
+def _record_product(path, record):
+    """Save the inputs a subband product was made from (see `_stale_product`)."""
+    with open(f"{path}.capture_subband.json", 'w') as f:
+        json.dump(record, f, indent=2)
+
+
+def split_subbands(msfile, subband_chan):
+    """Split an MS into subband MSs of `subband_chan` channels.
+
+    The subbands are written next to the MS as `{prefix}_sbNN.ms`, so that each one
+    gets its own image names (see `clean_image`). An existing subband is reused only if
+    it was split from the same MS (same fingerprint) with the same channels.
+
+    Returns:
+        List with the names of the subband MSs.
+    """
+    msfile = str(msfile).rstrip('/')
+    prefix = msfile.split('/')[-1].split('.')[0]
+    ranges = subband_ranges(get_metadata(msfile).nchan(0), subband_chan)
+    source = fingerprint(msfile)
+    subbands = []
+    for i, (first, last) in enumerate(ranges):
+        sbfile = os.path.join(os.path.dirname(msfile), f"{prefix}_sb{i:02d}.ms")
+        record = {'msfile': os.path.abspath(msfile), 'ms': source, 'channels': [first, last]}
+        if _stale_product(sbfile, record):
+            logging.info(f"Splitting subband {i} (channels {first}~{last}) to {sbfile}")
+            cts.mstransform(vis=msfile, outputvis=sbfile, spw=f"0:{first}~{last}",
+                            datacolumn='data')
+            _record_product(sbfile, record)
+        subbands.append(sbfile)
+    return subbands
+
+
+def _selfcal_subband(sbfile, selfcal_kwargs):
+    """Self-calibrate one subband and split its calibrated data for the recombination."""
+    imagename = selfcal_loop(msfile=sbfile, **selfcal_kwargs)
+    calfile = f"{sbfile[:-len('.ms')]}_cal.ms"
+    shutil.rmtree(calfile, ignore_errors=True)
+    cts.mstransform(vis=sbfile, outputvis=calfile,
+                    datacolumn='corrected' if selfcal_kwargs['loops'] > 0 else 'data')
+    return imagename, calfile
+
+
+def subband_selfcal(msfile, subband_chan, workers=4, memory_gb=None, **selfcal_kwargs):
+    """Self-calibrate each subband of a target MS in parallel and image the recombined band.
+
+    The MS is split into subbands of `subband_chan` channels (see `split_subbands`) and
+    the full `selfcal_loop` runs on each one in a separate worker process. The
+    self-calibrated subbands are then recombined (as one spectral window each) into
+    `{prefix}_subbands.ms`, and a final wideband image is made from it. The subband
+    splits are reused while the MS and the channels are the same (see `split_subbands`),
+    but the self-calibration, and so the calibrated splits and the recombined MS, are
+    made again on every call, so that stale subbands are never recombined.
+
+    Args:
+        msfile: Target MS
+        subband_chan: Channels per subband (in the channels of `msfile`)
+        workers: Maximum number of worker processes
+        memory_gb: Memory cap per worker in GB (None for no limit)
+        selfcal_kwargs: Parameters of `selfcal_loop`
+
+    Returns:
+        Tuple with the name of the recombined MS and of the final wideband image.
+    """
+    msfile = str(msfile).rstrip('/')
+    prefix = msfile.split('/')[-1].split('.')[0]
+    combined = os.path.join(os.path.dirname(msfile), f"{prefix}_subbands.ms")
+
+    subbands = split_subbands(msfile, subband_chan)
+    imaging = {key: selfcal_kwargs[key] for key in ('niter', 'threshold', 'cell', 'imsize',
+                                                    'nterms', 'wprojplanes', 'robust', 'plan')
+               if key in selfcal_kwargs}
+    # Every subband images at the same time, with the settings of the full band
+    job_memory = predict_tclean(subbands[0], imaging['imsize'], imaging['cell'],
+                                imaging.get('nterms', 1), imaging.get('wprojplanes', 1),
+                                imaging.get('niter', 0), plan=imaging.get('plan'))['memory_gb']
+    workers, threads = governor().plan_workers(
+        'subband self-calibration', worker_count(min(workers, len(subbands)), memory_gb),
+        job_memory)
+    logging.info(f"Self-calibrating {len(subbands)} subbands with {workers} workers")
+
+    with process_pool(workers, memory_gb, threads) as pool:
+        results = list(pool.map(_selfcal_subband, subbands, [selfcal_kwargs] * len(subbands)))
+
+    for sbfile, (imagename, _) in zip(subbands, results):
+        logging.info(f"Subband {sbfile} self-calibrated, last image: {imagename}")
+
+    # virtualconcat moves the calibrated subband splits into the recombined MS
+    calfiles = [calfile for _, calfile in results]
+    logging.info(f"Recombining {len(subbands)} subbands into {combined}")
+    shutil.rmtree(combined, ignore_errors=True)
+    if len(calfiles) == 1:
+        # virtualconcat needs at least two MSs
+        shutil.move(calfiles[0], combined)
+    else:
+        cts.virtualconcat(vis=calfiles, concatvis=combined, copypointing=False,
+                          keepcopy=False)
+
+    logging.info("Creating wideband image from the self-calibrated subbands")
+    imagename = clean_image(msfile=combined, **imaging)
+    return combined, imagename
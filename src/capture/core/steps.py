@@ -1,8 +1,9 @@
 """Pipeline step definitions for CAPTURE."""
 
 import logging
-from dataclasses import dataclass
-from typing import Callable, List
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, List, Union
 
 
 @dataclass
@@ -10,14 +11,15 @@ class PipelineStep:
     """Represents a single step in the pipeline."""
     name: str
     function: Callable
-    inputs: List[str]
-    outputs: List[str]
+    inputs: List[Union[str, Callable]]
+    outputs: List[Union[str, Callable]]
+    params: List[str] = field(default_factory=list)
     
     def get_input_paths(self, **config):
         """Get actual file paths for inputs based on configuration."""
         paths = []
         for inp in self.inputs:
-            path = inp.format(**config)
+            path = inp(config) if callable(inp) else inp.format(**config)
             paths.append(path)
         return paths
     
@@ -25,10 +27,14 @@ class PipelineStep:
         """Get actual file paths for outputs based on configuration."""
         paths = []
         for out in self.outputs:
-            path = out.format(**config)
+            path = out(config) if callable(out) else out.format(**config)
             paths.append(path)
         return paths
 
+    def get_params(self, **config):
+        """Get the resolved configuration parameters the step depends on."""
+        return {param: config.get(param) for param in self.params}
+
 
 def lta_to_fits_step(pipeline):
     """Convert LTA to FITS file."""
@@ -42,31 +48,60 @@ def fits_to_ms_step(pipeline):
 
 def initial_flagging_step(pipeline):
     """Perform initial flagging."""
-    from casatasks import flagdata
-    from ..utils.casa_tools import flagsummary
+    from ..core.flagging import FlagBatch
     
     msfile = pipeline.msfilename
     logging.info(f"Performing initial flagging on {msfile}")
+    flagbatch = FlagBatch(msfile)
     
     # Flag first channel
-    flagdata(vis=msfile, mode='manual', spw='0:0', action='apply')
+    flagbatch.add(mode='manual', spw='0:0')
     
     # Quack flagging
-    flagdata(vis=msfile, mode='quack', 
-            quackinterval=pipeline.setquackinterval,
-            quackmode='beg', action='apply')
-    flagdata(vis=msfile, mode='quack', 
-            quackinterval=pipeline.setquackinterval,
-            quackmode='endb', action='apply')
+    flagbatch.add(mode='quack', quackinterval=pipeline.setquackinterval, quackmode='beg')
+    flagbatch.add(mode='quack', quackinterval=pipeline.setquackinterval, quackmode='endb')
+    
+    # Single pass over the MS, including the flagging summary
+    flagbatch.apply(summary=True, runner=pipeline.runner)
+    Path(f"{msfile}.flagged").touch()
+
+
+def find_bad_antennas_step(pipeline):
+    """Find bad antennas and flag them if requested."""
+    from ..core.flagging import find_and_flag_bad_antennas
+    from ..utils.casa_tools import getfields
+    
+    msfile = pipeline.msfilename
+    logging.info(f"Finding bad antennas in {msfile}")
     
-    flagsummary(msfile)
+    fields = getfields(msfile)
+    stdcals = ['3C48', '3C147', '3C286', '0542+498', '1331+305', '0137+331']
+    calfields = [f for f in fields if f in stdcals] or None
+    
+    find_and_flag_bad_antennas(msfile, flag=pipeline.flagbadants, fields=calfields)
+
+
+def find_bad_channels_step(pipeline):
+    """Find bad channels and known RFI frequencies, and flag them."""
+    from ..core.flagging import find_and_flag_bad_channels
+    
+    msfile = pipeline.msfilename
+    logging.info(f"Finding bad channels in {msfile}")
+    
+    find_and_flag_bad_channels(
+        msfile,
+        find=pipeline.findbadchans,
+        rfi_ranges=pipeline.rfiranges if pipeline.flagbadfreq else None,
+        nsigma=pipeline.badchansigma,
+        flag=True
+    )
 
 
 def initial_calibration_step(pipeline):
     """Perform initial calibration."""
-    from ..core.calibration import initial_calibration, gain_calibration, apply_calibration
+    from ..core.calibration import (initial_calibration, gain_calibration_batch, flux_scale,
+                                    apply_calibration_batch)
     from ..utils.casa_tools import getfields
-    from casatasks import fluxscale
     
     msfile = pipeline.msfilename
     logging.info(f"Performing initial calibration on {msfile}")
@@ -97,51 +132,59 @@ def initial_calibration_step(pipeline):
         mycalsuffix=''
     )
     
-    # Gain calibration on all calibrators
+    # Gain calibration on all calibrators (single gaincal pass)
     mycals = myampcals + mypcals
-    for idx, cal in enumerate(mycals):
-        gain_calibration(
-            msfile=msfile,
-            mycal=cal,
-            ref_ant=pipeline.ref_ant,
-            gainspw=flagspw,
-            uvrange='',
-            mycalsuffix='',
-            append=(idx > 0)
-        )
+    gain_calibration_batch(
+        msfile=msfile,
+        mycals=mycals,
+        ref_ant=pipeline.ref_ant,
+        gainspw=flagspw,
+        uvrange='',
+        mycalsuffix=''
+    )
     
     # Flux scale calibration
-    fluxscale(
-        vis=msfile,
+    flux_scale(
+        msfile=msfile,
         caltable=f"{msfile}.AP.G",
         fluxtable=f"{msfile}.fluxscale",
-        reference=myampcals[0] if myampcals else '',
-        incremental=False
+        reference=myampcals[0] if myampcals else ''
     )
     
-    # Apply calibration to all fields
+    # Apply calibration to all fields (single applycal pass)
     gaintables = [gntable, bptable, f"{msfile}.fluxscale"]
-    for field in fields:
-        apply_calibration(
-            msfile=msfile,
-            field=field,
-            gaintables=gaintables
-        )
+    apply_calibration_batch(
+        msfile=msfile,
+        fields=fields,
+        gaintables=gaintables,
+        runner=pipeline.runner
+    )
+
+
+def _image_ms(config):
+    """Get the MS the dirty image is made from: the averaged split if averaged."""
+    dosplitavg = config['chanavg'] > 1 or bool(config['timeavg'])
+    return config['splitavgfilename'] if dosplitavg else config['splitfilename']
+
+
+def _dirty_image_fits(config):
+    """Get the FITS file `make_dirty_image` exports for the imaged MS."""
+    from ..core.imaging import dirty_image_name
+    return f"{dirty_image_name(_image_ms(config))}.fits"
 
 
 def make_dirty_image_step(pipeline):
     """Create dirty image."""
     from ..core.imaging import make_dirty_image
     
-    image_ms = pipeline.splitavgfilename if pipeline.chanavg > 1 else pipeline.splitfilename
-    
     make_dirty_image(
-        msfile=image_ms,
+        msfile=_image_ms(vars(pipeline)),
         cell=pipeline.imcellsize[0],
         imsize=pipeline.imsize_pix,
         nterms=pipeline.use_nterms,
         wprojplanes=pipeline.nwprojpl,
-        robust=pipeline.clean_robust
+        robust=pipeline.clean_robust,
+        plan=pipeline.imaging_plan
     )
 
 
@@ -151,7 +194,8 @@ PIPELINE_STEPS = {
         name='lta_to_fits',
         function=lta_to_fits_step,
         inputs=['{ltafile}'],
-        outputs=['{fits_file}']
+        outputs=['{fits_file}'],
+        params=['gvbinpath']
     ),
     'fits_to_ms': PipelineStep(
         name='fits_to_ms',
@@ -163,18 +207,36 @@ PIPELINE_STEPS = {
         name='initial_flagging',
         function=initial_flagging_step,
         inputs=['{msfilename}'],
-        outputs=['{msfilename}.flagged']
+        outputs=['{msfilename}.flagged'],
+        params=['setquackinterval']
+    ),
+    'find_bad_antennas': PipelineStep(
+        name='find_bad_antennas',
+        function=find_bad_antennas_step,
+        inputs=['{msfilename}', '{msfilename}.flagged'],
+        outputs=['{msfilename}.badants.txt'],
+        params=['flagbadants']
+    ),
+    'find_bad_channels': PipelineStep(
+        name='find_bad_channels',
+        function=find_bad_channels_step,
+        inputs=['{msfilename}', '{msfilename}.flagged'],
+        outputs=['{msfilename}.badchans.txt'],
+        params=['findbadchans', 'flagbadfreq', 'rfiranges', 'badchansigma']
     ),
     'initial_calibration': PipelineStep(
         name='initial_calibration',
         function=initial_calibration_step,
         inputs=['{msfilename}'],
-        outputs=['{msfilename}.K1', '{msfilename}.B1', '{msfilename}.AP.G', '{msfilename}.fluxscale']
+        outputs=['{msfilename}.K1', '{msfilename}.B1', '{msfilename}.AP.G', '{msfilename}.fluxscale'],
+        params=['ref_ant']
     ),
     'make_dirty_image': PipelineStep(
         name='make_dirty_image',
         function=make_dirty_image_step,
-        inputs=['{splitfilename}'],
-        outputs=['{splitfilename}-dirty-img.fits']
+        inputs=[_image_ms],
+        outputs=[_dirty_image_fits],
+        params=['chanavg', 'timeavg', 'imcellsize', 'imsize_pix', 'use_nterms', 'nwprojpl', 'clean_robust',
+                'imaging_plan']
     )
 }
@@ -0,0 +1,238 @@
+"""Multi-target processing for CAPTURE pipeline.
+
+Snapshot observations have many science targets, while steps 8-11 of
+`run_pipeline` only process the first one. In the multi-target mode
+(`[processing] multi_target = true`) every non-calibrator field is extracted
+into its own MS and averaged, imaged and self-calibrated in a pool of worker
+processes. Each target runs in its own working directory (`{targets_dir}/{field}`),
+which holds its MSs, images, log and pipeline state, so an interrupted run only
+redoes the unfinished steps of the unfinished targets.
+"""
+
+import os
+import re
+import time
+import logging
+from concurrent.futures import as_completed
+
+from .parallel import process_pool, worker_count
+from .resources import configure, governor, predict_tclean
+from ..utils.casa_tools import getfields
+
+# Flux/bandpass calibrators, never processed as targets
+STANDARD_CALIBRATORS = ['3C48', '3C147', '3C286', '0542+498', '1331+305', '0137+331']
+
+
+def target_fields(msfile, calibrators=STANDARD_CALIBRATORS) -> list:
+    """Get the fields of an MS that are not calibrators."""
+    return [field for field in getfields(msfile) if field not in calibrators]
+
+
+def target_name(field) -> str:
+    """Get a name for the directory and files of a target, without the characters that
+    cannot be used in file names or that the image names are cut at ('.')."""
+    return re.sub(r'[^A-Za-z0-9+_-]', '_', field)
+
+
+def target_options(pipeline) -> dict:
+    """Collect the configuration the per-target processing needs from a `Pipeline`.
+
+    Returns a plain dictionary, which can be sent to the worker processes.
+    """
+    return {
+        'chanavg': pipeline.chanavg, 'timeavg': pipeline.timeavg,
+        'keepsplit': pipeline.keepsplit, 'bdatolerance': pipeline.bdatolerance,
+        'bdamaxinterval': pipeline.bdamaxinterval, 'makedirty': pipeline.makedirty,
+        'doselfcal': pipeline.doselfcal, 'dosubbandselfcal': pipeline.dosubbandselfcal,
+        'subbandchan': pipeline.subbandchan, 'memory_gb': pipeline.workermemory,
+        'resources': (governor().memory_fraction, governor().threads, governor().strict),
+        'cache': (os.path.abspath(pipeline.cachedir), pipeline.cachesize, pipeline.cacheage,
+                  pipeline.usecache, pipeline.cachedigest),
+        'imaging': dict(cell=pipeline.imcellsize[0], imsize=pipeline.imsize_pix,
+                        nterms=pipeline.use_nterms, wprojplanes=pipeline.nwprojpl,
+                        robust=pipeline.clean_robust, plan=pipeline.imaging_plan),
+        'selfcal': dict(loops=pipeline.scaloops, solints=pipeline.scalsolints,
+                        min_improvement=pipeline.scalminimprovement,
+                        solint_candidates=pipeline.scalsolintcands
+                        if pipeline.scalsolintsearch else None,
+                        max_flagged=pipeline.scalmaxflagged, min_snr=pipeline.scalminsnr,
+                        ref_ant=pipeline.ref_ant, niter=pipeline.niter_start,
+                        threshold=f"{pipeline.mJythreshold}mJy"),
+    }
+
+
+def _run_step(state, name, function, inputs, outputs, params):
+    """Run a step of a target unless its inputs, outputs and parameters are unchanged."""
+    if not state.check_step_needed(name, inputs, outputs, params):
+        logging.info(f"Skipping step {name} - inputs, outputs and parameters unchanged")
+        return False
+    logging.info(f"Running step {name}")
+    before = state.snapshot(inputs + outputs)
+    start = time.perf_counter()
+    try:
+        function()
+    except Exception as e:
+        state.mark_step_failed(name, e, params=params, wall_s=time.perf_counter() - start)
+        raise
+    # Keep the earlier steps valid after in-place changes (e.g. the model column)
+    state.mark_step_complete(name, outputs, inputs=inputs, params=params,
+                             wall_s=time.perf_counter() - start)
+    state.adopt_changes(name, before)
+    return True
+
+
+def process_target(msfile, field, workdir, options, workers=1) -> dict:
+    """Extract, average, image and self-calibrate one target in its working directory.
+
+    Runs in a worker process: the working directory becomes the current directory (the
+    images are written there) and gets its own log file and pipeline state.
+
+    Args:
+        msfile: Calibrated MS (absolute path)
+        field: Target field
+        workdir: Working directory of the target
+        options: Configuration from `target_options`
+        workers: Worker processes the target can use itself (subbands, solint search)
+
+    Returns:
+        Dictionary with the target, its working directory, the MS it imaged, whether
+        each step ran (False if skipped as up to date) and the wall time.
+    """
+    from .extract import extract_target
+    from .bda import bda_average, field_radius
+    from .imaging import make_dirty_image, dirty_image_name
+    from .selfcal import selfcal_loop, subband_selfcal
+    from ..utils import task_cache
+    from ..utils.pipeline_state import PipelineState
+
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    handler = logging.FileHandler('capture.log')
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s',
+                                           datefmt='%Y-%m-%d %H:%M:%S'))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    task_cache.configure(*options['cache'][:3], enabled=options['cache'][3],
+                         data_digest=options['cache'][4])
+    configure(*options['resources'])
+    state = PipelineState()
+    started = time.perf_counter()
+    ran = {}
+
+    try:
+        name = target_name(field)
+        imaging = options['imaging']
+        chanavg, timeavg = options['chanavg'], options['timeavg']
+        averaged = chanavg > 1 or bool(timeavg)
+        splitfile = f"{name}.split.ms"
+        image_ms = f"{name}.avg.ms" if averaged else splitfile
+        logging.info(f"Processing target {field} from {msfile} in {workdir}")
+
+        ran['extract_target'] = _run_step(
+            state, 'extract_target',
+            lambda: extract_target(msfile, field, outputvis=image_ms, splitvis=splitfile,
+                                   chanbin=chanavg, timebin=timeavg,
+                                   keep_split=options['keepsplit']),
+            [msfile], [image_ms], {'chanavg': chanavg, 'timeavg': timeavg,
+                                   'keepsplit': options['keepsplit']})
+
+        if options['bdatolerance']:
+            bdafile = f"{image_ms}.bda"
+            params = {'bdatolerance': options['bdatolerance'],
+                      'bdamaxinterval': options['bdamaxinterval'], **imaging}
+            ran['bda_average'] = _run_step(
+                state, 'bda_average',
+                lambda: bda_average(image_ms, bdafile, options['bdatolerance'],
+                                    field_radius(image_ms, imaging['cell'], imaging['imsize'],
+                                                 plan=imaging['plan']),
+                                    options['bdamaxinterval']),
+                [image_ms], [bdafile], params)
+            image_ms = bdafile
+
+        if options['makedirty']:
+            ran['make_dirty_image'] = _run_step(
+                state, 'make_dirty_image', lambda: make_dirty_image(msfile=image_ms, **imaging),
+                [image_ms], [f"{dirty_image_name(image_ms)}.fits"], imaging)
+
+        if options['doselfcal']:
+            selfcal = {**options['selfcal'], **imaging}
+            if options['dosubbandselfcal']:
+                # subband_chan is given in channels of the unaveraged data
+                subband_chan = max(1, options['subbandchan'] // chanavg)
+                run = lambda: subband_selfcal(msfile=image_ms, subband_chan=subband_chan,
+                                              workers=workers, memory_gb=options['memory_gb'],
+                                              **selfcal)
+                outputs = [f"{name}_subbands.ms"]
+            else:
+                run = lambda: selfcal_loop(msfile=image_ms, search_workers=workers,
+                                           memory_gb=options['memory_gb'], **selfcal)
+                outputs = [f"{image_ms}.selfcal.json"]
+            ran['selfcal'] = _run_step(state, 'selfcal', run, [image_ms], outputs,
+                                       {**selfcal, 'subband': options['dosubbandselfcal'],
+                                        'subbandchan': options['subbandchan']})
+
+        state.finish_run('done')
+        logging.info(f"Target {field} completed")
+        return {'field': field, 'workdir': workdir, 'image_ms': image_ms, 'ran': ran,
+                'wall_s': time.perf_counter() - started}
+    except Exception:
+        state.finish_run('failed')
+        raise
+    finally:
+        state.close()
+        root.removeHandler(handler)
+        handler.close()
+
+
+def process_targets(msfile, fields, options, targets_dir='targets', workers=4,
+                    memory_gb=None) -> dict:
+    """Process several targets in parallel, each one with `process_target`.
+
+    The number of worker processes is limited by the CPUs and memory of the node (see
+    `worker_count`), and the workers left over are shared by the targets for their own
+    parallel stages. A failed target is logged and does not stop the others.
+
+    Returns:
+        Dictionary mapping each field to the result of `process_target`, or to a
+        dictionary with the 'error' if it failed.
+    """
+    from .extract import good_channel_range
+
+    msfile = os.path.abspath(str(msfile).rstrip('/'))
+    # Compute the metadata and flagging statistics of the MS once, in the sidecar files
+    # the workers then read
+    for field in fields:
+        good_channel_range(msfile, field)
+
+    # Every target images at the same time (the MS gives the uv-coverage of the array)
+    imaging = options['imaging']
+    job_memory = predict_tclean(msfile, imaging['imsize'], imaging['cell'], imaging['nterms'],
+                                imaging['wprojplanes'], options['selfcal']['niter'],
+                                plan=imaging['plan'])['memory_gb']
+    pool_workers, threads = governor().plan_workers(
+        'targets', worker_count(min(workers, len(fields)), memory_gb), job_memory)
+    per_target = max(1, workers // pool_workers)
+    logging.info(f"Processing {len(fields)} targets with {pool_workers} workers "
+                 f"({per_target} worker(s) each for their subbands/solint search): "
+                 f"{', '.join(fields)}")
+
+    results = {}
+    with process_pool(pool_workers, memory_gb, threads) as pool:
+        futures = {pool.submit(process_target, msfile, field,
+                               os.path.abspath(os.path.join(targets_dir, target_name(field))),
+                               options, per_target): field for field in fields}
+        for future in as_completed(futures):
+            field = futures[future]
+            try:
+                results[field] = future.result()
+                logging.info(f"Target {field} done in {results[field]['wall_s']:.0f} s "
+                             f"({results[field]['workdir']})")
+            except Exception as e:
+                results[field] = {'field': field, 'error': f"{type(e).__name__}: {e}"}
+                logging.error(f"Target {field} failed: {results[field]['error']}")
+
+    failed = [field for field, result in results.items() if 'error' in result]
+    logging.info(f"{len(fields) - len(failed)}/{len(fields)} targets processed"
+                 + (f", failed: {', '.join(failed)}" if failed else ''))
+    return results
@@ -26,6 +26,17 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('--working-dir', type=str, default=os.getcwd(),
                         help='Working directory where data files are located')
     parser.add_argument('--version', action='store_true', help='Show version information and exit')
+    parser.add_argument('--profile-report', type=str, default='capture_profile',
+                        help='Prefix of the JSON/CSV report with the time, CPU, memory and I/O '
+                             'of each step and CASA task')
+    parser.add_argument('--plan', action='store_true',
+                        help='Only print which steps the step path (Pipeline.run_pipeline and '
+                             'the Snakefile) would run or skip as up to date, from the '
+                             'configuration and the pipeline state, and exit without importing '
+                             'CASA. A normal run of this command runs every configured step')
+    parser.add_argument('--cprofile', type=str, default=None, metavar='DIR',
+                        help='Also profile the Python code of each step with cProfile, '
+                             'writing the stats to DIR/<step>.prof')
     return parser.parse_args()
 
 
@@ -52,7 +63,25 @@ def validate_config(config_path):
         sys.exit(1)
     return config_path
 
-def run_pipeline(input_file: str, working_dir: str | None = None, debug: bool = False, show_version: bool = False):
+def plan_pipeline(input_path):
+    """Print which steps of the step path would run and why, without importing CASA.
+
+    The plan is the one of `Pipeline.run_pipeline` (and of the Snakefile), which skips
+    the steps that are up to date. `run_pipeline` here does not check the pipeline
+    state: it runs every configured step.
+    """
+    from .core.pipeline import Pipeline
+    pipeline = Pipeline(str(input_path), log=False)
+    print("Plan of the step path (Pipeline.run_pipeline / Snakefile), which skips the steps "
+          "that are up to date.")
+    print("Note: a run of this command without --plan runs every configured step.")
+    for name, reason in pipeline.plan():
+        print(f"{name:<22} {'run: ' + reason if reason else 'skip: up to date'}")
+
+
+def run_pipeline(input_file: str, working_dir: str | None = None, debug: bool = False, show_version: bool = False,
+                 profile_report: str = 'capture_profile', cprofile_dir: str | None = None,
+                 plan: bool = False):
     """Main entry point for the pipeline - runs all steps in sequence.
     """
     if show_version:
@@ -69,16 +98,31 @@ def run_pipeline(input_file: str, working_dir: str | None = None, debug: bool =
         
     input_path = validate_config(input_file)
     logging.info(f"Using configuration file: {input_path}")
+    if plan:
+        plan_pipeline(input_path)
+        return
     
+    pipeline = None
     try:
         from .core.pipeline import Pipeline
-        from .core.calibration import initial_calibration, gain_calibration, apply_calibration
-        from .core.imaging import make_dirty_image, clean_image
+        from .core.calibration import (initial_calibration, gain_calibration_batch,
+                                       flux_scale, apply_calibration_batch)
+        from .core.extract import extract_target
+        from .core.bda import bda_average, field_radius
+        from .core.targets import target_fields, target_options, process_targets
+        from .core import resources
+        from .core.imaging import make_dirty_image
+        from .core.selfcal import selfcal_loop, subband_selfcal
+        from .core.flagging import FlagBatch, find_and_flag_bad_antennas, find_and_flag_bad_channels
         from .utils.casa_tools import getfields, flagsummary
-        from casatasks import flagdata, gaincal, fluxscale, mstransform
         
-        # Initialize pipeline
+        # Initialize pipeline, measuring each step and every CASA task call
         pipeline = Pipeline(str(input_path))
+        pipeline.profiler.cprofile_dir = cprofile_dir
+        # Thread count of this process, before CASA is imported
+        resources.governor().set_threads()
+        pipeline.profiler.instrument_casatasks()
+        from casatasks import mstransform
         logging.info("="*85)
         logging.info("Starting CAPTURE Pipeline Execution")
         logging.info("="*85)
@@ -86,46 +130,92 @@ def run_pipeline(input_file: str, working_dir: str | None = None, debug: bool =
         # Step 1: Convert LTA to FITS (if needed)
         if pipeline.fromlta:
             logging.info("Step 1: Converting LTA to FITS")
+            pipeline.profiler.start_step('lta_to_fits')
             pipeline.process_lta()
             logging.info(f"FITS file created: {pipeline.fits_file}")
         
         # Step 2: Import FITS to MS (if needed)
         if pipeline.fromfits:
             logging.info("Step 2: Importing FITS to MS")
+            pipeline.profiler.start_step('fits_to_ms')
             pipeline.process_fits()
             logging.info(f"MS file created: {pipeline.msfilename}")
         
+        # Partitioned mode: continue on a Multi-MS, with the per-partition work in parallel
+        if pipeline.partitioned:
+            logging.info("Partitioning the MS for parallel processing")
+            pipeline.use_partitions()
+        
         msfile = pipeline.msfilename
         
-        # Step 3: Initial flagging
+        searches = pipeline.findbadants or pipeline.flagbadants or pipeline.findbadchans \
+            or pipeline.flagbadfreq
+        
+        # Step 3: Initial flagging, in a single pass
         if pipeline.flaginit:
             logging.info("Step 3: Performing initial flagging")
+            pipeline.profiler.start_step('initial_flagging')
+            flagbatch = FlagBatch(msfile)
             
             # Flag first channel
-            flagdata(vis=msfile, mode='manual', spw='0:0', action='apply')
-            logging.info("Flagged first channel")
+            flagbatch.add(mode='manual', spw='0:0')
             
             # Quack flagging
-            flagdata(vis=msfile, mode='quack', 
-                    quackinterval=pipeline.setquackinterval,
-                    quackmode='beg', action='apply')
-            flagdata(vis=msfile, mode='quack', 
-                    quackinterval=pipeline.setquackinterval,
-                    quackmode='endb', action='apply')
-            logging.info(f"Quack flagging applied: {pipeline.setquackinterval}s")
+            flagbatch.add(mode='quack', quackinterval=pipeline.setquackinterval,
+                          quackmode='beg')
+            flagbatch.add(mode='quack', quackinterval=pipeline.setquackinterval,
+                          quackmode='endb')
             
-            flagsummary(msfile)
+            # Applied before the bad antenna/channel searches, which must not see the
+            # data these flag (the summary is computed after the searches if they run)
+            flagbatch.apply(summary=not searches, runner=pipeline.runner)
+            logging.info("Flagged first channel")
+            logging.info(f"Quack flagging applied: {pipeline.setquackinterval}s")
+            logging.info("Initial flagging completed")
+        
+        # Steps 4 and 4b: the flag commands of the bad antenna/channel searches are
+        # collected and applied in a single pass
+        flagbatch = FlagBatch(msfile)
         
         # Step 4: Find and flag bad antennas (if needed)
         if pipeline.findbadants or pipeline.flagbadants:
             logging.info("Step 4: Finding/flagging bad antennas")
-            # Placeholder for bad antenna detection
-            # This would need full implementation based on original code
-            logging.info("Bad antenna detection/flagging completed")
+            pipeline.profiler.start_step('find_bad_antennas')
+            
+            # Check the scans of the standard calibrators (all scans if there are none)
+            fields = getfields(msfile)
+            stdcals = ['3C48', '3C147', '3C286', '0542+498', '1331+305', '0137+331']
+            calfields = [f for f in fields if f in stdcals] or None
+            
+            find_and_flag_bad_antennas(msfile, flag=pipeline.flagbadants, fields=calfields,
+                                       batch=flagbatch)
+        
+        # Step 4b: Find and flag bad channels and known RFI frequencies (if needed)
+        if pipeline.findbadchans or pipeline.flagbadfreq:
+            logging.info("Step 4b: Finding/flagging bad channels")
+            pipeline.profiler.start_step('find_bad_channels')
+            
+            find_and_flag_bad_channels(
+                msfile,
+                find=pipeline.findbadchans,
+                rfi_ranges=pipeline.rfiranges if pipeline.flagbadfreq else None,
+                nsigma=pipeline.badchansigma,
+                flag=True,
+                batch=flagbatch
+            )
+            logging.info(f"Bad channel flags written to {msfile}.badchans.txt")
+        
+        if len(flagbatch) > 0:
+            pipeline.profiler.start_step('apply_flags')
+            flagbatch.apply(summary=True, runner=pipeline.runner)
+            logging.info("Bad antenna/channel flags applied")
+        elif searches and pipeline.flaginit:
+            flagsummary(msfile, jsonfile=f"{msfile}.flagstats.json")
         
         # Step 5: Initial calibration
         if pipeline.doinitcal:
             logging.info("Step 5: Performing initial calibration")
+            pipeline.profiler.start_step('initial_calibration')
             
             # Get field information
             fields = getfields(msfile)
@@ -158,58 +248,58 @@ def run_pipeline(input_file: str, working_dir: str | None = None, debug: bool =
                 mycalsuffix=''
             )
             
-            # Gain calibration on all calibrators
+            # Gain calibration on all calibrators (single gaincal pass)
             mycals = myampcals + mypcals
-            for idx, cal in enumerate(mycals):
-                logging.info(f"Gain calibration for {cal}")
-                gain_calibration(
-                    msfile=msfile,
-                    mycal=cal,
-                    ref_ant=pipeline.ref_ant,
-                    gainspw=flagspw,
-                    uvrange='',
-                    mycalsuffix='',
-                    append=(idx > 0)
-                )
+            gain_calibration_batch(
+                msfile=msfile,
+                mycals=mycals,
+                ref_ant=pipeline.ref_ant,
+                gainspw=flagspw,
+                uvrange='',
+                mycalsuffix=''
+            )
             
             # Flux scale calibration
             logging.info("Computing flux scale")
-            fluxscale(
-                vis=msfile,
+            flux_scale(
+                msfile=msfile,
                 caltable=f"{msfile}.AP.G",
                 fluxtable=f"{msfile}.fluxscale",
-                reference=myampcals[0] if myampcals else '',
-                incremental=False
+                reference=myampcals[0] if myampcals else ''
             )
             
-            # Apply calibration to all fields
+            # Apply calibration to all fields (single applycal pass)
             logging.info("Applying calibration to all fields")
             gaintables = [gntable, bptable, f"{msfile}.fluxscale"]
-            for field in fields:
-                apply_calibration(
-                    msfile=msfile,
-                    field=field,
-                    gaintables=gaintables
-                )
+            apply_calibration_batch(
+                msfile=msfile,
+                fields=fields,
+                gaintables=gaintables,
+                runner=pipeline.runner
+            )
             
             logging.info("Initial calibration completed")
-            flagsummary(msfile)
+            flagsummary(msfile, jsonfile=f"{msfile}.flagstats.json")
         
         # Step 6: Post-calibration flagging
         if pipeline.doflag:
             logging.info("Step 6: Post-calibration flagging")
+            pipeline.profiler.start_step('post_calibration_flagging')
             
-            # Clip flagging on calibrated data
+            # Clip flagging on calibrated data (summary computed in the same pass)
             if pipeline.clipfluxcal:
-                flagdata(vis=msfile, mode="clip", datacolumn="corrected",
-                        clipminmax=pipeline.clipfluxcal, action="apply")
+                flagbatch = FlagBatch(msfile)
+                flagbatch.add(mode='clip', datacolumn='corrected',
+                              clipminmax=pipeline.clipfluxcal)
+                flagbatch.apply(summary=True, runner=pipeline.runner)
                 logging.info(f"Clip flagging applied: {pipeline.clipfluxcal}")
-            
-            flagsummary(msfile)
+            else:
+                flagsummary(msfile, jsonfile=f"{msfile}.flagstats.json")
         
         # Step 7: Recalibration (if needed)
         if pipeline.redocal:
             logging.info("Step 7: Performing recalibration")
+            pipeline.profiler.start_step('recalibration')
             
             # Re-run calibration with 'recal' suffix
             fields = getfields(msfile)
@@ -228,133 +318,197 @@ def run_pipeline(input_file: str, working_dir: str | None = None, debug: bool =
             
             logging.info("Recalibration completed")
         
-        # Step 8: Split target data
-        if pipeline.target:
-            # Get all fields and identify target (non-calibrator fields)
-            fields = getfields(msfile)
-            stdcals = ['3C48', '3C147', '3C286', '0542+498', '1331+305', '0137+331']
-            target_fields = [f for f in fields if f not in stdcals]
-            target_field = target_fields[0] if target_fields else fields[-1]
-            
-            logging.info(f"Step 8: Splitting target data (field: {target_field})")
-            
-            # Set default split filename if not specified
-            if not pipeline.splitfilename:
-                pipeline.splitfilename = f"{msfile}.split.ms"
-            
-            if not os.path.exists(pipeline.splitfilename):
-                mstransform(
-                    vis=msfile,
-                    outputvis=pipeline.splitfilename,
-                    field=target_field,
-                    datacolumn='corrected',
-                    keepflags=False
-                )
-                logging.info(f"Target data split to: {pipeline.splitfilename}")
+        if pipeline.target and pipeline.multitarget:
+            # Steps 8-11 for every target field, in parallel
+            fields = target_fields(msfile)
+            logging.info(f"Steps 8-11: Processing {len(fields)} target fields in parallel")
+            pipeline.profiler.start_step('targets')
+            if pipeline.runner is not None:
+                pipeline.runner.close()
+            
+            results = process_targets(
+                msfile=msfile,
+                fields=fields,
+                options=target_options(pipeline),
+                targets_dir=pipeline.targetsdir,
+                workers=pipeline.nworkers,
+                memory_gb=pipeline.workermemory
+            )
+            failed = [field for field, result in results.items() if 'error' in result]
+            if failed:
+                raise RuntimeError(f"Processing of targets {', '.join(failed)} failed "
+                                   f"(see their logs in {pipeline.targetsdir})")
         else:
-            logging.info("Step 8: Skipping target split (not configured)")
-            pipeline.splitfilename = msfile
+            # Step 8: Extract the target data, averaged in the same pass (if needed)
+            dosplitavg = pipeline.chanavg > 1 or bool(pipeline.timeavg)
+            if pipeline.target:
+                # Get all fields and identify target (non-calibrator fields)
+                fields = getfields(msfile)
+                targets = target_fields(msfile)
+                target_field = targets[0] if targets else fields[-1]
+            
+                logging.info(f"Step 8: Extracting target data (field: {target_field})")
+                pipeline.profiler.start_step('split_target')
+            
+                # Set default split filenames if not specified
+                if not pipeline.splitfilename:
+                    pipeline.splitfilename = f"{msfile}.split.ms"
+                if not dosplitavg:
+                    pipeline.splitavgfilename = pipeline.splitfilename
+                elif not pipeline.splitavgfilename:
+                    pipeline.splitavgfilename = f"{pipeline.splitfilename}.avg"
+            
+                # The full-resolution split is only written if it is kept (or not averaged)
+                if not os.path.exists(pipeline.splitavgfilename):
+                    extract_target(
+                        msfile=msfile,
+                        field=target_field,
+                        outputvis=pipeline.splitavgfilename,
+                        splitvis=pipeline.splitfilename,
+                        chanbin=pipeline.chanavg,
+                        timebin=pipeline.timeavg,
+                        keep_split=pipeline.keepsplit,
+                        runner=pipeline.runner
+                    )
+                    logging.info(f"Target data extracted to: {pipeline.splitavgfilename}")
+            else:
+                logging.info("Step 8: Skipping target split (not configured)")
+                pipeline.splitfilename = msfile
         
-        # Step 9: Average split data (if needed)
-        dosplitavg = pipeline.chanavg > 1
-        if dosplitavg:
-            logging.info(f"Step 9: Averaging data (chanavg={pipeline.chanavg})")
-            
-            # Set default averaged filename if not specified
-            if not pipeline.splitavgfilename:
-                pipeline.splitavgfilename = f"{pipeline.splitfilename}.avg"
-            
-            if not os.path.exists(pipeline.splitavgfilename):
-                mstransform(
-                    vis=pipeline.splitfilename,
-                    outputvis=pipeline.splitavgfilename,
-                    chanaverage=True,
-                    chanbin=pipeline.chanavg,
-                    datacolumn='data'
-                )
-                logging.info(f"Averaged data saved to: {pipeline.splitavgfilename}")
-        else:
-            logging.info("Step 9: Skipping averaging (chanavg=1)")
-            pipeline.splitavgfilename = pipeline.splitfilename
+            # The remaining steps work on the split data, release the partition workers
+            if pipeline.runner is not None:
+                pipeline.runner.close()
         
-        # Step 10: Make dirty image (if needed)
-        if pipeline.makedirty:
-            logging.info("Step 10: Creating dirty image")
-            
-            image_ms = pipeline.splitavgfilename if dosplitavg else pipeline.splitfilename
-            
-            make_dirty_image(
-                msfile=image_ms,
-                cell=pipeline.imcellsize[0],
-                imsize=pipeline.imsize_pix,
-                nterms=pipeline.use_nterms,
-                wprojplanes=pipeline.nwprojpl,
-                robust=pipeline.clean_robust
-            )
+            # Step 9: Average the whole MS (the target data is averaged as it is extracted)
+            if dosplitavg and not pipeline.target:
+                logging.info(f"Step 9: Averaging data (chanavg={pipeline.chanavg}, "
+                             f"timeavg={pipeline.timeavg or 'none'})")
+                pipeline.profiler.start_step('average')
+            
+                # Set default averaged filename if not specified
+                if not pipeline.splitavgfilename:
+                    pipeline.splitavgfilename = f"{pipeline.splitfilename}.avg"
             
-            logging.info("Dirty image created")
+                if not os.path.exists(pipeline.splitavgfilename):
+                    average = dict(timeaverage=True, timebin=pipeline.timeavg) \
+                        if pipeline.timeavg else {}
+                    mstransform(
+                        vis=pipeline.splitfilename,
+                        outputvis=pipeline.splitavgfilename,
+                        chanaverage=pipeline.chanavg > 1,
+                        chanbin=pipeline.chanavg,
+                        datacolumn='data',
+                        **average
+                    )
+                    logging.info(f"Averaged data saved to: {pipeline.splitavgfilename}")
+            elif not dosplitavg:
+                logging.info("Step 9: Skipping averaging (chanavg=1)")
+                pipeline.splitavgfilename = pipeline.splitfilename
         
-        # Step 11: Self-calibration (if needed)
-        if pipeline.doselfcal:
-            logging.info("Step 11: Performing self-calibration")
-            
-            # First create a clean image for model
-            image_ms = pipeline.splitavgfilename if dosplitavg else pipeline.splitfilename
-            
-            clean_image(
-                msfile=image_ms,
-                niter=pipeline.niter_start,
-                threshold=f"{pipeline.mJythreshold}mJy",
-                cell=pipeline.imcellsize[0],
-                imsize=pipeline.imsize_pix,
-                nterms=pipeline.use_nterms,
-                wprojplanes=pipeline.nwprojpl,
-                robust=pipeline.clean_robust
-            )
+            # Step 9b: Baseline-dependent time averaging before imaging (if needed)
+            if pipeline.bdatolerance:
+                image_ms = pipeline.splitavgfilename if dosplitavg else pipeline.splitfilename
+                logging.info(f"Step 9b: Baseline-dependent averaging of {image_ms} "
+                             f"(smearing tolerance {pipeline.bdatolerance})")
+                pipeline.profiler.start_step('bda_average')
             
-            # Self-calibration loops
-            for loop in range(pipeline.scaloops):
-                logging.info(f"Self-calibration loop {loop+1}/{pipeline.scaloops}")
-                
-                solint = pipeline.scalsolints[loop] if loop < len(pipeline.scalsolints) else 'inf'
-                
-                # Gain calibration on target itself
-                gaincal(
-                    vis=image_ms,
-                    caltable=f"{image_ms}.selfcal_{loop}",
-                    solint=solint,
-                    refant=pipeline.ref_ant,
-                    gaintype='G',
-                    calmode='p'
-                )
-                
-                # Apply self-calibration
-                apply_calibration(
+                bdafilename = f"{image_ms}.bda"
+                if not os.path.exists(bdafilename):
+                    bda_average(
+                        msfile=image_ms,
+                        outputvis=bdafilename,
+                        tolerance=pipeline.bdatolerance,
+                        radius_rad=field_radius(image_ms, pipeline.imcellsize[0],
+                                                pipeline.imsize_pix, plan=pipeline.imaging_plan),
+                        max_interval=pipeline.bdamaxinterval
+                    )
+                pipeline.splitavgfilename = bdafilename
+                dosplitavg = True
+        
+            # Step 10: Make dirty image (if needed)
+            if pipeline.makedirty:
+                logging.info("Step 10: Creating dirty image")
+                pipeline.profiler.start_step('make_dirty_image')
+            
+                image_ms = pipeline.splitavgfilename if dosplitavg else pipeline.splitfilename
+            
+                make_dirty_image(
                     msfile=image_ms,
-                    field='0',
-                    gaintables=[f"{image_ms}.selfcal_{loop}"]
+                    cell=pipeline.imcellsize[0],
+                    imsize=pipeline.imsize_pix,
+                    nterms=pipeline.use_nterms,
+                    wprojplanes=pipeline.nwprojpl,
+                    robust=pipeline.clean_robust,
+                    plan=pipeline.imaging_plan
                 )
-                
-                # Re-image
-                clean_image(
-                    msfile=image_ms,
+            
+                logging.info("Dirty image created")
+        
+            # Step 11: Self-calibration (if needed)
+            if pipeline.doselfcal:
+                logging.info("Step 11: Performing self-calibration")
+                pipeline.profiler.start_step('selfcal')
+            
+                image_ms = pipeline.splitavgfilename if dosplitavg else pipeline.splitfilename
+                selfcal_params = dict(
+                    loops=pipeline.scaloops,
+                    solints=pipeline.scalsolints,
+                    min_improvement=pipeline.scalminimprovement,
+                    solint_candidates=(pipeline.scalsolintcands if pipeline.scalsolintsearch
+                                       else None),
+                    max_flagged=pipeline.scalmaxflagged,
+                    min_snr=pipeline.scalminsnr,
+                    ref_ant=pipeline.ref_ant,
                     niter=pipeline.niter_start,
                     threshold=f"{pipeline.mJythreshold}mJy",
                     cell=pipeline.imcellsize[0],
                     imsize=pipeline.imsize_pix,
                     nterms=pipeline.use_nterms,
                     wprojplanes=pipeline.nwprojpl,
-                    robust=pipeline.clean_robust
+                    robust=pipeline.clean_robust,
+                    plan=pipeline.imaging_plan
                 )
             
-            logging.info("Self-calibration completed")
+                if pipeline.dosubbandselfcal:
+                    # subband_chan is given in channels of the unaveraged data
+                    subband_chan = max(1, pipeline.subbandchan
+                                       // (pipeline.chanavg if dosplitavg else 1))
+                    subband_selfcal(
+                        msfile=image_ms,
+                        subband_chan=subband_chan,
+                        workers=pipeline.nworkers,
+                        memory_gb=pipeline.workermemory,
+                        **selfcal_params
+                    )
+                else:
+                    selfcal_loop(
+                        msfile=image_ms,
+                        search_workers=pipeline.nworkers,
+                        memory_gb=pipeline.workermemory,
+                        **selfcal_params
+                    )
+            
+                logging.info("Self-calibration completed")
         
+        pipeline.profiler.stop_step()
+        for record in pipeline.profiler.records:
+            if record['kind'] == 'step':
+                pipeline.state.record_profile(record['name'], record)
+        pipeline.state.finish_run('done')
+        pipeline.profiler.log_summary()
+        pipeline.profiler.write_report(profile_report)
         logging.info("="*85)
         logging.info("CAPTURE Pipeline completed successfully!")
         logging.info("="*85)
         
     except Exception as e:
         logging.error(f"Pipeline failed: {e}")
+        if pipeline is not None:
+            # Finish the measurement of the failed step before the interpreter exits
+            record = pipeline.profiler.stop_step()
+            if record is not None:
+                pipeline.state.mark_step_failed(record['name'], e, wall_s=record['wall_s'])
+            pipeline.state.finish_run('failed')
         if debug:
             import traceback
             traceback.print_exc()
@@ -362,7 +516,8 @@ def run_pipeline(input_file: str, working_dir: str | None = None, debug: bool =
 
 def main():
     args = parse_args()
-    run_pipeline(input_file=args.input_file, working_dir=args.working_dir, debug=args.debug, show_version=args.version)
+    run_pipeline(input_file=args.input_file, working_dir=args.working_dir, debug=args.debug, show_version=args.version,
+                 profile_report=args.profile_report, cprofile_dir=args.cprofile, plan=args.plan)
 
 if __name__ == '__main__':
     main()
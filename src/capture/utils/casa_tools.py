@@ -3,29 +3,89 @@
 import os
 import logging
 from pathlib import Path
-from casatasks import flagdata, visstat
-from casatools import ms
-from casatools import msmetadata
 from contextlib import contextmanager
 
+from .lazy import casatasks, casatools
+from .ms_metadata import get_metadata
+
 
 @contextmanager
 def msmd(msfile: str | Path, nomodify: bool = True, lock: str = 'default'):
     """Wrapper function that saves the user to do the shit thing that CASA developers coded,
     of loading the ms() then open, and not being save of closing it."""
+    msobj = casatools.msmetadata()
     try:
-        msobj = msmetadata()
-        msobj.open(msfile if isinstance(msfile, str) else str(msfile), nomodify=nomodify,
-                     lockoptions={'option': lock})
+        # msmetadata.open() only takes the MS name (nomodify/lock are kept for compatibility)
+        msobj.open(msfile if isinstance(msfile, str) else str(msfile))
         yield msobj
     finally:
         msobj.done()
         msobj.close()
 
+@contextmanager
+def casatable(tablename: str | Path, nomodify: bool = True):
+    """Same as `msmd` but for a generic CASA table (e.g. the main table of an MS)."""
+    tbobj = casatools.table()
+    try:
+        tbobj.open(str(tablename), nomodify=nomodify)
+        yield tbobj
+    finally:
+        tbobj.close()
+        tbobj.done()
+
+# Target size of the data read at once by `iter_ms_chunks`
+CHUNK_BYTES = 256 * 1024**2
+
+# Array columns that can be restricted to a channel range in `iter_ms_chunks`
+CHANNEL_COLUMNS = ('DATA', 'CORRECTED_DATA', 'MODEL_DATA', 'FLAG', 'WEIGHT_SPECTRUM',
+                   'SIGMA_SPECTRUM')
+
+def iter_ms_chunks(msfile, columns, chunk_rows=None, chan_range=None, query=None):
+    """Read columns of the main table of an MS in bounded chunks of rows.
+
+    Yields dictionaries mapping each column name to its values for the chunk. Array
+    columns come in CASA order (correlation, channel, row). If `chan_range` is given as
+    (first, last) channels (both inclusive), only that channel range of the data/flag
+    columns is read from disk. If `chunk_rows` is None, it is chosen so that a chunk of
+    complex visibilities takes about `CHUNK_BYTES`. If a TaQL `query` is given (e.g.
+    'SCAN_NUMBER IN [2,3]'), only the matching rows are read.
+    Assumes a single spectral window, like the rest of the pipeline.
+    """
+    with casatable(msfile) as maintb:
+        tb = maintb.query(query) if query else maintb
+        try:
+            nrows = tb.nrows()
+            if nrows == 0:
+                return
+
+            if chunk_rows is None:
+                nchan, ncorr = getnchan(msfile), getpols(msfile)
+                if chan_range is not None:
+                    nchan = chan_range[1] - chan_range[0] + 1
+                # complex64 data plus the boolean flag per visibility
+                chunk_rows = max(1, CHUNK_BYTES // (9 * nchan * ncorr))
+
+            for startrow in range(0, nrows, chunk_rows):
+                nrow = min(chunk_rows, nrows - startrow)
+                chunk = {}
+                for col in columns:
+                    if chan_range is not None and col in CHANNEL_COLUMNS:
+                        chunk[col] = tb.getcolslice(col, blc=[-1, chan_range[0]],
+                                                    trc=[-1, chan_range[1]], incr=[1, 1],
+                                                    startrow=startrow, nrow=nrow)
+                    else:
+                        chunk[col] = tb.getcol(col, startrow=startrow, nrow=nrow)
+                yield chunk
+        finally:
+            if query:
+                tb.close()
+
 def vislistobs(msfile):
     """Write verbose output of listobs task."""
-    ms.open(msfile)
-    outr = ms.summary(verbose=True, listfile=msfile+'.list')
+    myms = casatools.ms()
+    myms.open(msfile)
+    outr = myms.summary(verbose=True, listfile=msfile+'.list', overwrite=True)
+    myms.close()
     try:
         assert os.path.isfile(msfile+'.list')
         logging.info("Listobs output saved to .list file")
@@ -35,49 +95,31 @@ def vislistobs(msfile):
 
 def getpols(msfile):
     """Get number of polarizations in file."""
-    with msmd(msfile) as msmdfile:
-        polid = msmdfile.ncorrforpol(0)
-
-    return polid
+    return get_metadata(msfile).ncorr_for_pol(0)
 
 def getfields(msfile):
     """Get list of field names in MS."""
-    with msmd(msfile) as msmdfile:
-        fieldnames = msmdfile.fieldnames()
-    return fieldnames
+    return get_metadata(msfile).fieldnames.tolist()
 
 def getscans(msfile, mysrc):
     """Get list of scan numbers for specified source."""
-    with msmd(msfile) as msmdfile:
-        return msmdfile.scansforfield(mysrc).tolist()
+    return get_metadata(msfile).scans_for_field(mysrc).tolist()
 
 def getantlist(myvis, scanno):
     """Get list of antennas for given scan."""
-    with msmd(myvis) as msmdfile:
-        antenna_name = msmdfile.antennasforscan(scanno)
-        antlist = []
-        for i in range(0, len(antenna_name)):
-            antlist.append(msmdfile.antennanames(antenna_name[i])[0])
-    return antlist
+    return get_metadata(myvis).antenna_names_for_scan(scanno)
 
 def getnchan(msfile):
     """Get number of channels."""
-    with msmd(msfile) as msmdfile:
-        nchan = msmdfile.nchan(0)
-    return nchan
+    return get_metadata(msfile).nchan(0)
 
 def getbw(msfile):
     """Get bandwidth."""
-    with msmd(msfile) as msmdfile:
-        bw = msmdfile.bandwidths(0)
-    return bw
+    return get_metadata(msfile).bandwidth(0)
 
 def freq_info(ms_file):
     """Get frequency information."""
-    with msmd(ms_file) as msmdfile:
-        sw = 0
-        freq = msmdfile.chanfreqs(sw)
-    return freq
+    return get_metadata(ms_file).chan_freqs(0)
 
 def getbandcut(inpmsfile):
     """Get band-specific cutoff values."""
@@ -109,7 +151,7 @@ def getbandcut(inpmsfile):
 
 def myvisstatampraw(myfile, myspw, myant, mycorr, myscan):
     """Get visibility statistics."""
-    mystat = visstat(
+    mystat = casatasks.visstat(
         vis=myfile, axis="amp", datacolumn="data", useflags=False,
         spw=myspw, selectdata=True, antenna=myant, correlation=mycorr,
         scan=myscan, reportingaxes="ddid"
@@ -117,15 +159,24 @@ def myvisstatampraw(myfile, myspw, myant, mycorr, myscan):
     mymean1 = mystat['DATA_DESC_ID=0']['mean']
     return mymean1
 
-def flagsummary(msfile):
-    """Print flagging summary."""
+def flagsummary(msfile, jsonfile=None):
+    """Print flagging summary (see `flag_stats.log_flag_stats`).
+
+    Returns:
+        The flagged and total counts as a flagdata summary dictionary (see
+        `FlagStats.summary`).
+    """
+    from .flag_stats import log_flag_stats
     try:
         assert os.path.isdir(msfile), "MS file not found."
     except AssertionError:
         logging.error("MS file not found.")
         return
         
-    s = flagdata(vis=msfile, mode='summary')
+    return log_flag_stats(msfile, jsonfile=jsonfile).summary()
+
+def log_flagsummary(s):
+    """Print the flagging percentages of a flagdata summary report."""
     allkeys = s.keys()
     logging.info("Flagging percentage:")
     for x in allkeys:
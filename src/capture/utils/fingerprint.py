@@ -0,0 +1,97 @@
+"""Cheap content fingerprints for Measurement Sets and calibration tables.
+
+A Measurement Set (and any CASA table) is a directory, so the modification time
+of the top-level directory does not change when the column files inside it are
+rewritten. These helpers record a (size, inode, mtime) signature for every file
+inside the table instead. Only ``os.stat`` is used: no table data is ever read.
+"""
+
+import os
+import json
+import hashlib
+from pathlib import Path
+
+
+def path_signature(path: str | Path) -> dict | None:
+    """Get the per-file signature of a file or CASA table directory.
+
+    Returns a dictionary mapping each file (relative to `path`, '.' for a plain
+    file) to [size, inode, mtime_ns], or None if the path does not exist.
+    """
+    path = str(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    if not os.path.isdir(path):
+        return {'.': [st.st_size, st.st_ino, st.st_mtime_ns]}
+
+    signature = {}
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        with os.scandir(current) as entries:
+            for entry in entries:
+                # The lock file is touched by every reader, so it says nothing about the content
+                if entry.name == 'table.lock':
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    est = entry.stat(follow_symlinks=False)
+                    signature[os.path.relpath(entry.path, path)] = [est.st_size, est.st_ino,
+                                                                    est.st_mtime_ns]
+    return signature
+
+
+def signature_digest(signature: dict | None) -> str | None:
+    """Reduce a signature from `path_signature` to a short hexadecimal digest."""
+    if signature is None:
+        return None
+    return hashlib.sha1(json.dumps(signature, sort_keys=True).encode()).hexdigest()
+
+
+def fingerprint(path: str | Path) -> str | None:
+    """Get the digest fingerprint of a file or CASA table (None if missing)."""
+    return signature_digest(path_signature(path))
+
+
+def params_digest(params: dict) -> str:
+    """Get a digest of the resolved parameters of a step or task call."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def changed_files(old: dict | None, new: dict | None) -> list:
+    """List the files that differ between two signatures from `path_signature`."""
+    old = old or {}
+    new = new or {}
+    return sorted(name for name in set(old) | set(new) if old.get(name) != new.get(name))
+
+
+# Subtables that hold everything `msmetadata` reports about an MS
+METADATA_SUBTABLES = ('ANTENNA', 'DATA_DESCRIPTION', 'FIELD', 'OBSERVATION', 'POLARIZATION',
+                      'SPECTRAL_WINDOW', 'STATE')
+
+
+def ms_metadata_fingerprint(msfile: str | Path) -> str | None:
+    """Get a fingerprint of the metadata of an MS, insensitive to flag or data column updates.
+
+    The metadata subtables are signed in full, while the main table files are only signed
+    by size and inode: rewriting FLAG or CORRECTED_DATA in place does not change the
+    fields, scans, antennas or spectral setup of the MS.
+    """
+    msfile = str(msfile)
+    if not os.path.isdir(msfile):
+        return None
+
+    signature = {}
+    for subtable in METADATA_SUBTABLES:
+        signature[subtable] = path_signature(os.path.join(msfile, subtable))
+
+    with os.scandir(msfile) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and entry.name != 'table.lock':
+                est = entry.stat(follow_symlinks=False)
+                signature[entry.name] = [est.st_size, est.st_ino]
+    return signature_digest(signature)
@@ -0,0 +1,369 @@
+"""Fast flagging statistics for CAPTURE pipeline.
+
+Replaces the repeated `flagdata(mode='summary')` calls: the FLAG column is read
+in chunks of rows and the flagged fractions per antenna, scan, field, spw,
+correlation and channel are computed with NumPy in one pass. Counts are kept
+per scan, so when a step only adds flags to some scans only those scans are
+read again. The result is cached in memory and in a sidecar file, keyed by a
+fingerprint of the files that store the FLAG column.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+
+from .casa_tools import casatable, iter_ms_chunks
+from .fingerprint import path_signature, signature_digest
+from .ms_metadata import get_metadata
+
+
+SIDECAR_SUFFIX = '.capture_flagstats.npz'
+
+# Statistics already computed in this process, by absolute MS path
+_cache = {}
+
+# Column digests already computed in this process, by MS path, column and fingerprint
+_digests = {}
+
+
+def column_fingerprint(msfile, column) -> str | None:
+    """Get a fingerprint of the storage files of a column of the main table of an MS.
+
+    Writing other columns (e.g. CORRECTED_DATA with applycal) does not change it.
+    """
+    msfile = str(msfile)
+    if not os.path.isdir(msfile):
+        return None
+    # A Multi-MS stores the columns in its sub-MSs
+    submss = os.path.join(msfile, 'SUBMSS')
+    if os.path.isdir(submss):
+        return signature_digest({entry.name: column_fingerprint(entry.path, column)
+                                 for entry in os.scandir(submss) if entry.is_dir()})
+
+    with casatable(msfile) as tb:
+        seqnrs = [dm['SEQNR'] for dm in tb.getdminfo().values() if column in dm['COLUMNS']]
+
+    signature = {}
+    with os.scandir(msfile) as entries:
+        for entry in entries:
+            if any(entry.name == f"table.f{seq}" or entry.name.startswith(f"table.f{seq}_")
+                   for seq in seqnrs):
+                signature[entry.name] = path_signature(entry.path)
+    return signature_digest(signature)
+
+
+def flag_fingerprint(msfile) -> str | None:
+    """Get a fingerprint of the storage files of the FLAG column of an MS."""
+    return column_fingerprint(msfile, 'FLAG')
+
+
+def column_digest(msfile, column, chunk_rows=None) -> str | None:
+    """Get a digest of the content of a column of the main table of an MS.
+
+    Unlike `column_fingerprint`, it does not change when a task rewrites the column
+    with the same values. The column is only read again when the fingerprint of its
+    storage files changes.
+    """
+    key = (os.path.abspath(str(msfile)), column, column_fingerprint(msfile, column))
+    if key[2] is None:
+        return None
+    if key not in _digests:
+        digest = hashlib.sha1()
+        for chunk in iter_ms_chunks(msfile, [column], chunk_rows=chunk_rows):
+            values = chunk[column]
+            digest.update(np.packbits(values).tobytes() if values.dtype == bool
+                          else np.ascontiguousarray(values).tobytes())
+        _digests[key] = digest.hexdigest()
+    return _digests[key]
+
+
+def flag_digest(msfile, chunk_rows=None) -> str | None:
+    """Get a digest of the content of the FLAG column of an MS.
+
+    Unlike `flag_fingerprint`, it does not change when a task rewrites the column
+    with the same flags (e.g. applycal).
+    """
+    return column_digest(msfile, 'FLAG', chunk_rows)
+
+
+class FlagStats:
+    """Flagged and total visibility counts of an MS, kept per scan."""
+
+    # Name of each per-scan count array and the axis it is broken down by
+    AXES = ('antenna', 'spw', 'correlation', 'channel')
+
+    def __init__(self, msfile, fingerprint, scans, counts):
+        """Initialize from the per-scan counts.
+
+        Args:
+            msfile: Measurement Set the statistics belong to
+            fingerprint: `flag_fingerprint` of the MS when the counts were taken
+            scans: Array with the scan numbers
+            counts: Dictionary with, for each axis in `AXES`, 'flagged_{axis}' and
+                    'total_{axis}' arrays of shape (nscan, n_axis)
+        """
+        self.msfile = str(msfile)
+        self.fingerprint = fingerprint
+        self.scans = np.asarray(scans, dtype=np.int64)
+        self.counts = counts
+
+    @classmethod
+    def empty(cls, msfile):
+        """Get statistics with all counts set to zero."""
+        md = get_metadata(msfile)
+        sizes = {'antenna': len(md.antennanames), 'spw': len(md.bandwidths),
+                 'correlation': md.ncorr_for_pol(0), 'channel': md.nchan(0)}
+        counts = {}
+        for axis in cls.AXES:
+            for kind in ('flagged', 'total'):
+                counts[f"{kind}_{axis}"] = np.zeros((len(md.scannumbers), sizes[axis]))
+        return cls(msfile, None, md.scannumbers, counts)
+
+    def accumulate(self, scans=None, chunk_rows=None):
+        """Read the FLAG column (of the given scans only, if given) and update the counts.
+
+        Raises:
+            ValueError: If one of `scans` is not a scan of the statistics.
+        """
+        nscan = len(self.scans)
+        nant, nspw = self.counts['total_antenna'].shape[1], self.counts['total_spw'].shape[1]
+        if scans is None:
+            query = None
+            iscans = np.arange(nscan)
+        else:
+            scans = sorted(int(s) for s in scans)
+            unknown = set(scans) - set(self.scans.tolist())
+            if unknown:
+                raise ValueError(f"Scans {sorted(unknown)} are not in the flag statistics "
+                                 f"of {self.msfile}")
+            query = f"SCAN_NUMBER IN [{','.join(str(s) for s in scans)}]"
+            iscans = np.searchsorted(self.scans, scans)
+        for name in self.counts:
+            self.counts[name][iscans] = 0
+
+        for chunk in iter_ms_chunks(self.msfile, ['ANTENNA1', 'ANTENNA2', 'SCAN_NUMBER',
+                                                  'DATA_DESC_ID', 'FLAG'],
+                                    chunk_rows=chunk_rows, query=query):
+            flag = chunk['FLAG']
+            ncorr, nchan, nrow = flag.shape
+            sidx = np.searchsorted(self.scans, chunk['SCAN_NUMBER'])
+            nflag = flag.sum(axis=(0, 1))
+            ntotal = np.full(nrow, ncorr * nchan)
+            for ant in (chunk['ANTENNA1'], chunk['ANTENNA2']):
+                idx = sidx * nant + ant
+                self.counts['flagged_antenna'] += np.bincount(
+                    idx, weights=nflag, minlength=nscan * nant).reshape(nscan, nant)
+                self.counts['total_antenna'] += np.bincount(
+                    idx, weights=ntotal, minlength=nscan * nant).reshape(nscan, nant)
+            idx = sidx * nspw + chunk['DATA_DESC_ID']
+            self.counts['flagged_spw'] += np.bincount(
+                idx, weights=nflag, minlength=nscan * nspw).reshape(nscan, nspw)
+            self.counts['total_spw'] += np.bincount(
+                idx, weights=ntotal, minlength=nscan * nspw).reshape(nscan, nspw)
+            # Chunks are ordered in time, so they usually hold a single scan
+            for s in np.unique(sidx):
+                rows = sidx == s
+                nrows = rows.sum()
+                self.counts['flagged_correlation'][s] += flag[:, :, rows].sum(axis=(1, 2))
+                self.counts['total_correlation'][s] += nchan * nrows
+                self.counts['flagged_channel'][s] += flag[:, :, rows].sum(axis=(0, 2))
+                self.counts['total_channel'][s] += ncorr * nrows
+
+        self.fingerprint = flag_fingerprint(self.msfile)
+        return self
+
+    def _fields_of_scans(self):
+        """Get the index of the field of each scan."""
+        md = get_metadata(self.msfile)
+        fields = np.zeros(len(self.scans), dtype=np.int64)
+        for fid in range(len(md.fieldnames)):
+            fscans = md.field_scans[md.field_offsets[fid]:md.field_offsets[fid+1]]
+            fields[np.isin(self.scans, fscans)] = fid
+        return fields
+
+    def fractions(self) -> dict:
+        """Get the flagged fractions per antenna, scan, field, spw, correlation and channel.
+
+        Returns:
+            Dictionary with one entry per axis (a dictionary name -> fraction, or a list
+            for 'channel') plus 'total', ready to be dumped to JSON.
+        """
+        md = get_metadata(self.msfile)
+
+        def ratio(flagged, total):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(total > 0, flagged / total, 0.0)
+
+        flagged_scan = self.counts['flagged_spw'].sum(axis=1)
+        total_scan = self.counts['total_spw'].sum(axis=1)
+        fields = self._fields_of_scans()
+        nfield = len(md.fieldnames)
+        flagged_field = np.bincount(fields, weights=flagged_scan, minlength=nfield)
+        total_field = np.bincount(fields, weights=total_scan, minlength=nfield)
+        per_axis = {axis: ratio(self.counts[f"flagged_{axis}"].sum(axis=0),
+                                self.counts[f"total_{axis}"].sum(axis=0)) for axis in self.AXES}
+
+        return {
+            'total': float(ratio(flagged_scan.sum(), total_scan.sum())),
+            'antenna': dict(zip(md.antennanames.tolist(), per_axis['antenna'].tolist())),
+            'scan': dict(zip((str(s) for s in self.scans), ratio(flagged_scan, total_scan).tolist())),
+            'field': dict(zip(md.fieldnames.tolist(), ratio(flagged_field, total_field).tolist())),
+            'spw': dict(zip((str(s) for s in range(len(per_axis['spw']))), per_axis['spw'].tolist())),
+            'correlation': dict(zip(md.corr_names(0), per_axis['correlation'].tolist())),
+            'channel': per_axis['channel'].tolist()
+        }
+
+    def summary(self) -> dict:
+        """Get the flagged and total counts in the layout of a flagdata summary report.
+
+        Returns:
+            Dictionary with 'flagged' and 'total', and for each of 'antenna', 'scan',
+            'field', 'spw' and 'correlation' a dictionary name -> {'flagged', 'total'}.
+        """
+        md = get_metadata(self.msfile)
+
+        def entries(names, flagged, total):
+            return {str(name): {'flagged': float(f), 'total': float(t)}
+                    for name, f, t in zip(names, flagged, total)}
+
+        flagged_scan = self.counts['flagged_spw'].sum(axis=1)
+        total_scan = self.counts['total_spw'].sum(axis=1)
+        fields = self._fields_of_scans()
+        nfield = len(md.fieldnames)
+        per_axis = {axis: (self.counts[f"flagged_{axis}"].sum(axis=0),
+                           self.counts[f"total_{axis}"].sum(axis=0)) for axis in self.AXES}
+        return {
+            'flagged': float(flagged_scan.sum()),
+            'total': float(total_scan.sum()),
+            'antenna': entries(md.antennanames.tolist(), *per_axis['antenna']),
+            'scan': entries(self.scans.tolist(), flagged_scan, total_scan),
+            'field': entries(md.fieldnames.tolist(),
+                             np.bincount(fields, weights=flagged_scan, minlength=nfield),
+                             np.bincount(fields, weights=total_scan, minlength=nfield)),
+            'spw': entries(range(len(per_axis['spw'][0])), *per_axis['spw']),
+            'correlation': entries(md.corr_names(0), *per_axis['correlation'])
+        }
+
+    def log(self):
+        """Print the flagging percentages, as `flagsummary` did."""
+        fractions = self.fractions()
+        logging.info("Flagging percentage:")
+        for x in ('antenna', 'correlation', 'field', 'scan', 'spw'):
+            for y, frac in fractions[x].items():
+                logging.info(f"{x} {y} {100.*frac}")
+        logging.info(f"total {100.*fractions['total']}")
+
+    def save_json(self, path):
+        """Write the flagged fractions to a JSON file for QA."""
+        with open(path, 'w') as f:
+            json.dump(self.fractions(), f, indent=2)
+
+    @staticmethod
+    def sidecar_path(msfile) -> str:
+        """Get the path of the sidecar file for the MS."""
+        return f"{str(msfile).rstrip('/')}{SIDECAR_SUFFIX}"
+
+    def save(self):
+        """Persist the counts in the sidecar file."""
+        path = self.sidecar_path(self.msfile)
+        try:
+            with open(path, 'wb') as f:
+                np.savez(f, fingerprint=np.asarray(self.fingerprint or '', dtype=str),
+                         scans=self.scans, **self.counts)
+        except OSError as e:
+            logging.warning(f"Failed to save flag statistics {path}: {e}")
+
+    @classmethod
+    def load(cls, msfile):
+        """Load the counts from the sidecar file (None if missing or unreadable)."""
+        path = cls.sidecar_path(msfile)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                counts = {f"{kind}_{axis}": data[f"{kind}_{axis}"]
+                          for axis in cls.AXES for kind in ('flagged', 'total')}
+                return cls(msfile, str(data['fingerprint']), data['scans'], counts)
+        except (OSError, KeyError, ValueError) as e:
+            logging.warning(f"Failed to load flag statistics {path}: {e}")
+            return None
+
+
+def flag_stats(msfile, scans=None, before=None, chunk_rows=None) -> FlagStats:
+    """Get the flagging statistics of an MS, reading as little of the FLAG column as possible.
+
+    Args:
+        msfile: Measurement Set
+        scans: Scans whose flags changed (e.g. the scans selected by a list of flag
+               commands, see `command_scans`) since the FLAG column had the fingerprint
+               `before`. Only these scans are read again, and only if the statistics
+               were last computed at `before`: any other change of the flags (applycal,
+               an external flagdata, statistics left by an earlier run) could be in any
+               scan, so it triggers a full pass, as does None or an unknown scan.
+        before: `flag_fingerprint` of the MS just before the change to `scans`
+        chunk_rows: Rows read per chunk (see `iter_ms_chunks`)
+    """
+    key = os.path.abspath(str(msfile))
+    fingerprint = flag_fingerprint(msfile)
+    if fingerprint is None:
+        raise FileNotFoundError(f"MS file {msfile} not found.")
+
+    stats = _cache.get(key) or FlagStats.load(msfile)
+    if stats is not None and stats.fingerprint == fingerprint:
+        logging.debug(f"Flag statistics of {msfile} are up to date")
+    elif stats is not None and scans is not None and before is not None and \
+            stats.fingerprint == before and \
+            np.array_equal(stats.scans, get_metadata(msfile).scannumbers) and \
+            set(scans) <= set(stats.scans.tolist()):
+        logging.debug(f"Updating flag statistics of {msfile} for scans {sorted(scans)}")
+        stats.accumulate(scans=scans, chunk_rows=chunk_rows)
+        stats.save()
+    else:
+        logging.debug(f"Computing flag statistics of {msfile}")
+        stats = FlagStats.empty(msfile).accumulate(chunk_rows=chunk_rows)
+        stats.save()
+
+    _cache[key] = stats
+    return stats
+
+
+def has_flag_stats(msfile) -> bool:
+    """Check if flagging statistics were already computed for an MS."""
+    return os.path.abspath(str(msfile)) in _cache or os.path.isfile(FlagStats.sidecar_path(msfile))
+
+
+def command_scans(cmds):
+    """Get the scans selected by a list of flag commands.
+
+    Returns:
+        Set of scan numbers, or None (the flags of any scan may change, so the statistics
+        need a full recount) if a command has no scan selection or one that is not a
+        list of scans and scan ranges ('1,3~5').
+    """
+    scans = set()
+    for cmd in cmds:
+        selection = [item for item in cmd.split() if item.startswith('scan=')]
+        if not selection:
+            return None
+        for part in selection[0].split('=', 1)[1].strip('\'"').split(','):
+            try:
+                if '~' in part:
+                    first, last = part.split('~')
+                    scans.update(range(int(first), int(last) + 1))
+                elif part:
+                    scans.add(int(part))
+            except ValueError:
+                return None
+    return scans
+
+
+def log_flag_stats(msfile, jsonfile=None, scans=None, before=None):
+    """Log the flagging statistics of an MS and optionally save them as JSON (see
+    `flag_stats` for `scans` and `before`)."""
+    stats = flag_stats(msfile, scans=scans, before=before)
+    stats.log()
+    if jsonfile:
+        stats.save_json(jsonfile)
+    return stats
@@ -0,0 +1,71 @@
+"""Lazy loading of the CASA modules.
+
+Importing `casatasks` takes seconds (it starts the CASA tools and the logger), so
+the CAPTURE modules use the `casatasks` and `casatools` proxies defined here
+instead: the real module is only imported the first time one of its attributes
+is used. Code that needs to configure CASA when it is loaded (e.g. the log file)
+registers a callback with `on_import`.
+"""
+
+import sys
+import types
+import importlib
+import threading
+
+
+class LazyModule(types.ModuleType):
+    """Module proxy that imports the real module on first attribute access."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_module'] = None
+        self.__dict__['_callbacks'] = []
+        self.__dict__['_lock'] = threading.RLock()
+
+    def _load(self):
+        """Import the module (once) and run the callbacks registered for it."""
+        module = self.__dict__['_module']
+        if module is not None:
+            return module
+        with self._lock:
+            if self.__dict__['_module'] is None:
+                module = importlib.import_module(self.__name__)
+                self.__dict__['_module'] = module
+                callbacks, self.__dict__['_callbacks'] = self._callbacks, []
+                for callback in callbacks:
+                    callback(module)
+        return self.__dict__['_module']
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the real module has been imported (by the proxy or anywhere else)."""
+        return self.__dict__['_module'] is not None or self.__name__ in sys.modules
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.loaded else 'not loaded'
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+casatasks = LazyModule('casatasks')
+casatools = LazyModule('casatools')
+
+
+def on_import(module, callback):
+    """Call `callback(module)` once the real module behind a proxy is imported.
+
+    The callback runs right away if the module was already imported.
+    """
+    if module.loaded:
+        callback(module._load())
+        return
+    with module._lock:
+        if module.__dict__['_module'] is None:
+            module._callbacks.append(callback)
+            return
+    callback(module._load())
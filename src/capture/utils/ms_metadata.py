@@ -0,0 +1,203 @@
+"""In-memory snapshot of the Measurement Set metadata used by CAPTURE.
+
+All the information the pipeline asks `msmetadata` for (fields, scans per field,
+antennas per scan, channel frequencies, bandwidths and polarizations) is read in
+a single open of the MS. It is kept in NumPy arrays (ragged lists are stored
+flat together with an offsets array) and persisted in a sidecar file next to the
+MS, keyed by the metadata fingerprint of the MS, so later steps and reruns do
+not need to open the MS at all.
+"""
+
+import os
+import logging
+from pathlib import Path
+import numpy as np
+
+from .fingerprint import ms_metadata_fingerprint
+
+
+SIDECAR_SUFFIX = '.capture_metadata.npz'
+
+# Names of the Stokes/correlation codes used in the POLARIZATION table
+STOKES_NAMES = {1: 'I', 2: 'Q', 3: 'U', 4: 'V', 5: 'RR', 6: 'RL', 7: 'LR', 8: 'LL',
+                9: 'XX', 10: 'XY', 11: 'YX', 12: 'YY'}
+
+# Snapshots already loaded in this process, by absolute MS path
+_cache = {}
+
+
+def _flatten(arrays, dtype):
+    """Store a list of arrays as one flat array plus the offsets of each item."""
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(a) for a in arrays])
+    flat = np.concatenate([np.asarray(a, dtype=dtype) for a in arrays]) if arrays \
+        else np.zeros(0, dtype=dtype)
+    return flat, offsets
+
+
+class MSMetadata:
+    """Snapshot of the metadata of a Measurement Set."""
+
+    def __init__(self, msfile, fingerprint, fieldnames, field_scans, field_offsets,
+                 antennanames, scannumbers, scan_antennas, scan_offsets,
+                 chanfreqs, spw_offsets, bandwidths, ncorr, corrtypes, pol_offsets):
+        """Initialize the snapshot from its array-backed storage."""
+        self.msfile = str(msfile)
+        self.fingerprint = fingerprint
+        self.fieldnames = np.asarray(fieldnames, dtype=str)
+        self.field_scans = np.asarray(field_scans, dtype=np.int64)
+        self.field_offsets = np.asarray(field_offsets, dtype=np.int64)
+        self.antennanames = np.asarray(antennanames, dtype=str)
+        self.scannumbers = np.asarray(scannumbers, dtype=np.int64)
+        self.scan_antennas = np.asarray(scan_antennas, dtype=np.int64)
+        self.scan_offsets = np.asarray(scan_offsets, dtype=np.int64)
+        self.chanfreqs = np.asarray(chanfreqs, dtype=np.float64)
+        self.spw_offsets = np.asarray(spw_offsets, dtype=np.int64)
+        self.bandwidths = np.asarray(bandwidths, dtype=np.float64)
+        self.ncorr = np.asarray(ncorr, dtype=np.int64)
+        self.corrtypes = np.asarray(corrtypes, dtype=np.int64)
+        self.pol_offsets = np.asarray(pol_offsets, dtype=np.int64)
+
+    @classmethod
+    def from_ms(cls, msfile: str | Path, fingerprint: str | None = None):
+        """Read the full snapshot opening the MS only once."""
+        from .casa_tools import msmd
+
+        with msmd(msfile) as md:
+            fieldnames = list(md.fieldnames())
+            field_scans, field_offsets = _flatten(
+                [np.sort(md.scansforfield(fid)) for fid in range(len(fieldnames))], np.int64)
+            antennanames = list(md.antennanames())
+            scannumbers = np.sort(np.asarray(md.scannumbers(), dtype=np.int64))
+            scan_antennas, scan_offsets = _flatten(
+                [md.antennasforscan(int(scan)) for scan in scannumbers], np.int64)
+            chanfreqs, spw_offsets = _flatten(
+                [md.chanfreqs(spw) for spw in range(md.nspw())], np.float64)
+            bandwidths = np.atleast_1d(md.bandwidths())
+            ncorr = np.atleast_1d(md.ncorrforpol(-1))
+            corrtypes, pol_offsets = _flatten(
+                [md.corrtypesforpol(polid) for polid in range(len(ncorr))], np.int64)
+
+        return cls(msfile, fingerprint or ms_metadata_fingerprint(msfile), fieldnames,
+                   field_scans, field_offsets, antennanames, scannumbers, scan_antennas,
+                   scan_offsets, chanfreqs, spw_offsets, bandwidths, ncorr, corrtypes,
+                   pol_offsets)
+
+    @staticmethod
+    def sidecar_path(msfile: str | Path) -> str:
+        """Get the path of the sidecar file for the MS."""
+        return f"{str(msfile).rstrip('/')}{SIDECAR_SUFFIX}"
+
+    def save(self, path: str | None = None):
+        """Persist the snapshot in its sidecar file."""
+        path = path or self.sidecar_path(self.msfile)
+        try:
+            with open(path, 'wb') as f:
+                np.savez(f, fingerprint=np.asarray(self.fingerprint or '', dtype=str),
+                         fieldnames=self.fieldnames, field_scans=self.field_scans,
+                         field_offsets=self.field_offsets, antennanames=self.antennanames,
+                         scannumbers=self.scannumbers, scan_antennas=self.scan_antennas,
+                         scan_offsets=self.scan_offsets, chanfreqs=self.chanfreqs,
+                         spw_offsets=self.spw_offsets, bandwidths=self.bandwidths,
+                         ncorr=self.ncorr, corrtypes=self.corrtypes,
+                         pol_offsets=self.pol_offsets)
+        except OSError as e:
+            logging.warning(f"Failed to save metadata sidecar {path}: {e}")
+
+    @classmethod
+    def load(cls, msfile: str | Path, fingerprint: str | None = None):
+        """Load the snapshot from the sidecar file.
+
+        Returns None if there is no sidecar or if it was written for a different
+        fingerprint of the MS.
+        """
+        path = cls.sidecar_path(msfile)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                stored = str(data['fingerprint'])
+                if fingerprint is not None and stored != fingerprint:
+                    logging.debug(f"Metadata sidecar {path} is outdated")
+                    return None
+                return cls(msfile, stored, *(data[key] for key in (
+                    'fieldnames', 'field_scans', 'field_offsets', 'antennanames',
+                    'scannumbers', 'scan_antennas', 'scan_offsets', 'chanfreqs',
+                    'spw_offsets', 'bandwidths', 'ncorr', 'corrtypes', 'pol_offsets')))
+        except (OSError, KeyError, ValueError) as e:
+            logging.warning(f"Failed to load metadata sidecar {path}: {e}")
+            return None
+
+    def field_ids(self, field) -> np.ndarray:
+        """Get the field IDs matching a field name or ID."""
+        if isinstance(field, str) and not field.isdigit():
+            return np.flatnonzero(self.fieldnames == field)
+        return np.asarray([int(field)])
+
+    def scans_for_field(self, field) -> np.ndarray:
+        """Get the sorted scan numbers for a field given by name or ID."""
+        scans = [self.field_scans[self.field_offsets[fid]:self.field_offsets[fid+1]]
+                 for fid in self.field_ids(field)]
+        return np.unique(np.concatenate(scans)) if scans else np.zeros(0, dtype=np.int64)
+
+    def antennas_for_scan(self, scan: int) -> np.ndarray:
+        """Get the antenna IDs present in a scan."""
+        idx = np.searchsorted(self.scannumbers, scan)
+        if idx >= len(self.scannumbers) or self.scannumbers[idx] != scan:
+            return np.zeros(0, dtype=np.int64)
+        return self.scan_antennas[self.scan_offsets[idx]:self.scan_offsets[idx+1]]
+
+    def antenna_names_for_scan(self, scan: int) -> list:
+        """Get the antenna names present in a scan."""
+        return self.antennanames[self.antennas_for_scan(scan)].tolist()
+
+    def chan_freqs(self, spw: int = 0) -> np.ndarray:
+        """Get the channel frequencies (Hz) of a spectral window."""
+        return self.chanfreqs[self.spw_offsets[spw]:self.spw_offsets[spw+1]]
+
+    def nchan(self, spw: int = 0) -> int:
+        """Get the number of channels of a spectral window."""
+        return int(self.spw_offsets[spw+1] - self.spw_offsets[spw])
+
+    def bandwidth(self, spw: int = 0) -> float:
+        """Get the total bandwidth (Hz) of a spectral window."""
+        return float(self.bandwidths[spw])
+
+    def ncorr_for_pol(self, polid: int = 0) -> int:
+        """Get the number of correlations of a polarization setup."""
+        return int(self.ncorr[polid])
+
+    def corr_names(self, polid: int = 0) -> list:
+        """Get the names of the correlations of a polarization setup (e.g. ['RR', 'LL'])."""
+        codes = self.corrtypes[self.pol_offsets[polid]:self.pol_offsets[polid+1]]
+        return [STOKES_NAMES.get(int(code), str(code)) for code in codes]
+
+
+def get_metadata(msfile: str | Path) -> MSMetadata:
+    """Get the metadata snapshot of an MS.
+
+    The snapshot is taken from the in-process cache, then from the sidecar file, and
+    only read from the MS when neither matches the current metadata fingerprint.
+    """
+    key = os.path.abspath(str(msfile))
+    fingerprint = ms_metadata_fingerprint(msfile)
+    if fingerprint is None:
+        raise FileNotFoundError(f"MS file {msfile} not found.")
+
+    snapshot = _cache.get(key)
+    if snapshot is not None and snapshot.fingerprint == fingerprint:
+        return snapshot
+
+    snapshot = MSMetadata.load(msfile, fingerprint)
+    if snapshot is None:
+        logging.debug(f"Reading metadata snapshot of {msfile}")
+        snapshot = MSMetadata.from_ms(msfile, fingerprint)
+        snapshot.save()
+
+    _cache[key] = snapshot
+    return snapshot
+
+
+def clear_metadata_cache():
+    """Forget the snapshots loaded in this process."""
+    _cache.clear()
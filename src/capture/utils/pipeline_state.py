@@ -1,107 +1,493 @@
-"""Pipeline state management for CAPTURE."""
+"""Pipeline state management for CAPTURE.
+
+The state is kept in a SQLite database in WAL mode (`.capture_state.db`), so that
+several processes (worker pools, or pipelines sharing a working directory) can
+read it while another one writes, and every update is a short atomic transaction
+on the rows it changes instead of a rewrite of the whole state. Besides the
+current record of every step (outputs, parameter digest and fingerprints), every
+run of a step is kept in its history with the run ID, status and timings.
+
+The JSON state file of earlier versions (`.capture_state.json`) is imported when
+the database is created, and the state can still be exported to and imported
+from that format:
+
+    python -m capture.utils.pipeline_state export state.json
+    python -m capture.utils.pipeline_state last initial_calibration
+"""
 
 import os
+import sys
 import json
+import sqlite3
 import logging
+import argparse
+import socket
 from datetime import datetime
+from contextlib import contextmanager
+
+from .fingerprint import path_signature, params_digest, changed_files
+
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started TEXT NOT NULL,
+    finished TEXT,
+    status TEXT NOT NULL DEFAULT 'running',
+    host TEXT,
+    pid INTEGER
+);
+CREATE TABLE IF NOT EXISTS steps (
+    step TEXT PRIMARY KEY,
+    run_id INTEGER,
+    completed INTEGER NOT NULL DEFAULT 0,
+    timestamp TEXT,
+    outputs TEXT,
+    params TEXT,
+    fingerprinted INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    step TEXT NOT NULL,
+    path TEXT NOT NULL,
+    signature TEXT,
+    PRIMARY KEY (step, path)
+);
+CREATE INDEX IF NOT EXISTS fingerprints_path ON fingerprints (path);
+CREATE TABLE IF NOT EXISTS step_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    step TEXT NOT NULL,
+    run_id INTEGER,
+    status TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    wall_s REAL,
+    params TEXT,
+    error TEXT,
+    profile TEXT
+);
+CREATE INDEX IF NOT EXISTS step_runs_last ON step_runs (step, status, id);
+"""
+
+
+def _dumps(signature):
+    """Serialize a signature so that equal signatures give equal strings."""
+    return json.dumps(signature, sort_keys=True)
+
+
+class SQLiteStore:
+    """SQLite database in WAL mode shared by several processes, with one connection per process."""
 
+    # Statements creating the tables, run when the database is opened
+    SCHEMA = ''
 
-class PipelineState:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        # Connections can't be shared between processes: workers open their own
+        state = self.__dict__.copy()
+        state['_conn'], state['_pid'] = None, None
+        return state
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Connection to the database, opened once per process."""
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.db_file, timeout=60.0, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(self.SCHEMA)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @contextmanager
+    def transaction(self):
+        """Run the statements of a block as one atomic update.
+
+        The write lock is taken at the start (BEGIN IMMEDIATE), so concurrent writers
+        wait for each other instead of failing half-way through their update. A block
+        run inside another one is part of the outer transaction. If the block or the
+        COMMIT fails, the whole update is rolled back.
+        """
+        conn = self.conn
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+    def close(self):
+        """Close the connection of this process (it is reopened when needed)."""
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn, self._pid = None, None
+
+
+class PipelineState(SQLiteStore):
     """Manages pipeline execution state and tracks completed steps."""
-    
-    def __init__(self, state_file='.capture_state.json'):
-        """Initialize pipeline state."""
+
+    SCHEMA = STATE_SCHEMA
+
+    def __init__(self, state_file='.capture_state.db', json_file='.capture_state.json',
+                 run_id=None):
+        """Initialize pipeline state.
+
+        Args:
+            state_file: SQLite database with the state
+            json_file: JSON state file of earlier versions, imported if the database
+                       does not exist yet (None to not import it)
+            run_id: ID of the run the updates belong to (e.g. from the parent process in
+                    a worker). A new run is started on the first update if not given
+        """
+        super().__init__(state_file)
         self.state_file = state_file
-        self.state = self.load_state()
-    
-    def load_state(self):
-        """Load pipeline state from file."""
-        if os.path.exists(self.state_file):
-            try:
-                with open(self.state_file, 'r') as f:
-                    return json.load(f)
-            except Exception as e:
-                logging.warning(f"Failed to load state file: {e}")
-                return {}
-        return {}
-    
-    def save_state(self):
-        """Save pipeline state to file."""
-        try:
-            with open(self.state_file, 'w') as f:
-                json.dump(self.state, f, indent=2)
-        except Exception as e:
-            logging.error(f"Failed to save state file: {e}")
-    
-    def check_step_needed(self, step_name, inputs, outputs):
+        self._run_id = run_id
+        is_new = not os.path.exists(state_file)
+        if is_new and json_file and os.path.exists(json_file):
+            logging.info(f"Importing the pipeline state from {json_file} into {state_file}")
+            self.import_json(json_file)
+
+    @property
+    def run_id(self) -> int:
+        """ID of the current run, started the first time it is needed."""
+        if self._run_id is None:
+            with self.transaction() as conn:
+                self._run_id = conn.execute(
+                    'INSERT INTO runs (started, host, pid) VALUES (?, ?, ?)',
+                    (datetime.now().isoformat(), socket.gethostname(), os.getpid())).lastrowid
+            logging.debug(f"Started run {self._run_id} in {self.state_file}")
+        return self._run_id
+
+    def finish_run(self, status='done'):
+        """Record the end of the current run (if anything was recorded in it)."""
+        if self._run_id is None:
+            return
+        with self.transaction() as conn:
+            conn.execute('UPDATE runs SET finished = ?, status = ? WHERE run_id = ?',
+                         (datetime.now().isoformat(), status, self._run_id))
+
+    def get_record(self, step_name) -> dict:
+        """Get the current record of a step: completed, timestamp, outputs, params and
+        fingerprints (missing for steps recorded without them), or {} if never recorded."""
+        row = self.conn.execute('SELECT * FROM steps WHERE step = ?', (step_name,)).fetchone()
+        if row is None:
+            return {}
+        record = {'completed': bool(row['completed']), 'timestamp': row['timestamp'],
+                  'outputs': json.loads(row['outputs'] or '[]'), 'params': row['params'],
+                  'run_id': row['run_id']}
+        if row['fingerprinted']:
+            record['fingerprints'] = {
+                r['path']: json.loads(r['signature']) for r in self.conn.execute(
+                    'SELECT path, signature FROM fingerprints WHERE step = ?', (step_name,))}
+        return record
+
+    def check_step_needed(self, step_name, inputs, outputs, params=None):
         """
-        Check if a step needs to be run based on input/output file timestamps.
-        
+        Check if a step needs to be run based on the fingerprints of its inputs and outputs.
+
+        The fingerprints recorded by `mark_step_complete` cover every file inside the
+        MS/calibration tables, so changes to the table contents are detected even when
+        the top-level directory mtime is unchanged. Steps recorded by older versions of
+        the state file (without fingerprints) fall back to the timestamp comparison.
+
         Args:
             step_name: Name of the pipeline step
             inputs: List of input file paths
             outputs: List of output file paths
-            
+            params: Dictionary with the resolved parameters of the step
+
         Returns:
             True if step needs to be run, False otherwise
         """
+        reason = self.stale_reason(step_name, inputs, outputs, params)
+        logging.debug(f"Step {step_name}: {reason or 'outputs are up to date'}")
+        return reason is not None
+
+    def stale_reason(self, step_name, inputs, outputs, params=None):
+        """
+        Get why a step needs to be run (see `check_step_needed`).
+
+        Returns:
+            A short description of the reason, or None if the step is up to date
+        """
         # If any output is missing, step needs to be run
         for output in outputs:
             if not os.path.exists(output):
-                logging.debug(f"Output {output} missing for step {step_name}")
-                return True
-        
+                return f"output {output} missing"
+
+        record = self.get_record(step_name)
+        if 'fingerprints' not in record:
+            return self._check_step_timestamps(step_name, inputs, outputs)
+
+        if not record.get('completed', False):
+            return "did not complete in the previous run"
+
+        if params is not None and record.get('params') != params_digest(params):
+            return "parameters changed"
+
+        recorded = record['fingerprints']
+        for path in list(inputs) + list(outputs):
+            if path not in recorded:
+                return f"no fingerprint recorded for {path}"
+            current = path_signature(path)
+            if current != recorded[path]:
+                return (f"{path} changed since the step ran: "
+                        f"{', '.join(changed_files(recorded[path], current)[:5])}")
+        return None
+
+    def _check_step_timestamps(self, step_name, inputs, outputs):
+        """Check if a step needs to be run based on input/output file timestamps.
+
+        Returns:
+            The reason to run the step, or None if it is up to date
+        """
         # Check if inputs are newer than outputs
         input_times = []
         for inp in inputs:
             if os.path.exists(inp):
                 input_times.append(os.path.getmtime(inp))
-        
+
         output_times = []
         for out in outputs:
             if os.path.exists(out):
                 output_times.append(os.path.getmtime(out))
-        
+
         # If any input is newer than any output, step needs to be run
         if input_times and output_times:
             newest_input = max(input_times)
             oldest_output = min(output_times)
             if newest_input > oldest_output:
-                logging.debug(f"Inputs newer than outputs for step {step_name}")
-                return True
-        
-        logging.debug(f"Step {step_name} outputs are up to date")
-        return False
-    
-    def mark_step_complete(self, step_name, outputs):
+                return "inputs newer than outputs"
+        return None
+
+    def snapshot(self, paths):
+        """Get the current per-file signatures of the given paths."""
+        return {path: path_signature(path) for path in paths}
+
+    def mark_step_complete(self, step_name, outputs, inputs=None, params=None, wall_s=None):
         """
-        Mark a step as complete in the state.
-        
+        Mark a step as complete in the state, and add the run to its history.
+
         Args:
             step_name: Name of the pipeline step
             outputs: List of output file paths
+            inputs: List of input file paths to fingerprint
+            params: Dictionary with the resolved parameters of the step
+            wall_s: Wall time of the step in seconds
         """
-        self.state[step_name] = {
-            'completed': True,
-            'timestamp': datetime.now().isoformat(),
-            'outputs': outputs
-        }
-        self.save_state()
+        inputs = inputs or []
+        # Fingerprint outside the transaction: it only needs the write lock for the update
+        fingerprints = self.snapshot(list(inputs) + list(outputs))
+        digest = params_digest(params or {})
+        timestamp = datetime.now().isoformat()
+        run_id = self.run_id
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO steps (step, run_id, completed, timestamp, '
+                         'outputs, params, fingerprinted) VALUES (?, ?, 1, ?, ?, ?, 1)',
+                         (step_name, run_id, timestamp, json.dumps(list(outputs)), digest))
+            conn.execute('DELETE FROM fingerprints WHERE step = ?', (step_name,))
+            conn.executemany('INSERT INTO fingerprints (step, path, signature) VALUES (?, ?, ?)',
+                             [(step_name, path, _dumps(signature))
+                              for path, signature in fingerprints.items()])
+            conn.execute('INSERT INTO step_runs (step, run_id, status, timestamp, wall_s, params) '
+                         "VALUES (?, ?, 'done', ?, ?, ?)",
+                         (step_name, run_id, timestamp, wall_s, digest))
         logging.debug(f"Marked step {step_name} as complete")
-    
+
+    def mark_step_failed(self, step_name, error, params=None, wall_s=None):
+        """Add a failed run of a step to its history (the current record is not changed)."""
+        run_id = self.run_id
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO step_runs (step, run_id, status, timestamp, wall_s, params, '
+                         "error) VALUES (?, ?, 'failed', ?, ?, ?, ?)",
+                         (step_name, run_id, datetime.now().isoformat(), wall_s,
+                          params_digest(params or {}), str(error)))
+        logging.debug(f"Marked step {step_name} as failed")
+
+    def record_profile(self, step_name, profile, keep=None):
+        """
+        Attach the profile of a run of a step (see `Profiler.measure`) to its history.
+
+        The profile goes to the last run of the step in the current run, or to a new
+        history entry if the step was not recorded in this run.
+
+        Args:
+            keep: If given, only the last `keep` runs of the step are kept
+        """
+        run_id = self.run_id
+        with self.transaction() as conn:
+            row = conn.execute('SELECT id FROM step_runs WHERE step = ? AND run_id = ? '
+                               'ORDER BY id DESC LIMIT 1', (step_name, run_id)).fetchone()
+            if row is None:
+                conn.execute('INSERT INTO step_runs (step, run_id, status, timestamp, wall_s, '
+                             "profile) VALUES (?, ?, 'done', ?, ?, ?)",
+                             (step_name, run_id, profile.get('start', datetime.now().isoformat()),
+                              profile.get('wall_s'), json.dumps(profile, default=str)))
+            else:
+                conn.execute('UPDATE step_runs SET profile = ?, wall_s = COALESCE(?, wall_s) '
+                             'WHERE id = ?',
+                             (json.dumps(profile, default=str), profile.get('wall_s'), row['id']))
+            if keep is not None:
+                conn.execute('DELETE FROM step_runs WHERE step = ? AND id NOT IN (SELECT id FROM '
+                             'step_runs WHERE step = ? ORDER BY id DESC LIMIT ?)',
+                             (step_name, step_name, keep))
+
+    def history(self, step_name, limit=None) -> list:
+        """Get the runs of a step, oldest first (or the last `limit` ones)."""
+        rows = self.conn.execute('SELECT * FROM step_runs WHERE step = ? ORDER BY id DESC LIMIT ?',
+                                 (step_name, -1 if limit is None else limit)).fetchall()
+        return [self._step_run(row) for row in reversed(rows)]
+
+    def last_successful_run(self, step_name) -> dict | None:
+        """Get the last run of a step that completed (None if there is none)."""
+        row = self.conn.execute("SELECT * FROM step_runs WHERE step = ? AND status = 'done' "
+                                'ORDER BY id DESC LIMIT 1', (step_name,)).fetchone()
+        return None if row is None else self._step_run(row)
+
+    @staticmethod
+    def _step_run(row) -> dict:
+        run = dict(row)
+        run['profile'] = json.loads(run['profile']) if run['profile'] else None
+        return run
+
+    def adopt_changes(self, step_name, before):
+        """
+        Update the fingerprints recorded by other steps after `step_name` modified files in place.
+
+        Many steps (flagging, applycal) modify the MS in place. Without this, a change
+        made by a later step would make every earlier step look stale on the next run.
+        Recorded fingerprints that still match the state of a file right before
+        `step_name` ran are moved forward to the state of the file after it ran.
+
+        Args:
+            step_name: Name of the pipeline step that just completed
+            before: Signatures of the step paths taken before it ran (see `snapshot`)
+        """
+        after = self.snapshot(before.keys())
+        changed = [(_dumps(after[path]), path, step_name, _dumps(signature))
+                   for path, signature in before.items() if after[path] != signature]
+        if not changed:
+            return
+        with self.transaction() as conn:
+            adopted = conn.executemany('UPDATE fingerprints SET signature = ? WHERE path = ? '
+                                       'AND step != ? AND signature = ?', changed).rowcount
+        logging.debug(f"Adopted changes made by {step_name} in {adopted} fingerprints of "
+                      f"other steps")
+
     def is_step_complete(self, step_name):
         """Check if a step has been marked as complete."""
-        return self.state.get(step_name, {}).get('completed', False)
-    
+        row = self.conn.execute('SELECT completed FROM steps WHERE step = ?',
+                                (step_name,)).fetchone()
+        return bool(row and row['completed'])
+
     def clear_step(self, step_name):
-        """Clear completion status for a step."""
-        if step_name in self.state:
-            del self.state[step_name]
-            self.save_state()
+        """Clear completion status for a step (its history is kept)."""
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM fingerprints WHERE step = ?', (step_name,))
+            cleared = conn.execute('DELETE FROM steps WHERE step = ?', (step_name,)).rowcount
+        if cleared:
             logging.debug(f"Cleared step {step_name} from state")
-    
+
     def reset(self):
-        """Reset all pipeline state."""
-        self.state = {}
-        self.save_state()
+        """Reset all pipeline state (the history of the runs is kept)."""
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM fingerprints')
+            conn.execute('DELETE FROM steps')
         logging.info("Pipeline state reset")
+
+    @property
+    def state(self) -> dict:
+        """The whole state in the JSON format of earlier versions (see `export_json`)."""
+        steps = [row['step'] for row in self.conn.execute('SELECT step FROM steps')]
+        steps += [row['step'] for row in self.conn.execute('SELECT DISTINCT step FROM step_runs')
+                  if row['step'] not in steps]
+        state = {}
+        for step in steps:
+            record = self.get_record(step)
+            record.pop('run_id', None)
+            record['history'] = [run['profile'] or {k: run[k] for k in ('status', 'timestamp',
+                                                                         'wall_s')}
+                                 for run in self.history(step)]
+            state[step] = record
+        return state
+
+    def export_json(self, json_file='.capture_state.json'):
+        """Write the state to a JSON file, in the format of earlier versions."""
+        with open(json_file, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        logging.info(f"Exported the pipeline state to {json_file}")
+
+    def import_json(self, json_file='.capture_state.json'):
+        """Load the steps of a JSON state file (see `export_json`), replacing their records."""
+        try:
+            with open(json_file) as f:
+                state = json.load(f)
+        except Exception as e:
+            logging.warning(f"Failed to load state file: {e}")
+            return
+        with self.transaction() as conn:
+            for step, record in state.items():
+                fingerprints = record.get('fingerprints')
+                conn.execute('DELETE FROM fingerprints WHERE step = ?', (step,))
+                if 'completed' in record:
+                    conn.execute('INSERT OR REPLACE INTO steps (step, completed, timestamp, '
+                                 'outputs, params, fingerprinted) VALUES (?, ?, ?, ?, ?, ?)',
+                                 (step, int(record['completed']), record.get('timestamp'),
+                                  json.dumps(record.get('outputs', [])), record.get('params'),
+                                  int(fingerprints is not None)))
+                conn.executemany('INSERT INTO fingerprints (step, path, signature) '
+                                 'VALUES (?, ?, ?)',
+                                 [(step, path, _dumps(signature))
+                                  for path, signature in (fingerprints or {}).items()])
+                conn.executemany('INSERT INTO step_runs (step, status, timestamp, wall_s, '
+                                 "profile) VALUES (?, 'done', ?, ?, ?)",
+                                 [(step, profile.get('start') or record.get('timestamp') or '',
+                                   profile.get('wall_s'), json.dumps(profile, default=str))
+                                  for profile in record.get('history', [])])
+        logging.info(f"Imported {len(state)} steps from {json_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect, export or import the pipeline state',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--state-file', type=str, default='.capture_state.db',
+                        help='SQLite state database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='Write the state to a JSON file')
+    export.add_argument('json_file', type=str, nargs='?', default='.capture_state.json')
+    load = commands.add_parser('import', help='Load the steps of a JSON state file')
+    load.add_argument('json_file', type=str)
+    history = commands.add_parser('history', help='Print the runs of a step')
+    history.add_argument('step', type=str)
+    last = commands.add_parser('last', help='Print the last successful run of a step')
+    last.add_argument('step', type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    state = PipelineState(args.state_file, json_file=None)
+    if args.command == 'export':
+        state.export_json(args.json_file)
+    elif args.command == 'import':
+        state.import_json(args.json_file)
+    else:
+        runs = state.history(args.step) if args.command == 'history' else \
+            [run for run in [state.last_successful_run(args.step)] if run]
+        if not runs:
+            print(f"No runs of {args.step} recorded")
+            sys.exit(1)
+        for run in runs:
+            wall = f"{run['wall_s']:.1f} s" if run['wall_s'] is not None else '-'
+            print(f"run {run['run_id']}  {run['timestamp']}  {run['status']:<6} {wall}"
+                  f"{'  ' + run['error'] if run['error'] else ''}")
+
+
+if __name__ == '__main__':
+    main()
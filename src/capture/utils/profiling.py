@@ -0,0 +1,328 @@
+"""Timing, memory and I/O instrumentation for CAPTURE pipeline.
+
+Every pipeline step and every CASA task called through `casatasks` can be measured:
+wall time, CPU time, peak resident memory and bytes read/written, in all cases
+including the child processes (worker pools, CASA subprocesses). Memory and the
+I/O and CPU time of live children are sampled from /proc by a background thread,
+as the increase of their counters over the measurement (workers that outlive a
+step are only charged for what they did during it); the CPU time of the process
+itself and of short-lived children that were never sampled comes from
+`resource.getrusage`. The records are written to a JSON/CSV run report.
+"""
+
+import os
+import csv
+import json
+import time
+import inspect
+import cProfile
+import logging
+import resource
+import threading
+import functools
+from datetime import datetime
+from contextlib import contextmanager
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+# Report columns, in order
+FIELDS = ('kind', 'name', 'step', 'start', 'wall_s', 'cpu_s', 'peak_rss_mb', 'read_mb',
+          'write_mb')
+
+# Profiler the CASA task calls are recorded in (see `Profiler.instrument_casatasks`),
+# and whether the current thread is inside a measured task call
+_recording = None
+_task_state = threading.local()
+
+
+def _children(pid):
+    """Get the PIDs of all the descendants of a process (Linux only, empty elsewhere)."""
+    pids, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    found = [int(p) for p in f.read().split()]
+                pids.extend(found)
+                stack.extend(found)
+        except OSError:
+            continue
+    return pids
+
+
+def _rss(pid) -> int:
+    """Get the resident memory of a process in bytes (0 if not available)."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def _io(pid) -> tuple:
+    """Get the bytes read and written by a process so far (rchar, wchar), or (0, 0)."""
+    counters = {}
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+
+def _cpu(pid) -> float:
+    """Get the user + system CPU seconds used by a process so far (0 if not available)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The command name (field 2) may contain spaces, utime and stime are the
+            # 14th and 15th fields
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+
+def _counters(pid) -> tuple:
+    """Get the (bytes read, bytes written, CPU seconds) of a process so far."""
+    return _io(pid) + (_cpu(pid),)
+
+
+class _Sampler(threading.Thread):
+    """Samples the memory, I/O and CPU time of the process and its children until stopped.
+
+    The counters of a child are cumulative over its life, so they are taken relative to
+    their values in the first sample (taken when the measurement starts): children that
+    already exist then, such as pool workers, only count what they do from then on, and
+    children started later count from zero.
+    """
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_rss = 0
+        self.start_counters = {}
+        self.last_counters = {}
+        self.live = set()
+        self._sampled = False
+        self._finished = threading.Event()
+
+    def sample(self):
+        pid = os.getpid()
+        children = _children(pid)
+        self.peak_rss = max(self.peak_rss, _rss(pid) + sum(_rss(c) for c in children))
+        for child in children:
+            counters = _counters(child)
+            if child not in self.start_counters:
+                self.start_counters[child] = counters if not self._sampled else (0, 0, 0.0)
+            # Keep the last values seen, the counters disappear when the child exits
+            self.last_counters[child] = counters
+        self.live = set(children)
+        self._sampled = True
+
+    def _delta(self, index, pids):
+        return sum(max(0, self.last_counters[pid][index] - self.start_counters[pid][index])
+                   for pid in pids)
+
+    @property
+    def children_read(self) -> int:
+        """Bytes read by the children during the measurement."""
+        return self._delta(0, self.last_counters)
+
+    @property
+    def children_written(self) -> int:
+        """Bytes written by the children during the measurement."""
+        return self._delta(1, self.last_counters)
+
+    @property
+    def children_cpu(self) -> float:
+        """CPU seconds used by the sampled children during the measurement."""
+        return self._delta(2, self.last_counters)
+
+    @property
+    def exited_cpu(self) -> float:
+        """CPU seconds of the whole life of the sampled children that exited during the
+        measurement (as last seen), which `RUSAGE_CHILDREN` also counts once reaped."""
+        return sum(self.last_counters[pid][2] for pid in self.last_counters
+                   if pid not in self.live)
+
+    def run(self):
+        while not self._finished.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._finished.set()
+        self.join()
+        self.sample()
+
+
+def _measured_call(name, call):
+    """Get a replacement for the `__call__` of a task class that measures every call in
+    the recording profiler (if any)."""
+    @functools.wraps(call)
+    def measured(task, *args, **kwargs):
+        profiler = _recording
+        if profiler is None or getattr(_task_state, 'active', False):
+            return call(task, *args, **kwargs)
+        _task_state.active = True
+        try:
+            with profiler.measure('task', name):
+                return call(task, *args, **kwargs)
+        finally:
+            _task_state.active = False
+    measured.__signature__ = inspect.signature(call)
+    measured.__measured__ = True
+    return measured
+
+
+class Profiler:
+    """Collects the measurements of the steps and CASA task calls of a pipeline run."""
+
+    def __init__(self, interval=0.5, cprofile_dir=None):
+        """Initialize the profiler.
+
+        Args:
+            interval: Seconds between memory/I/O samples
+            cprofile_dir: If given, the Python side of every step is also profiled with
+                          cProfile and dumped to `{cprofile_dir}/{step}.prof`
+        """
+        self.interval = interval
+        self.cprofile_dir = cprofile_dir
+        self.records = []
+        self._steps = []
+        self._current = None
+
+    @contextmanager
+    def measure(self, kind, name):
+        """Measure the code run inside the context, adding a record when it finishes.
+
+        Yields the record (a dictionary with the `FIELDS`), filled in on exit.
+        """
+        record = {'kind': kind, 'name': name, 'step': self._steps[-1] if self._steps else None,
+                  'start': datetime.now().isoformat()}
+        self_before = resource.getrusage(resource.RUSAGE_SELF)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io_before = _io(os.getpid())
+        wall = time.perf_counter()
+        sampler = _Sampler(self.interval)
+        sampler.sample()
+        sampler.start()
+        # Only one cProfile profiler can be active, nested steps are in the outer one
+        profile = cProfile.Profile() if kind == 'step' and self.cprofile_dir and \
+            not self._steps else None
+        if kind == 'step':
+            self._steps.append(name)
+        if profile is not None:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+                os.makedirs(self.cprofile_dir, exist_ok=True)
+                profile.dump_stats(os.path.join(self.cprofile_dir, f"{name}.prof"))
+            if kind == 'step':
+                self._steps.pop()
+            sampler.stop()
+            wall = time.perf_counter() - wall
+            self_after = resource.getrusage(resource.RUSAGE_SELF)
+            children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            io_after = _io(os.getpid())
+
+            def used(before, after):
+                return after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+            # Live children are sampled; the reaped ones are in RUSAGE_CHILDREN for their
+            # whole life, so the part of it already sampled is taken out
+            reaped = max(0.0, used(children_before, children_after) - sampler.exited_cpu)
+            cpu = used(self_before, self_after) + sampler.children_cpu + reaped
+            # ru_maxrss (KB) is a high-water mark since the process started: it only
+            # says something about this measurement if it grew during it
+            peak = sampler.peak_rss
+            for before, after in ((self_before, self_after), (children_before, children_after)):
+                if after.ru_maxrss > before.ru_maxrss:
+                    peak = max(peak, after.ru_maxrss * 1024)
+            read = io_after[0] - io_before[0] + sampler.children_read
+            written = io_after[1] - io_before[1] + sampler.children_written
+
+            record.update({'wall_s': wall, 'cpu_s': cpu, 'peak_rss_mb': peak / 1024**2,
+                           'read_mb': read / 1024**2, 'write_mb': written / 1024**2})
+            self.records.append(record)
+            logging.debug(f"{kind} {name}: {wall:.1f} s wall, {cpu:.1f} s CPU, "
+                          f"{record['peak_rss_mb']:.0f} MB peak RSS, "
+                          f"{record['read_mb']:.0f} MB read, {record['write_mb']:.0f} MB written")
+
+    def start_step(self, name):
+        """Start measuring a step, finishing the previous one started this way."""
+        self.stop_step()
+        self._current = self.measure('step', name)
+        return self._current.__enter__()
+
+    def stop_step(self):
+        """Finish the step started with `start_step` (if any) and return its record."""
+        if self._current is None:
+            return None
+        current, self._current = self._current, None
+        current.__exit__(None, None, None)
+        return self.records[-1]
+
+    def instrument_casatasks(self):
+        """Measure every call to a CASA task, as a 'task' record under the current step.
+
+        The `__call__` of the task classes is replaced (once per process), so the calls
+        are measured however the task was imported. CASA inspects the signature of the
+        tasks (e.g. flagdata in list mode), so it is kept. The calls are recorded in the
+        profiler that called this last, until its `release_casatasks`. Tasks called from
+        within another task are part of the outer measurement.
+        """
+        global _recording
+        from .lazy import casatasks
+        _recording = self
+        for name in casatasks.__all__:
+            task = getattr(casatasks, name, None)
+            call = getattr(type(task), '__call__', None)
+            if task is None or isinstance(task, type) or call is None or \
+                    hasattr(call, '__measured__') or \
+                    not type(task).__module__.startswith('casatasks.'):
+                continue
+            type(task).__call__ = _measured_call(name, call)
+
+    def release_casatasks(self):
+        """Stop recording the CASA task calls in this profiler."""
+        global _recording
+        if _recording is self:
+            _recording = None
+
+    def step_totals(self) -> dict:
+        """Get the wall time spent in each CASA task, in total over all the calls."""
+        totals = {}
+        for record in self.records:
+            if record['kind'] == 'task':
+                totals[record['name']] = totals.get(record['name'], 0.0) + record['wall_s']
+        return totals
+
+    def log_summary(self):
+        """Log the measured steps and the CASA tasks that took the most time."""
+        for record in self.records:
+            if record['kind'] == 'step':
+                logging.info(f"Step {record['name']}: {record['wall_s']:.1f} s wall, "
+                             f"{record['cpu_s']:.1f} s CPU, {record['peak_rss_mb']:.0f} MB peak, "
+                             f"{record['read_mb']:.0f} MB read, {record['write_mb']:.0f} MB written")
+        totals = sorted(self.step_totals().items(), key=lambda x: -x[1])
+        if totals:
+            logging.info("Time per CASA task: " +
+                         ', '.join(f"{name} {seconds:.1f} s" for name, seconds in totals[:10]))
+
+    def write_report(self, prefix='capture_profile'):
+        """Write all the records to `{prefix}.json` and `{prefix}.csv`."""
+        with open(f"{prefix}.json", 'w') as f:
+            json.dump({'records': self.records, 'task_totals_s': self.step_totals()}, f, indent=2)
+        with open(f"{prefix}.csv", 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            for record in self.records:
+                writer.writerow({key: record.get(key) for key in FIELDS})
+        logging.info(f"Profiling report written to {prefix}.json and {prefix}.csv")
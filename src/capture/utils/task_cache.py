@@ -0,0 +1,449 @@
+"""Memoization of the CASA task calls that write calibration tables and images.
+
+A call is identified by a key hashed from the task name, its normalized arguments
+and the identity of its inputs: the metadata subtables and FLAG column content of
+the MS (plus the storage fingerprint of the data column for imaging, or with
+`data_digest` its content), and for calibration tables and images the cache entry that produced them (or their fingerprint if
+they were not made through the cache). When the key of a call is in the cache,
+its outputs are reused instead of running the task again: in place if they are
+unchanged, otherwise restored from the copy kept in the cache directory.
+
+Tasks that modify the MS in place and only prepare it for the cached calls
+(`clearcal`, `setjy`) are given as `Deferred` calls: they are part of the keys
+and only run before the first call that is not in the cache.
+
+Copies are evicted by age (last use) and total size; entries can also be
+invalidated explicitly:
+
+    python -m capture.utils.task_cache list
+    python -m capture.utils.task_cache invalidate --task bandpass
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+
+from .lazy import casatasks
+from .casa_tools import casatable
+from .fingerprint import path_signature, signature_digest, METADATA_SUBTABLES
+from .flag_stats import column_digest, column_fingerprint, flag_digest
+from .pipeline_state import SQLiteStore
+
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    task TEXT NOT NULL,
+    args TEXT,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    stored INTEGER NOT NULL DEFAULT 0,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    signature TEXT,
+    copy TEXT,
+    PRIMARY KEY (key, path)
+);
+CREATE INDEX IF NOT EXISTS outputs_path ON outputs (path);
+"""
+
+# Arguments that do not change what a task writes
+IGNORED_ARGS = {'calcpsf', 'calcres', 'interactive', 'parallel'}
+
+# Arguments holding paths, made absolute in the keys
+PATH_ARGS = {'vis', 'caltable', 'gaintable', 'fluxtable', 'imagename', 'callib', 'startmodel'}
+
+# Cache used by `call_cached`, set with `configure`
+_default = None
+
+
+def _dumps(value):
+    """Serialize a value so that equal values give equal strings (arrays as lists)."""
+    return json.dumps(value, sort_keys=True,
+                      default=lambda v: v.tolist() if hasattr(v, 'tolist') else str(v))
+
+
+def normalize_args(args) -> dict:
+    """Normalize task arguments for the key: paths made absolute, lists for tuples."""
+    def normalize(value, path):
+        if isinstance(value, (list, tuple)):
+            return [normalize(v, path) for v in value]
+        if path and isinstance(value, str) and value:
+            return os.path.abspath(value)
+        return value
+    return {name: normalize(value, name in PATH_ARGS) for name, value in sorted(args.items())
+            if name not in IGNORED_ARGS}
+
+
+def data_column(msfile) -> str:
+    """Get the column imaging tasks read from an MS: CORRECTED_DATA if present, else DATA."""
+    with casatable(msfile) as tb:
+        return 'CORRECTED_DATA' if 'CORRECTED_DATA' in tb.colnames() else 'DATA'
+
+
+def ms_identity(msfile, datacolumn=None, data_digest=False) -> str | None:
+    """Get the identity of an MS as input of a task call.
+
+    It covers the metadata subtables (recreating the MS changes it), the content of
+    the FLAG column and, if `datacolumn` is given, that column. Tasks that only rewrite
+    the model or the history (clearcal, setjy) do not change it.
+
+    The data column is identified by the fingerprint of its storage files, which every
+    write of the column (e.g. applycal) changes. With `data_digest` its content is
+    hashed instead, so that rewriting the same values keeps the identity, at the cost
+    of reading the whole column each time it was written.
+    """
+    if not os.path.isdir(str(msfile)):
+        return None
+    identity = {'metadata': {name: path_signature(os.path.join(str(msfile), name))
+                             for name in METADATA_SUBTABLES},
+                'flags': flag_digest(msfile)}
+    if datacolumn:
+        identity[datacolumn] = (column_digest(msfile, datacolumn) if data_digest
+                                else column_fingerprint(msfile, datacolumn))
+    return signature_digest(identity)
+
+
+def _size(path) -> int:
+    """Get the bytes used by a file or directory tree."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class Deferred:
+    """Calls modifying the MS in place that cached calls depend on (e.g. clearcal, setjy).
+
+    They are part of the key of the calls they are given to, and only run (once) before
+    the first of those calls that is not in the cache.
+    """
+
+    def __init__(self, *calls):
+        """
+        Args:
+            calls: (task name, arguments) tuples, run in order
+        """
+        self.calls = list(calls)
+        self.done = False
+
+    def describe(self) -> list:
+        """Get the normalized calls, for the keys."""
+        return [[task, normalize_args(args)] for task, args in self.calls]
+
+    def run(self):
+        """Run the calls, if they have not run yet."""
+        if self.done:
+            return
+        for task, args in self.calls:
+            getattr(casatasks, task)(**args)
+        self.done = True
+
+
+class TaskCache(SQLiteStore):
+    """Cache of task calls, indexed in a SQLite database inside the cache directory."""
+
+    SCHEMA = CACHE_SCHEMA
+
+    def __init__(self, directory='.capture_cache', max_size_gb=20.0, max_age_days=30.0,
+                 data_digest=False):
+        """
+        Args:
+            directory: Directory with the index and the copies of the outputs
+            max_size_gb: Largest total size of the copies. Outputs of calls larger than
+                         this are not copied, only reused while unchanged in place
+            max_age_days: Entries not used for longer than this are evicted
+            data_digest: Identify the data column read by imaging calls by its content
+                         rather than by its storage fingerprint (see `ms_identity`)
+        """
+        self.directory = os.path.abspath(directory)
+        super().__init__(os.path.join(self.directory, 'index.db'))
+        self.max_size = int(max_size_gb * 1024**3)
+        self.max_age = max_age_days * 86400.0
+        self.data_digest = data_digest
+
+    @property
+    def conn(self):
+        os.makedirs(self.directory, exist_ok=True)
+        return super().conn
+
+    def identity(self, path) -> str | None:
+        """Get the identity of a table or image as input of a task call.
+
+        If its current content was written by a cached call, that is the key of the call
+        (so restoring an output from the cache does not change the keys of the calls that
+        use it), otherwise the fingerprint of its files.
+        """
+        signature = path_signature(path)
+        if signature is None:
+            return None
+        row = self.conn.execute('SELECT key FROM outputs WHERE path = ? AND signature = ?',
+                                (os.path.abspath(path), _dumps(signature))).fetchone()
+        return f"{row['key']}:{os.path.basename(path)}" if row else signature_digest(signature)
+
+    def key(self, task, args, tables=(), datacolumn=False, deferred=None) -> str:
+        """Get the key of a task call.
+
+        Args:
+            task: Task name
+            args: Task arguments (the MS in `vis` is an input)
+            tables: Calibration tables or images read by the task
+            datacolumn: Whether the content of the data column of the MS is an input
+            deferred: `Deferred` calls the task depends on
+        """
+        vis = args.get('vis')
+        inputs = {'task': task, 'args': normalize_args(args),
+                  'vis': ms_identity(vis, data_column(vis) if datacolumn else None,
+                                     self.data_digest) if vis else None,
+                  'tables': {os.path.abspath(t): self.identity(t) for t in tables},
+                  'deferred': deferred.describe() if deferred else None}
+        return hashlib.sha1(_dumps(inputs).encode()).hexdigest()
+
+    def restore(self, key) -> tuple:
+        """Make the outputs of a cached call available at their paths.
+
+        Returns:
+            (True, result of the call) if the entry exists and all its outputs are in
+            place (unchanged or restored from their copies), (False, None) otherwise.
+        """
+        entry = self.conn.execute('SELECT * FROM entries WHERE key = ?', (key,)).fetchone()
+        if entry is None:
+            return False, None
+        outputs = self.conn.execute('SELECT * FROM outputs WHERE key = ?', (key,)).fetchall()
+        restored = {}
+        for output in outputs:
+            if _dumps(path_signature(output['path'])) == output['signature']:
+                continue
+            if not (output['copy'] and os.path.exists(output['copy'])):
+                logging.debug(f"Cache entry {key[:12]}: {output['path']} changed and has no "
+                              f"copy, dropping the entry")
+                self.invalidate(key=key)
+                return False, None
+            _remove(output['path'])
+            if os.path.isdir(output['copy']):
+                shutil.copytree(output['copy'], output['path'])
+            else:
+                shutil.copy2(output['copy'], output['path'])
+            restored[output['path']] = _dumps(path_signature(output['path']))
+        with self.transaction() as conn:
+            conn.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+            conn.executemany('UPDATE outputs SET signature = ? WHERE key = ? AND path = ?',
+                             [(signature, key, path) for path, signature in restored.items()])
+        if restored:
+            logging.info(f"Restored {', '.join(restored)} from the cache")
+        return True, json.loads(entry['result']) if entry['result'] else None
+
+    def store(self, key, task, args, outputs, result=None):
+        """Add a call to the cache, copying its outputs if they fit in the size limit.
+
+        Args:
+            outputs: Paths (or glob patterns) of the outputs written by the call
+        """
+        paths = sorted({os.path.abspath(p) for pattern in outputs
+                        for p in (glob.glob(pattern) if glob.has_magic(pattern) else [pattern])
+                        if os.path.exists(p)})
+        size = sum(_size(path) for path in paths)
+        copies = {}
+        if size <= self.max_size:
+            entrydir = os.path.join(self.directory, key[:2], key)
+            _remove(entrydir)
+            os.makedirs(entrydir)
+            for i, path in enumerate(paths):
+                copies[path] = os.path.join(entrydir, f"{i}_{os.path.basename(path)}")
+                if os.path.isdir(path):
+                    shutil.copytree(path, copies[path])
+                else:
+                    shutil.copy2(path, copies[path])
+        try:
+            result = _dumps(result) if result is not None else None
+        except (TypeError, ValueError):
+            result = None
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM outputs WHERE key = ?', (key,))
+            conn.execute('INSERT OR REPLACE INTO entries (key, task, args, created, last_used, '
+                         'size, stored, result) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (key, task, _dumps(normalize_args(args)), now, now, size,
+                          int(bool(copies)), result))
+            conn.executemany('INSERT INTO outputs (key, path, signature, copy) VALUES (?, ?, ?, ?)',
+                             [(key, path, _dumps(path_signature(path)), copies.get(path))
+                              for path in paths])
+        logging.debug(f"Cached {task} call {key[:12]}: {len(paths)} outputs, "
+                      f"{size / 1024**2:.1f} MB{'' if copies else ' (not copied)'}")
+        self.evict()
+
+    def call(self, task, outputs, tables=(), datacolumn=False, deferred=None, on_hit=None,
+             **args):
+        """Call a CASA task, or reuse the outputs of an identical earlier call.
+
+        Args:
+            task: Task name
+            outputs: Paths (or glob patterns) of the outputs the task writes
+            tables, datacolumn, deferred: Inputs of the call besides the MS (see `key`)
+            on_hit: Function called when the outputs are reused (e.g. to redo a side
+                    effect of the task on the MS)
+            args: Task arguments
+
+        Returns:
+            What the task returns.
+        """
+        key = self.key(task, args, tables, datacolumn, deferred)
+        hit, result = self.restore(key)
+        if hit:
+            logging.info(f"Reusing the outputs of an identical {task} call "
+                         f"(cache entry {key[:12]})")
+            if on_hit is not None:
+                on_hit()
+            return result
+        if deferred is not None:
+            deferred.run()
+        result = getattr(casatasks, task)(**args)
+        self.store(key, task, args, outputs, result)
+        return result
+
+    def _delete(self, conn, keys):
+        """Remove entries and their copies (inside a transaction)."""
+        for key in keys:
+            _remove(os.path.join(self.directory, key[:2], key))
+            conn.execute('DELETE FROM outputs WHERE key = ?', (key,))
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+        return len(keys)
+
+    def evict(self) -> int:
+        """Remove the entries not used within the age limit, then the least recently used
+        copies until the total size is within the size limit.
+
+        Returns:
+            The number of entries removed.
+        """
+        with self.transaction() as conn:
+            keys = [row['key'] for row in conn.execute(
+                'SELECT key FROM entries WHERE last_used < ?', (time.time() - self.max_age,))]
+            total = 0
+            for row in conn.execute('SELECT key, size FROM entries WHERE stored = 1 '
+                                    'ORDER BY last_used DESC').fetchall():
+                if row['key'] in keys:
+                    continue
+                total += row['size']
+                if total > self.max_size:
+                    keys.append(row['key'])
+            removed = self._delete(conn, keys)
+        if removed:
+            logging.info(f"Evicted {removed} entries from the cache in {self.directory}")
+        return removed
+
+    def invalidate(self, key=None, task=None, path=None) -> int:
+        """Remove the entries with the given key, of the given task, or with an output at
+        the given path.
+
+        Returns:
+            The number of entries removed.
+        """
+        query, params = [], []
+        if key is not None:
+            query.append('key LIKE ?')
+            params.append(f"{key}%")
+        if task is not None:
+            query.append('task = ?')
+            params.append(task)
+        if path is not None:
+            query.append('key IN (SELECT key FROM outputs WHERE path = ?)')
+            params.append(os.path.abspath(path))
+        if not query:
+            raise ValueError("Give a key, task or path to invalidate (or use clear)")
+        with self.transaction() as conn:
+            keys = [row['key'] for row in conn.execute(
+                f"SELECT key FROM entries WHERE {' AND '.join(query)}", params)]
+            return self._delete(conn, keys)
+
+    def clear(self) -> int:
+        """Remove all the entries."""
+        with self.transaction() as conn:
+            return self._delete(conn, [row['key'] for row in conn.execute('SELECT key FROM entries')])
+
+    def entries(self) -> list:
+        """Get the entries, most recently used first."""
+        rows = self.conn.execute('SELECT * FROM entries ORDER BY last_used DESC').fetchall()
+        return [{**dict(row), 'outputs': [r['path'] for r in self.conn.execute(
+            'SELECT path FROM outputs WHERE key = ?', (row['key'],))]} for row in rows]
+
+
+def configure(directory='.capture_cache', max_size_gb=20.0, max_age_days=30.0, enabled=True,
+              data_digest=False):
+    """Set the cache used by `call_cached` in this process (None if not enabled)."""
+    global _default
+    _default = TaskCache(directory, max_size_gb, max_age_days, data_digest) if enabled else None
+    return _default
+
+
+def call_cached(task, outputs, tables=(), datacolumn=False, deferred=None, on_hit=None,
+                **args):
+    """Call a CASA task through the cache set with `configure` (see `TaskCache.call`).
+
+    Without a cache the task is just called, after the deferred calls.
+    """
+    if _default is not None:
+        return _default.call(task, outputs, tables, datacolumn, deferred, on_hit, **args)
+    if deferred is not None:
+        deferred.run()
+    return getattr(casatasks, task)(**args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or invalidate the CASA task cache',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--directory', type=str, default='.capture_cache',
+                        help='Cache directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='List the entries, most recently used first')
+    invalidate = commands.add_parser('invalidate', help='Remove some entries')
+    invalidate.add_argument('--key', type=str, default=None, help='Key (or key prefix)')
+    invalidate.add_argument('--task', type=str, default=None, help='Task name')
+    invalidate.add_argument('--path', type=str, default=None, help='Output path')
+    evict = commands.add_parser('evict', help='Apply the age and size limits')
+    evict.add_argument('--max-size-gb', type=float, default=20.0)
+    evict.add_argument('--max-age-days', type=float, default=30.0)
+    commands.add_parser('clear', help='Remove all the entries')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    if not os.path.isdir(args.directory):
+        print(f"No cache in {args.directory}")
+        sys.exit(1)
+    if args.command == 'evict':
+        cache = TaskCache(args.directory, args.max_size_gb, args.max_age_days)
+    else:
+        cache = TaskCache(args.directory)
+    if args.command == 'list':
+        for entry in cache.entries():
+            used = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_used']))
+            print(f"{entry['key'][:12]}  {entry['task']:<10} {used}  "
+                  f"{entry['size'] / 1024**2:8.1f} MB{'' if entry['stored'] else ' (in place)'}"
+                  f"  {', '.join(os.path.basename(p) for p in entry['outputs'])}")
+    elif args.command == 'invalidate':
+        print(f"Removed {cache.invalidate(args.key, args.task, args.path)} entries")
+    elif args.command == 'evict':
+        print(f"Removed {cache.evict()} entries")
+    else:
+        print(f"Removed {cache.clear()} entries")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+"""Tests of the time-smearing limits of the baseline-dependent averaging."""
+
+import math
+
+import numpy as np
+import pytest
+
+from capture.core.bda import max_uv_span, smearing_loss
+from capture.core.planner import SPEED_OF_LIGHT
+
+
+def test_smearing_loss():
+    assert smearing_loss(0.0, 0.01) == 0.0
+    # The first null of the sinc: the source is averaged out
+    assert smearing_loss(100.0, 0.01) == pytest.approx(1.0)
+    losses = smearing_loss(np.array([1.0, 2.0, 5.0]), 0.01)
+    assert np.all(np.diff(losses) > 0)
+
+
+@pytest.mark.parametrize('tolerance', [0.001, 0.01, 0.02])
+def test_max_uv_span(tolerance):
+    radius, freq = math.radians(0.5), 650e6
+    span = max_uv_span(tolerance, radius, freq)
+    # The loss over the span (in wavelengths) is the tolerance, to the small-angle
+    # approximation
+    assert smearing_loss(span * freq / SPEED_OF_LIGHT, radius) == \
+        pytest.approx(tolerance, rel=0.02)
+    # Twice the frequency, half the span; a larger field, a shorter span
+    assert max_uv_span(tolerance, radius, 2 * freq) == pytest.approx(span / 2)
+    assert max_uv_span(tolerance, 2 * radius, freq) == pytest.approx(span / 2)
@@ -0,0 +1,53 @@
+"""Tests of the incremental flagging statistics on a small simulated MS (needs CASA)."""
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('casatools')
+casatasks = pytest.importorskip('casatasks')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'benchmarks'))
+from synthetic import make_synthetic_ms  # noqa: E402
+
+from capture.core.flagging import FlagBatch  # noqa: E402
+from capture.utils import flag_stats as flag_stats_module  # noqa: E402
+from capture.utils.flag_stats import flag_stats  # noqa: E402
+
+
+@pytest.fixture
+def msfile(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(flag_stats_module, '_cache', {})
+    return make_synthetic_ms(str(tmp_path / 'test.ms'), nant=4, nchan=8, nscans=3,
+                             scanlength=32.0)
+
+
+def assert_counts_match(msfile):
+    """Check the statistics against a flagdata summary of the MS."""
+    stats = flag_stats(msfile).summary()
+    reference = casatasks.flagdata(vis=msfile, mode='summary')
+    assert stats['flagged'] == reference['flagged']
+    for axis in ('scan', 'antenna'):
+        assert {name: counts['flagged'] for name, counts in stats[axis].items()} == \
+            {name: counts['flagged'] for name, counts in reference[axis].items()}
+
+
+def test_batch_updates_its_scans(msfile):
+    flag_stats(msfile)
+    batch = FlagBatch(msfile)
+    batch.add('manual', scan='3', antenna='1')
+    batch.apply(summary=False)
+    assert_counts_match(msfile)
+
+
+def test_flags_changed_outside_the_batch(msfile):
+    flag_stats(msfile)
+    # Flags the batch does not know about, in a scan it does not select
+    casatasks.flagdata(vis=msfile, mode='manual', scan='1', antenna='0', flagbackup=False)
+    batch = FlagBatch(msfile)
+    batch.add('manual', scan='3', antenna='1')
+    batch.apply(summary=False)
+    assert flag_stats(msfile).summary()['scan']['1']['flagged'] > 0
+    assert_counts_match(msfile)
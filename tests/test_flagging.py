@@ -0,0 +1,38 @@
+"""Tests of the flag command helpers."""
+
+import numpy as np
+
+from capture.core.flagging import badant_flag_commands, freq_ranges_to_channels
+from capture.utils.flag_stats import command_scans
+
+
+def test_freq_ranges_to_channels():
+    # Lower sideband: the frequency decreases with the channel
+    freqs = 400e6 - 1e6 * np.arange(10)
+    assert freq_ranges_to_channels(freqs, [(395, 397)]).tolist() == [3, 4, 5]
+    # Reversed and overlapping ranges; the edges are included
+    assert freq_ranges_to_channels(freqs, [(392.5, 391), (400, 399), (399.5, 398)]).tolist() == \
+        [0, 1, 2, 8, 9]
+    assert freq_ranges_to_channels(freqs, [(500, 600)]).size == 0
+    assert freq_ranges_to_channels(freqs, []).size == 0
+
+
+def test_badant_flag_commands():
+    badants = [('C00', 1, 'RR', 0.1), ('C00', 2, 'RR', 0.1), ('C00', 3, 'LL', 0.2),
+               ('C00', 3, 'RR', 0.2), ('W01', 5, 'LL', 0.3)]
+    assert badant_flag_commands(badants) == [
+        "mode='manual' antenna='C00' scan='1,2' correlation='RR'",
+        "mode='manual' antenna='C00' scan='3' correlation='LL,RR'",
+        "mode='manual' antenna='W01' scan='5' correlation='LL'",
+    ]
+    assert badant_flag_commands([]) == []
+
+
+def test_command_scans():
+    cmds = badant_flag_commands([('C00', 1, 'RR', 0.1), ('W01', 5, 'LL', 0.3)])
+    assert command_scans(cmds) == {1, 5}
+    assert command_scans(["mode='manual' scan='2~4,7'", 'mode=quack scan="9"']) == {2, 3, 4, 7, 9}
+    assert command_scans([]) == set()
+    # Any scan may change: a command without a scan selection, or one that is not a list
+    assert command_scans(["mode='manual' scan='1'", "mode='manual' antenna='C00'"]) is None
+    assert command_scans(["mode='manual' scan='>3'"]) is None
@@ -0,0 +1,35 @@
+"""Tests of the imaging product records, on image directories without CASA."""
+
+import json
+
+from capture.core.imaging import clear_products, products_changed
+from capture.utils.fingerprint import params_digest
+
+PARAMS = {'msfile': '/data/t.ms', 'imsize': 1024, 'cell': '1arcsec', 'robust': 0.0,
+          'nterms': 1, 'wprojplanes': 1}
+
+
+def write_products(imagename, kinds, params=PARAMS):
+    """Make empty image directories of the given kinds and the product record."""
+    for kind in kinds:
+        (imagename.parent / f"{imagename.name}.{kind}").mkdir()
+    with open(f"{imagename}.capture_products.json", 'w') as f:
+        json.dump({'params': params_digest(params)}, f)
+
+
+def test_products_changed(tmp_path):
+    imagename = tmp_path / 'img'
+    # Nothing was made yet
+    assert not products_changed(imagename, PARAMS)
+    write_products(imagename, ['psf'])
+    assert not products_changed(imagename, dict(PARAMS))
+    assert products_changed(imagename, {**PARAMS, 'imsize': 2048})
+
+
+def test_clear_products(tmp_path):
+    imagename = tmp_path / 'img'
+    write_products(imagename, ['image', 'model', 'psf', 'residual', 'sumwt', 'psf.tt0'])
+    (tmp_path / 'img-dirty-img.psf').mkdir()
+    clear_products(imagename)
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['img-dirty-img.psf', 'img.capture_products.json']
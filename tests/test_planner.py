@@ -0,0 +1,35 @@
+"""Tests of the imaging planner helpers."""
+
+import math
+
+import pytest
+
+from capture.core.planner import min_wprojplanes, optimum_imsize
+
+
+@pytest.mark.parametrize('npix, expected', [(1, 2), (7, 8), (1000, 1000), (1001, 1024),
+                                            (4097, 4320), (5000.5, 5120)])
+def test_optimum_imsize(npix, expected):
+    assert optimum_imsize(npix) == expected
+
+
+def test_optimum_imsize_factors():
+    for npix in range(1, 2000, 37):
+        n = optimum_imsize(npix)
+        assert n >= npix and n % 2 == 0
+        for p in (2, 3, 5):
+            while n % p == 0:
+                n //= p
+        assert n == 1
+
+
+def test_min_wprojplanes():
+    # No w-term, or a field too small for it to matter
+    assert min_wprojplanes(0, math.radians(1)) == 1
+    assert min_wprojplanes(1000, math.radians(1)) == 1
+    # 2 pi 20000 (1 - sqrt(1 - l^2)) / 0.5 = 9.57 at l = 0.5 deg
+    assert min_wprojplanes(20000, math.radians(1)) == 10
+    # Half the phase error needs twice the planes
+    assert min_wprojplanes(20000, math.radians(1), w_phase_error=0.25) == 20
+    # The field edge is capped at l = 1
+    assert min_wprojplanes(1e4, 10.0) == min_wprojplanes(1e4, 2.0) == 125664
@@ -0,0 +1,93 @@
+"""Tests of the step and task bookkeeping of the profiler, without CASA."""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from capture.utils import profiling
+from capture.utils.profiling import Profiler
+
+
+class FakeTask:
+    def __call__(self, vis, mode='list'):
+        return {'vis': vis, 'mode': mode}
+
+
+def test_steps():
+    profiler = Profiler(interval=0.01)
+    assert profiler.stop_step() is None
+    profiler.start_step('flagging')
+    # Starting a step finishes the previous one
+    profiler.start_step('calibration')
+    record = profiler.stop_step()
+    assert record['name'] == 'calibration'
+    assert [r['name'] for r in profiler.records] == ['flagging', 'calibration']
+    assert all(r['kind'] == 'step' and r['wall_s'] >= 0 for r in profiler.records)
+    assert profiler.stop_step() is None
+
+
+def test_tasks_recorded_in_active_profiler(monkeypatch):
+    monkeypatch.setattr(FakeTask, '__call__', profiling._measured_call('fake', FakeTask.__call__))
+    first, second = Profiler(interval=0.01), Profiler(interval=0.01)
+    task = FakeTask()
+
+    monkeypatch.setattr(profiling, '_recording', first)
+    first.start_step('step1')
+    assert task('a.ms') == {'vis': 'a.ms', 'mode': 'list'}
+    first.stop_step()
+    # A second profiler takes over the recording
+    monkeypatch.setattr(profiling, '_recording', second)
+    task('b.ms', mode='summary')
+    second.release_casatasks()
+    task('c.ms')
+
+    assert [(r['kind'], r['name'], r['step']) for r in first.records] == \
+        [('task', 'fake', 'step1'), ('step', 'step1', None)]
+    assert [(r['kind'], r['name']) for r in second.records] == [('task', 'fake')]
+
+
+WORKER = """
+import sys, time
+path = sys.argv[1]
+for line in sys.stdin:
+    if line.strip() == 'work':
+        with open(path, 'rb') as f:
+            while f.read(1 << 20):
+                pass
+        end = time.process_time() + 0.3
+        while time.process_time() < end:
+            pass
+    print('done', flush=True)
+"""
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/io'), reason='needs /proc/<pid>/io')
+def test_worker_across_steps(tmp_path):
+    data = tmp_path / 'data.bin'
+    data.write_bytes(os.urandom(4 << 20))
+    worker = subprocess.Popen([sys.executable, '-c', WORKER, str(data)], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, text=True)
+
+    def ask(command):
+        worker.stdin.write(f"{command}\n")
+        worker.stdin.flush()
+        assert worker.stdout.readline().strip() == 'done'
+
+    try:
+        ask('idle')
+        profiler = Profiler(interval=0.05)
+        profiler.start_step('busy')
+        ask('work')
+        profiler.start_step('idle')
+        ask('idle')
+        profiler.stop_step()
+    finally:
+        worker.stdin.close()
+        worker.wait()
+
+    busy, idle = profiler.records
+    assert busy['read_mb'] >= 4.0 and busy['cpu_s'] >= 0.25
+    # The worker's I/O and CPU of the first step are not charged to the second one
+    assert idle['read_mb'] < 1.0 and idle['cpu_s'] < 0.2
@@ -0,0 +1,68 @@
+"""Tests of the self-calibration helpers."""
+
+import json
+import math
+
+import pytest
+
+from capture.core import selfcal
+from capture.core.selfcal import solint_seconds, subband_ranges
+
+
+def test_subband_ranges():
+    assert subband_ranges(64, 16) == [(0, 15), (16, 31), (32, 47), (48, 63)]
+    # A narrow remainder goes into the last subband, a wide one is its own subband
+    assert subband_ranges(100, 30) == [(0, 29), (30, 59), (60, 99)]
+    assert subband_ranges(100, 40) == [(0, 39), (40, 79), (80, 99)]
+    # Subbands wider than the band, or empty
+    assert subband_ranges(10, 20) == [(0, 9)]
+    assert subband_ranges(10, 0) == [(i, i) for i in range(10)]
+
+
+@pytest.mark.parametrize('solint, seconds', [('int', 0.0), ('60s', 60.0), ('2min', 120.0),
+                                             ('1.5h', 5400.0), ('30', 30.0), (45, 45.0)])
+def test_solint_seconds(solint, seconds):
+    assert solint_seconds(solint) == seconds
+
+
+def test_solint_order():
+    assert solint_seconds('inf') == math.inf
+    assert sorted(['inf', '2min', 'int', '30s'], key=solint_seconds) == \
+        ['int', '30s', '2min', 'inf']
+
+
+def test_revert_to_best_loop(tmp_path, monkeypatch):
+    """The reverted image continues from the model of the best loop, not of the last one."""
+    monkeypatch.chdir(tmp_path)
+    msfile = tmp_path / 'target.ms'
+    # Dynamic range of the image made by every clean: loop 1 is the best one
+    ranges = iter([10.0, 20.0, 15.0, 21.0])
+    cleaned = []
+
+    def clean_image(msfile, **imaging):
+        model = tmp_path / 'target.model'
+        cleaned.append((model / 'loop').read_text() if model.exists() else None)
+        model.mkdir(exist_ok=True)
+        (model / 'loop').write_text(str(len(cleaned) - 1))
+        return 'target'
+
+    def image_metrics(imagename, nterms=1):
+        return {'peak': 1.0, 'residual_rms': 1.0, 'dynamic_range': next(ranges)}
+
+    applied = []
+    monkeypatch.setattr(selfcal, 'clean_image', clean_image)
+    monkeypatch.setattr(selfcal, 'image_metrics', image_metrics)
+    monkeypatch.setattr(selfcal, 'solve_phase_gains', lambda *args: None)
+    monkeypatch.setattr(selfcal, 'gain_phase_scatter', lambda caltable: 1.0)
+    monkeypatch.setattr(selfcal, 'apply_calibration',
+                        lambda msfile, field, gaintables: applied.append(gaintables))
+    selfcal.selfcal_loop(msfile, 3, ['60s', '30s', 'int'], 'C00', 100, '1mJy', '1arcsec',
+                         256, min_improvement=0.1)
+
+    # The loop stopped after loop 2, then loop 1 was applied and re-imaged from its model
+    assert applied[-1] == [f"{msfile}.selfcal_0"]
+    assert cleaned == [None, '0', '1', '1']
+    assert not list(tmp_path.glob('target.selfcal_best*'))
+    with open(f"{msfile}.selfcal.json") as f:
+        report = json.load(f)
+    assert report['final_loop'] == 1 and report['final']['dynamic_range'] == 21.0
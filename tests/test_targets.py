@@ -0,0 +1,17 @@
+"""Tests of the target naming."""
+
+from capture.core.imaging import dirty_image_name, image_prefix
+from capture.core.targets import target_name
+
+
+def test_target_name():
+    assert target_name('TARGET1') == 'TARGET1'
+    assert target_name('J1234+56_a-b') == 'J1234+56_a-b'
+    assert target_name('J1234.5+67 a/b') == 'J1234_5+67_a_b'
+
+
+def test_target_image_names():
+    # The images of a target are named after its whole name, as it has no '.'
+    name = target_name('J0137.3+3309')
+    assert image_prefix(f"targets/{name}/{name}.avg.ms") == name
+    assert dirty_image_name(f"{name}.avg.ms/") == f"{name}-dirty-img"
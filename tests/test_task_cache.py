@@ -0,0 +1,29 @@
+"""Tests of the normalization of the task arguments in the cache keys."""
+
+import os
+
+from capture.utils.task_cache import normalize_args
+
+
+def test_normalize_args(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    args = normalize_args({'vis': 't.ms', 'gaintable': ('t.ms.K1', 't.ms.B1'), 'field': '3C286',
+                           'interp': ('nearest', ''), 'calcpsf': False, 'parallel': True,
+                           'callib': '', 'refant': 'C00'})
+    assert args == {
+        'vis': os.path.join(str(tmp_path), 't.ms'),
+        'gaintable': [os.path.join(str(tmp_path), 't.ms.K1'),
+                      os.path.join(str(tmp_path), 't.ms.B1')],
+        'field': '3C286',
+        'interp': ['nearest', ''],
+        'callib': '',
+        'refant': 'C00',
+    }
+    # Sorted, so that the order of the arguments does not change the key
+    assert list(args) == sorted(args)
+
+
+def test_normalize_args_equal_calls(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert normalize_args({'vis': 't.ms', 'solint': '60s', 'interactive': False}) == \
+        normalize_args({'solint': '60s', 'vis': os.path.join(str(tmp_path), 't.ms')})